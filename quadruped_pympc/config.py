@@ -97,6 +97,11 @@ mpc_params = {
     'horizon_fine_grained':                    2,
     'dt_fine_grained':                         0.01,
 
+    # integrator of the sampling-based mpc: 'euler', 'semi_implicit_euler', 'rk2' or 'rk4'. The higher order
+    # ones allow a larger dt with fewer horizon steps. The fine-grained steps use their own one, if not None
+    'sampling_integrator':                     'euler',
+    'sampling_integrator_fine_grained':        None,
+
     # if this is true, we optimize the step frequency as well
     # for the sampling controller, this is done in the rollout
     # for the gradient-based controller, this is done with a batched version of the ocp
@@ -185,12 +190,88 @@ mpc_params = {
     'sigma_cem_mppi':                          3,
     'sigma_mppi':                              3,
     'sigma_random_sampling':                   [0.2, 3, 10],
+    # cem_mppi: fraction of the samples used as elites, and weight of the elite covariance in the
+    # exponential smoothing of the covariance of each leg (carried from one tick to the next)
+    'cem_elite_fraction':                      0.01,
+    'cem_covariance_smoothing':                0.5,
+    # move the warm start ahead by one mpc period at every tick, by refitting the parametrization
     'shift_solution':                          False,
+    # keep the solution mean, sigma and PRNG key on the device and run state packing, masking of
+    # the legs at lift-off, sampling, rollout and update in a single jitted call per control tick
+    # (not available for the gait-adaptive sampling controller)
+    'use_fused_control_tick':                  False,
+    # if not None, the mppi samples are evaluated in chunks of this size with a streaming update,
+    # so the memory does not grow with num_parallel_computations (which must be a multiple of it)
+    'rollout_chunk_size':                      None,
+    # if more than one, the host CPU is split in this many devices and the mppi samples are sharded
+    # over them (num_parallel_computations must be a multiple of it, rollout_chunk_size is then ignored).
+    # The entry script splits the CPU with helpers.jax_compilation.configure_host_devices before using jax
+    'num_sampling_devices':                    1,
+    # successive-halving of the mppi rollouts: at each of these steps of the horizon only the best
+    # fraction of the samples (by partial cost) continues the rollout, [] integrates all of them
+    'rollout_pruning_steps':                   [],
+    'rollout_pruning_keep_fraction':           0.5,
+    # hybrid mppi: after the update, this many projected gradient steps on the rollout cost are taken from the
+    # new mean and from the best gradient_refinement_candidates samples (step_size is the length of the first step)
+    'gradient_refinement_steps':               0,
+    'gradient_refinement_candidates':          0,
+    'gradient_refinement_step_size':           1.0,
+    # mppi samples the gait timing together with the forces (stage 1 of ROADMAP.md): phase offset and duty factor
+    # of each leg and step frequency, with these standard deviations. The contact sequence of each sample is built
+    # in its rollout (from the current contact). The new timing is kept only if it lowers the cost of the one in use
+    # by gait_timing_min_improvement (relative). The phase offsets are applied to the periodic gait generator at once,
+    # up to gait_timing_max_phase_drift (fraction of the cycle) away from its nominal phase, the duty factors
+    # together with the step frequency (best_sample_freq) at the apex of the swing, as with optimize_step_freq
+    'optimize_gait_timing':                    False,
+    'sigma_gait_timing':                       [0.05, 0.05, 0.1],  # phase offset, duty factor, step frequency
+    'gait_timing_duty_factor_range':           [0.4, 0.9],
+    'gait_timing_step_freq_range':             [0.8, 2.5],
+    'gait_timing_min_improvement':             0.05,
+    'gait_timing_max_phase_drift':             0.25,
+    # additional terms of the stage cost of the sampling rollout, on top of the state regulation with the
+    # diagonal of Q. Each one is a dict with name, kind ('quadratic', 'huber', 'barrier' or 'custom'), source
+    # ('state' error or 'input'), indices, weights and its parameters (delta, lower, upper, or function), e.g.
+    # {'name': 'grf_regularization', 'kind': 'huber', 'source': 'input', 'indices': slice(12, 24), 'weights': 0.1, 'delta': 50.}
+    'sampling_cost_terms':                     [],
+    # mppi and cem_mppi sample only the parameters of the legs in stance somewhere along the horizon
+    # (the mask is rebuilt at every tick from the contact sequence)
+    'use_contact_aware_sampling':              False,
+    # noise of mppi, cem_mppi and random_sampling: 'gaussian' (i.i.d.), or 'sobol' and 'halton' that are
+    # randomized low-discrepancy sequences and need fewer samples
+    'noise_engine':                            'gaussian',
+    # precision of the dynamics in the rollout: 'float32', 'bfloat16' or 'float16'. The state is
+    # integrated and the cost and the mppi weights are accumulated in float32 in any case
+    'rollout_precision':                       'float32',
+    # number of best samples kept from a tick and re-injected in the next one as a pool of elites, rolled out
+    # but not weighted in the update of the mean (only mppi with use_fused_control_tick, without rollout_chunk_size
+    # nor num_sampling_devices, 0 disables it)
+    'num_recycled_samples':                    0,
+    # anytime mode: a controller is built for each of these numbers of samples (e.g. [1000, 3000, 10000]),
+    # and each tick runs the largest one whose measured latency fits the deadline (in seconds). [] disables it
+    # (the tiers are always compiled ahead of time, and measured once when the controller is created)
+    'anytime_sample_tiers':                    [],
+    'anytime_deadline':                        0.01,
+    # compile ahead of time the functions called at every tick, so that the first tick does not stall
+    # (opt-in, as it compiles at the creation of the controller also the functions that end up unused)
+    'use_aot_compilation':                     False,
+    # if not None, the compiled executables are stored in this folder and reused by the next runs
+    # (set once per process, shared by all the controllers)
+    'compilation_cache_dir':                   None,
+    # the wrapper launches the solve without waiting for it, and the whole-body loop keeps using the previous
+    # solution until the new one is ready, waiting for it at most async_mpc_max_staleness mpc ticks later
+    # (the anytime mode waits for every solve, to measure its latency)
+    'use_async_mpc_dispatch':                  False,
+    'async_mpc_max_staleness':                 1,
 
     # ----- END properties for the sampling-based mpc -----
 
     'use_random_gait': True,  # Set to True to use random gait optimization
     'num_gait_samples': 20,    # Number of contact sequences to try
+    'use_jax_gait_generator': False,  # Generate the contact sequences on the device, inside the jitted call
+    'use_gait_bank': False,    # Serve the contact sequences from a bank indexed by the phase of the legs
+    'gait_bank_fresh_samples': 4,  # New contact sequences generated at each tick when using the bank
+    'gait_bank_max_phases': 64,    # Phases of the legs kept in the bank
+    'gait_bank_max_sequences_per_phase': 64,  # Contact sequences kept for each phase
     'gait_stability_weight': 1.0,  # Weight for stability cost term
     'min_support_legs': 2,     # Minimum legs required in stance
 
@@ -58,6 +58,22 @@ class Centroidal_Model_JAX:
             self.dts = jnp.tile(self.dt, config.mpc_params['horizon'])
 
 
+        # Integration scheme of the coarse steps, and of the fine-grained ones of the nonuniform discretization
+        self.integrators = {'euler': self.integrate_euler,
+                            'semi_implicit_euler': self.integrate_semi_implicit_euler,
+                            'rk2': self.integrate_rk2,
+                            'rk4': self.integrate_rk4}
+        integrator = config.mpc_params.get('sampling_integrator', 'euler')
+        integrator_fine_grained = config.mpc_params.get('sampling_integrator_fine_grained', None)
+        if(integrator_fine_grained is None):
+            integrator_fine_grained = integrator
+        if(integrator not in self.integrators or integrator_fine_grained not in self.integrators):
+            print("Error: integrator not recognized")
+            sys.exit(1)
+        self.stage_integrators = (integrator_fine_grained, integrator)
+        self.horizon_fine_grained = config.mpc_params['horizon_fine_grained'] if config.mpc_params['use_nonuniform_discretization'] else 0
+
+
 
 
         # We precompute the inverse of the inertia
@@ -109,6 +125,9 @@ class Centroidal_Model_JAX:
                             [v[2], 0, -v[0]], 
                             [-v[1], v[0], 0]])
         
+        # Canonical jax arrays (e.g. float32 for float64 numpy inputs), their dtype gives the precision of the constants
+        states, inputs, contact_status = jnp.asarray(states), jnp.asarray(inputs), jnp.asarray(contact_status)
+
         # Extracting variables for clarity
         foot_position_fl, foot_position_fr, foot_position_rl, foot_position_rr = jnp.split(states[12:], 4)
         foot_force_fl, foot_force_fr, foot_force_rl, foot_force_rr = jnp.split(inputs[12:], 4)
@@ -119,10 +138,16 @@ class Centroidal_Model_JAX:
         linear_com_vel = states[3:6]
         
 
+        # Constants in the precision of the state, so a reduced precision is not promoted back
+        zero = jnp.zeros((), dtype=states.dtype)
+        one = jnp.ones((), dtype=states.dtype)
+        inertia = self.inertia.astype(states.dtype)
+        inertia_inv = self.inertia_inv.astype(states.dtype)
+
         # Compute linear_com_acc
         temp = jnp.dot(foot_force_fl, stanceFL) + jnp.dot(foot_force_fr, stanceFR) + jnp.dot(foot_force_rl, stanceRL) + jnp.dot(foot_force_rr, stanceRR)
-        gravity = jnp.array([jnp.float32(0), jnp.float32(0), jnp.float32(-9.81)])
-        linear_com_acc = jnp.dot(jnp.float32(1) / self.mass, temp) + gravity
+        gravity = jnp.array([0., 0., -9.81], dtype=states.dtype)
+        linear_com_acc = jnp.dot(one / self.mass, temp) + gravity
         
 
         # Compute euler_rates_base and angular_acc_base
@@ -131,9 +156,9 @@ class Centroidal_Model_JAX:
 
     
         conj_euler_rates = jnp.array([
-            [jnp.float32(1), jnp.float32(0), -jnp.sin(pitch)],
-            [jnp.float32(0), jnp.cos(roll), jnp.cos(pitch) * jnp.sin(roll)],
-            [jnp.float32(0), -jnp.sin(roll), jnp.cos(pitch) * jnp.cos(roll)]
+            [one, zero, -jnp.sin(pitch)],
+            [zero, jnp.cos(roll), jnp.cos(pitch) * jnp.sin(roll)],
+            [zero, -jnp.sin(roll), jnp.cos(pitch) * jnp.cos(roll)]
         ])
 
         
@@ -158,7 +183,7 @@ class Centroidal_Model_JAX:
 
         
         
-        angular_acc_base = -jnp.dot(self.inertia_inv, jnp.dot(skew(w), jnp.dot(self.inertia,  w))) + jnp.dot(self.inertia_inv, jnp.dot(b_R_w, temp2))
+        angular_acc_base = -jnp.dot(inertia_inv, jnp.dot(skew(w), jnp.dot(inertia,  w))) + jnp.dot(inertia_inv, jnp.dot(b_R_w, temp2))
         
         
         # Returning the results
@@ -167,16 +192,102 @@ class Centroidal_Model_JAX:
        
 
 
-    def integrate_jax(self, state, inputs, contact_status, n):
+    def compute_state_derivative(self, state, inputs, contact_status, compute_dtype=None):
+        """
+        State derivative evaluated in compute_dtype (if given), and returned in the precision of the state.
+        """
+        if(compute_dtype is None):
+            return self.fd(state, inputs, contact_status)
+        
+        state = jnp.asarray(state)
+        return self.fd(state.astype(compute_dtype), inputs.astype(compute_dtype), 
+                       contact_status.astype(compute_dtype)).astype(state.dtype)
+
+
+
+    def integrate_euler(self, state, inputs, contact_status, dt, compute_dtype=None):
         """
-        This method computes the forward evolution of the system.
+        Explicit euler step of the base state.
         """
-        fd = self.fd(state, inputs, contact_status)
+        fd = self.compute_state_derivative(state, inputs, contact_status, compute_dtype)
+        return state[0:12] + fd*dt
 
 
-        # Simple euler!
+
+    def integrate_semi_implicit_euler(self, state, inputs, contact_status, dt, compute_dtype=None):
+        """
+        Symplectic euler step: the velocities are updated first, and the position and the orientation 
+        are integrated with the new velocities.
+        """
+        fd = self.compute_state_derivative(state, inputs, contact_status, compute_dtype)
+        velocities = state[0:12] + fd*dt
+        state_new_velocities = jnp.concatenate([state[0:3], velocities[3:6], state[6:9], velocities[9:12], state[12:]])
+        fd_new_velocities = self.compute_state_derivative(state_new_velocities, inputs, contact_status, compute_dtype)
+
+        return jnp.concatenate([state[0:3] + fd_new_velocities[0:3]*dt, velocities[3:6],
+                                state[6:9] + fd_new_velocities[6:9]*dt, velocities[9:12]])
+
+
+
+    def integrate_rk2(self, state, inputs, contact_status, dt, compute_dtype=None):
+        """
+        Heun step (second order Runge-Kutta), the inputs are held during the step.
+        """
+        k1 = self.compute_state_derivative(state, inputs, contact_status, compute_dtype)
+        k2 = self.compute_state_derivative(jnp.concatenate([state[0:12] + k1*dt, state[12:]]), inputs, contact_status, compute_dtype)
+        return state[0:12] + (k1 + k2)*dt/2.
+
+
+
+    def integrate_rk4(self, state, inputs, contact_status, dt, compute_dtype=None):
+        """
+        Classic fourth order Runge-Kutta step, the inputs are held during the step.
+        """
+        k1 = self.compute_state_derivative(state, inputs, contact_status, compute_dtype)
+        k2 = self.compute_state_derivative(jnp.concatenate([state[0:12] + k1*dt/2., state[12:]]), inputs, contact_status, compute_dtype)
+        k3 = self.compute_state_derivative(jnp.concatenate([state[0:12] + k2*dt/2., state[12:]]), inputs, contact_status, compute_dtype)
+        k4 = self.compute_state_derivative(jnp.concatenate([state[0:12] + k3*dt, state[12:]]), inputs, contact_status, compute_dtype)
+        return state[0:12] + (k1 + 2.*k2 + 2.*k3 + k4)*dt/6.
+
+
+
+    def get_integration_stages(self, start, stop):
+        """
+        Split the steps from start to stop (static) in the stages with a single integrator.
+
+        Returns:
+            list: (first step, stop step, integrator) of each nonempty stage
+        """
+        fine_grained_integrator, integrator = self.stage_integrators
+        if(fine_grained_integrator == integrator):
+            return [(start, stop, integrator)]
+        
+        stages = [(start, min(stop, self.horizon_fine_grained), fine_grained_integrator),
+                  (max(start, self.horizon_fine_grained), stop, integrator)]
+        return [stage for stage in stages if stage[0] < stage[1]]
+
+
+
+    def integrate_jax(self, state, inputs, contact_status, n, compute_dtype=None, integrator=None):
+        """
+        This method computes the forward evolution of the system. If compute_dtype is given
+        (e.g. 'bfloat16'), the state derivative is evaluated in that precision, while the 
+        integration is accumulated in the precision of the state. If integrator is None, it 
+        is the one of the stage of step n (see get_integration_stages).
+        """
         dt = self.dts[n]
-        new_state = state[0:12] + fd*dt
+
+        fine_grained_integrator, coarse_integrator = self.stage_integrators
+        if(integrator is None and fine_grained_integrator == coarse_integrator):
+            integrator = coarse_integrator
+        
+        if(integrator is None):
+            # The step is traced, so the stage is selected at runtime
+            new_state = jax.lax.cond(n < self.horizon_fine_grained,
+                                     lambda: self.integrators[fine_grained_integrator](state, inputs, contact_status, dt, compute_dtype),
+                                     lambda: self.integrators[coarse_integrator](state, inputs, contact_status, dt, compute_dtype))
+        else:
+            new_state = self.integrators[integrator](state, inputs, contact_status, dt, compute_dtype)
 
         return jnp.concatenate([new_state, state[12:]])
         
@@ -13,11 +13,18 @@ import sys
 sys.path.append(dir_path)
 sys.path.append(dir_path + '/../')
 
+from jax.sharding import Mesh, NamedSharding, PartitionSpec
+from scipy.stats import qmc
+
 from quadruped_pympc import config
+from quadruped_pympc.helpers.jax_compilation import enable_persistent_compilation_cache, AOTCompiledFunction
 from centroidal_model_jax import Centroidal_Model_JAX
+from quadruped_pympc.helpers.periodic_gait_generator_jax import PeriodicGaitGeneratorJax
+from cost_terms import CostRegistry
 
 import time
 import copy
+import functools
 
 
 
@@ -29,14 +36,20 @@ class Sampling_MPC:
     """This is a small class that implements a sampling based control law"""
 
 
-    def __init__(self, horizon = 200, dt = 0.01, num_parallel_computations = 10000, sampling_method = 'random_sampling', control_parametrization = "linear_spline_1", device="gpu"):
+    def __init__(self, horizon = 200, dt = 0.01, num_parallel_computations = None, sampling_method = 'random_sampling', control_parametrization = "linear_spline_1", device="gpu",
+                 use_aot_compilation = None, anytime_sample_tiers = None):
         """
         Args:
             horizon (int): how much to look into the future for optimizing the gains 
             dt (int): desidered sampling time
+            num_parallel_computations (int): number of samples, None reads it from the config
+            use_aot_compilation (bool): compile the entry points ahead of time, None reads it from the config
+            anytime_sample_tiers (list): numbers of samples of the anytime mode, None reads them from the config
         """
 
-        self.num_parallel_computations = config.mpc_params['num_parallel_computations']
+        if(num_parallel_computations is None):
+            num_parallel_computations = config.mpc_params['num_parallel_computations']
+        self.num_parallel_computations = num_parallel_computations
         self.sampling_method = config.mpc_params['sampling_method']
         self.control_parametrization = config.mpc_params['control_parametrization']
         self.num_sampling_iterations = config.mpc_params['num_sampling_iterations']
@@ -59,6 +72,9 @@ class Sampling_MPC:
                 print("GPU not available, using CPU")
         else:
             self.device = jax.devices('cpu')[0]
+
+        # Executables stored on disk are loaded instead of compiled again (None disables it)
+        self.compilation_cache_path = enable_persistent_compilation_cache(config.mpc_params.get('compilation_cache_dir', None))
         
 
         
@@ -171,13 +187,89 @@ class Sampling_MPC:
             self.sigma_mppi = config.mpc_params['sigma_mppi']
         elif(self.sampling_method == 'cem_mppi'):
             self.compute_control = self.compute_control_cem_mppi
-            self.sigma_cem_mppi = jnp.ones(self.num_control_parameters, dtype=dtype_general) * config.mpc_params['sigma_cem_mppi']
+            # Cholesky factors of the covariance of each leg, adapted on the elites and kept between ticks
+            self.sigma_cem_mppi = self.compute_cem_cholesky_factors(config.mpc_params['sigma_cem_mppi'])
+            self.cem_elite_fraction = config.mpc_params.get('cem_elite_fraction', 0.01)
+            self.cem_covariance_smoothing = config.mpc_params.get('cem_covariance_smoothing', 0.5)
         else:
             # return error and stop execution
             print("Error: sampling method not recognized")
             sys.exit(1)
 
-        self.jitted_compute_control = jax.jit(self.compute_control, device=self.device)
+        # If not None, the MPPI samples are evaluated in chunks of this size (see compute_mppi_update_chunked)
+        self.rollout_chunk_size = config.mpc_params.get('rollout_chunk_size', None)
+        if(self.rollout_chunk_size is not None and self.num_parallel_computations % self.rollout_chunk_size != 0):
+            print("Error: num_parallel_computations must be a multiple of rollout_chunk_size")
+            sys.exit(1)
+
+        # 'gaussian' draws i.i.d. noise, 'sobol' and 'halton' use a randomized low-discrepancy point set 
+        # (see sample_standard_normal)
+        self.noise_engine = config.mpc_params.get('noise_engine', 'gaussian')
+        if(self.noise_engine in ['sobol', 'halton']):
+            self.qmc_points = self.compute_qmc_points(self.num_parallel_computations - 1)
+        elif(self.noise_engine != 'gaussian'):
+            print("Error: noise engine not recognized")
+            sys.exit(1)
+
+        # Precision of the dynamics in the rollout, the state integration, the cost and the weights stay in float32
+        rollout_precision = config.mpc_params.get('rollout_precision', 'float32')
+        self.rollout_compute_dtype = None if rollout_precision == 'float32' else jnp.dtype(rollout_precision)
+
+        # Sample only the parameters that act on legs in stance (see compute_active_parameters_mask)
+        self.use_contact_aware_sampling = config.mpc_params.get('use_contact_aware_sampling', False)
+
+        # Best samples of a tick re-injected in the next one, only with the dense mppi in the fused control 
+        # tick (see compute_control_fused). They are moved ahead by the time between two ticks
+        self.num_recycled_samples = config.mpc_params.get('num_recycled_samples', 0)
+        if(self.num_recycled_samples > 0 and (self.sampling_method != 'mppi' or self.rollout_chunk_size is not None or 
+                                             config.mpc_params.get('num_sampling_devices', 1) > 1 or 
+                                             not config.mpc_params.get('use_fused_control_tick', False))):
+            print("Error: num_recycled_samples requires mppi with use_fused_control_tick, without rollout_chunk_size nor num_sampling_devices")
+            sys.exit(1)
+
+        # Successive-halving of the MPPI rollouts (see compute_pruned_rollout), empty to disable it
+        self.pruning_steps = config.mpc_params.get('rollout_pruning_steps', [])
+        self.pruning_keep_fraction = config.mpc_params.get('rollout_pruning_keep_fraction', 0.5)
+
+        # Projected gradient steps on the MPPI solution and its best samples (see compute_gradient_refinement), 0 to disable it
+        self.gradient_refinement_steps = config.mpc_params.get('gradient_refinement_steps', 0)
+        self.gradient_refinement_candidates = config.mpc_params.get('gradient_refinement_candidates', 0)
+        self.gradient_refinement_step_size = config.mpc_params.get('gradient_refinement_step_size', 1.0)
+
+        # MPPI samples the gait timing (phase offset and duty factor of each leg, and step frequency) together 
+        # with the forces, the contact sequence of each sample is built inside its rollout (see compute_mppi_gait_timing_update)
+        self.optimize_gait_timing = config.mpc_params.get('optimize_gait_timing', False) and self.sampling_method == 'mppi'
+        if(self.optimize_gait_timing and self.noise_engine != 'gaussian'):
+            print("Error: optimize_gait_timing requires the gaussian noise_engine")
+            sys.exit(1)
+        if(self.optimize_gait_timing):
+            gait_params = config.simulation_params['gait_params'][config.simulation_params['gait']]
+            self.timing_pgg = PeriodicGaitGeneratorJax(duty_factor=gait_params['duty_factor'], step_freq=gait_params['step_freq'], 
+                                                       horizon=self.horizon, mpc_dt=self.dt)
+            sigma_phase_offset, sigma_duty_factor, sigma_step_freq = config.mpc_params.get('sigma_gait_timing', [0.05, 0.05, 0.1])
+            self.sigma_gait_timing = jnp.array([sigma_phase_offset]*4 + [sigma_duty_factor]*4 + [sigma_step_freq], dtype=dtype_general)
+            self.duty_factor_range = config.mpc_params.get('gait_timing_duty_factor_range', [0.4, 0.9])
+            self.step_freq_range = config.mpc_params.get('gait_timing_step_freq_range', [0.8, 2.5])
+            self.best_timing_parameters = self.get_nominal_timing_parameters(gait_params['duty_factor'], gait_params['step_freq'])
+            # The new timing is kept only if it lowers the cost of the timing in use by this fraction
+            self.gait_timing_min_improvement = config.mpc_params.get('gait_timing_min_improvement', 0.05)
+
+        # If more than one, the MPPI samples are sharded over these devices (see compute_mppi_update_sharded).
+        # The jitted functions then span all of them, hence they are not pinned to self.device
+        self.num_sampling_devices = config.mpc_params.get('num_sampling_devices', 1)
+        if(self.num_sampling_devices > 1):
+            sampling_devices = jax.devices(self.device.platform)[:self.num_sampling_devices]
+            if(len(sampling_devices) < self.num_sampling_devices or self.num_parallel_computations % self.num_sampling_devices != 0):
+                print("Error: not enough devices (see configure_host_devices), or num_parallel_computations is not a multiple of num_sampling_devices")
+                sys.exit(1)
+            self.sampling_mesh = Mesh(np.array(sampling_devices), ('samples',))
+            self.jit_device = None
+            self.data_placement = NamedSharding(self.sampling_mesh, PartitionSpec())
+        else:
+            self.jit_device = self.device
+            self.data_placement = self.device
+
+        self.jitted_compute_control = jax.jit(self.compute_control, device=self.jit_device)
 
 
         # Initialize the robot model
@@ -227,6 +319,18 @@ class Sampling_MPC:
         self.R = self.R.at[21,21].set(0.1) #foot_force_x_RR
         self.R = self.R.at[22,22].set(0.1) #foot_force_y_RR
         self.R = self.R.at[23,23].set(0.001) #foot_force_z_RR
+
+        # Terms of the stage cost of the rollout (see cost_terms.py): the diagonal of Q is the default
+        # state regulation, config.mpc_params['sampling_cost_terms'] declares the additional terms
+        self.cost_registry = CostRegistry(self.state_dim, self.control_dim)
+        Q_diagonal = np.asarray(jnp.diag(self.Q))
+        self.cost_registry.add_quadratic('com_position', 'state', slice(0, 3), Q_diagonal[0:3])
+        self.cost_registry.add_quadratic('com_velocity', 'state', slice(3, 6), Q_diagonal[3:6])
+        self.cost_registry.add_quadratic('base_angle', 'state', slice(6, 9), Q_diagonal[6:9])
+        self.cost_registry.add_quadratic('base_angle_rates', 'state', slice(9, 12), Q_diagonal[9:12])
+        for term in config.mpc_params.get('sampling_cost_terms', []):
+            self.cost_registry.add_term(**term)
+        self.cost_registry.compile()
  
         # mu is the friction coefficient
         self.mu = config.mpc_params['mu']
@@ -236,15 +340,48 @@ class Sampling_MPC:
         self.f_z_min = config.mpc_params['grf_min']
 
 
+        # Every parametrization is linear in its parameters, hence the whole force
+        # trajectory of a leg along the horizon is a matrix product with a fixed basis
+        self.spline_basis = self.compute_spline_basis()
+
+        # The warm start and the recycled samples are moved ahead by one mpc period at every tick
+        self.tick_shift_matrix = self.compute_shift_matrix(1. / (config.simulation_params['mpc_frequency'] * self.dt))
+
+
         self.best_control_parameters = jnp.zeros((self.num_control_parameters,), dtype=dtype_general)
         self.master_key = jax.random.PRNGKey(42)
-        self.initial_random_parameters = jax.random.uniform(key=self.master_key, minval=-self.max_sampling_forces, maxval=self.max_sampling_forces, shape=(self.num_parallel_computations, self.num_control_parameters ))
+
+        # Predicted states and GRFs of the last solution along the horizon, for IK, visualization, ...
+        self.predicted_trajectory = None
 
 
         
+        # Device-resident solver state and fused control tick (see compute_control_fused)
+        self.use_fused_control_tick = config.mpc_params.get('use_fused_control_tick', False)
+        self.state_keys = ("position", "linear_velocity", "orientation", "angular_velocity",
+                           "foot_FL", "foot_FR", "foot_RL", "foot_RR")
+        self.reference_keys = ("ref_position", "ref_linear_velocity", "ref_orientation", "ref_angular_velocity",
+                               "ref_foot_FL", "ref_foot_FR", "ref_foot_RL", "ref_foot_RR")
+        self.solver_state = jax.device_put(self.get_initial_solver_state(), self.data_placement)
+        self.jitted_compute_control_fused = jax.jit(self.compute_control_fused, donate_argnums=0)
+
+        # All the sampling iterations of a tick in one compiled lax.scan
+        self.jitted_compute_control_iterations = jax.jit(self.compute_control_iterations)
+
+        # Many robots in one call, vmapped over the robots on top of the samples (see compute_control_batch)
+        self.jitted_compute_control_batch = jax.jit(self.compute_control_batch, device=self.jit_device)
+
+        # Forces and gait timing in one MPPI pass, all the iterations in one lax.scan (see compute_control_gait_timing_iterations)
+        if(self.optimize_gait_timing):
+            self.jitted_compute_control_gait_timing = jax.jit(self.compute_control_gait_timing_iterations, device=self.jit_device)
+
+        # Per-term cost of a solution, for logging (see compute_cost_breakdown)
+        self.jitted_compute_cost_breakdown = jax.jit(self.compute_cost_breakdown, device=self.jit_device)
+
+
         # jitting the vmap function!
         self.vectorized_rollout = jax.vmap(self.compute_rollout, in_axes=(None, None, 0, None), out_axes=0)
-        self.jit_vectorized_rollout = jax.jit(self.vectorized_rollout, device=self.device)
+        self.jit_vectorized_rollout = jax.jit(self.vectorized_rollout, device=self.jit_device)
 
         # the first call of jax is very slow, hence we should do this since the beginning 
         # creating a fake initial state, reference and contact sequence
@@ -253,11 +390,27 @@ class Sampling_MPC:
         contact_sequence = jnp.ones((4, self.horizon), dtype=dtype_general)
         
 
-        self.control_parameters_vec = random.uniform(self.master_key, (self.num_control_parameters*self.num_parallel_computations, ), minval=-100., maxval=100.)
+        num_warm_up_samples = self.num_parallel_computations if self.rollout_chunk_size is None else self.rollout_chunk_size
+        self.control_parameters_vec = random.uniform(self.master_key, (self.num_control_parameters*num_warm_up_samples, ), minval=-100., maxval=100.)
         self.jit_vectorized_rollout(initial_state, initial_reference, 
-                                    self.control_parameters_vec.reshape(self.num_parallel_computations, self.num_control_parameters), 
+                                    self.control_parameters_vec.reshape(num_warm_up_samples, self.num_control_parameters), 
                                     contact_sequence)
 
+        # Compile ahead of time the entry points called at every tick, so the first tick does not stall
+        if(use_aot_compilation is None):
+            use_aot_compilation = config.mpc_params.get('use_aot_compilation', False)
+        if(use_aot_compilation):
+            self.compile_entry_points()
+
+        # Anytime mode: each tick runs the largest number of samples that fits the deadline
+        # (see build_sample_tiers and compute_control_anytime)
+        self.anytime_deadline = config.mpc_params.get('anytime_deadline', 0.01)
+        self.anytime_metrics = {}
+        if(anytime_sample_tiers is None):
+            anytime_sample_tiers = config.mpc_params.get('anytime_sample_tiers', [])
+        if(len(anytime_sample_tiers) > 0):
+            self.build_sample_tiers(anytime_sample_tiers, device)
+
             
     
     
@@ -449,6 +602,220 @@ class Sampling_MPC:
 
 
 
+    def compute_spline_basis(self, steps=None):
+        """
+        Precompute the basis matrices of the GRF parametrization. The spline of every leg is 
+        evaluated on the unit parameter vectors for each step of the horizon.
+
+        Args:
+            steps (jnp.array): steps where the splines are evaluated, by default the steps of the horizon
+        Returns:
+            (jnp.array): basis of shape (4, horizon, 3, num_control_parameters_single_leg), such that
+                         the forces of a leg at step n are spline_basis[leg, n] @ leg_parameters
+        """
+
+        unit_parameters = jnp.identity(self.num_control_parameters_single_leg, dtype=dtype_general)
+        if(steps is None):
+            steps = jnp.arange(self.horizon)
+
+        def leg_basis(spline_fun):
+            def basis_at_step(step):
+                f_x, f_y, f_z = jax.vmap(lambda parameters: spline_fun(parameters, step, self.horizon))(unit_parameters)
+                return jnp.stack([f_x, f_y, f_z]).astype(dtype_general)
+            return jax.vmap(basis_at_step)(steps)
+
+        return jnp.stack([leg_basis(self.spline_fun_FL), leg_basis(self.spline_fun_FR),
+                          leg_basis(self.spline_fun_RL), leg_basis(self.spline_fun_RR)])
+    
+
+
+    def compute_active_parameters_mask(self, contact_sequence):
+        """
+        Find the control parameters that can change the rollout: the ones whose basis function
+        is nonzero in at least one step where their leg is in stance.
+
+        Args:
+            contact_sequence (jnp.array): contact sequence of shape (4, horizon)
+        Returns:
+            (jnp.array): mask of shape (num_control_parameters, ), 1 for the active parameters
+        """
+
+        basis_in_stance = jnp.abs(self.spline_basis) * contact_sequence[:, :, jnp.newaxis, jnp.newaxis]
+        active_parameters = jnp.any(basis_in_stance > 0, axis=(1, 2))
+        return active_parameters.reshape((self.num_control_parameters, )).astype(dtype_general)
+    
+
+
+    def compute_shift_matrix(self, advance):
+        """
+        Linear operator that moves the parameters of each leg ahead in time. The shifted parameters 
+        are the least-squares fit of the force trajectory advanced by some steps (the forces after 
+        the end of the horizon are held at the last step).
+
+        Args:
+            advance (float): number of steps (possibly fractional) to move ahead
+        Returns:
+            (jnp.array): matrix of shape (4, num_control_parameters_single_leg, num_control_parameters_single_leg)
+        """
+
+        steps_ahead = jnp.minimum(jnp.arange(self.horizon) + advance, self.horizon - 1)
+        basis = self.spline_basis.reshape((4, self.horizon*3, self.num_control_parameters_single_leg))
+        basis_ahead = self.compute_spline_basis(steps_ahead).reshape((4, self.horizon*3, self.num_control_parameters_single_leg))
+        return jnp.linalg.pinv(basis) @ basis_ahead
+    
+
+
+    def shift_control_parameters(self, control_parameters, shift_matrix):
+        """
+        Apply the shift matrix of compute_shift_matrix to parameters of shape (..., num_control_parameters).
+        """
+
+        leg_parameters = control_parameters.reshape(control_parameters.shape[:-1] + (4, self.num_control_parameters_single_leg))
+        shifted_parameters = jnp.einsum('lpq,...lq->...lp', shift_matrix, leg_parameters)
+        return shifted_parameters.reshape(control_parameters.shape)
+    
+
+
+    def compute_force_trajectory(self, control_parameters):
+        """
+        Compute the GRF of all the legs along the horizon with a single matmul over the spline basis.
+
+        Args:
+            control_parameters (jnp.array): parameters of the four legs, of shape (num_control_parameters, )
+        Returns:
+            (jnp.array): forces of shape (horizon, 4, 3)
+        """
+
+        leg_parameters = control_parameters.reshape((4, self.num_control_parameters_single_leg))
+        return jnp.einsum('lhcp,lp->hlc', self.spline_basis, leg_parameters)
+    
+
+
+    def compute_step_input(self, leg_forces, contact_sequence, n):
+        """
+        Input of the dynamics at step n: the sampled f_z is a delta over gravity compensation, the legs 
+        in swing have zero force and the force constraints are enforced.
+
+        Args:
+            leg_forces (jnp.array): spline forces of the four legs at step n, of shape (4, 3)
+            contact_sequence (jnp.array): contact sequence along the whole horizon
+            n (int): step of the horizon
+        Returns:
+            (jnp.array, float): input of the dynamics and gravity compensation of each leg in stance
+        """
+
+        f_x_FL, f_y_FL, f_z_FL = leg_forces[0]
+        f_x_FR, f_y_FR, f_z_FR = leg_forces[1]
+        f_x_RL, f_y_RL, f_z_RL = leg_forces[2]
+        f_x_RR, f_y_RR, f_z_RR = leg_forces[3]
+
+
+        # The sampling over f_z is a delta over gravity compensation (only for the leg in stance!)
+        number_of_legs_in_stance = contact_sequence[0][n] + contact_sequence[1][n] + contact_sequence[2][n] + contact_sequence[3][n]
+        reference_force_stance_legs = (self.robot.mass * 9.81) / number_of_legs_in_stance
+
+
+        f_z_FL = reference_force_stance_legs + f_z_FL
+        f_z_FR = reference_force_stance_legs + f_z_FR
+        f_z_RL = reference_force_stance_legs + f_z_RL
+        f_z_RR = reference_force_stance_legs + f_z_RR
+          
+
+        # Foot in swing (contact sequence = 0) have zero force
+        f_x_FL = f_x_FL*contact_sequence[0][n]
+        f_y_FL = f_y_FL*contact_sequence[0][n]
+        f_z_FL = f_z_FL*contact_sequence[0][n]
+        
+        f_x_FR = f_x_FR*contact_sequence[1][n]
+        f_y_FR = f_y_FR*contact_sequence[1][n]
+        f_z_FR = f_z_FR*contact_sequence[1][n]
+
+        f_x_RL = f_x_RL*contact_sequence[2][n]
+        f_y_RL = f_y_RL*contact_sequence[2][n]
+        f_z_RL = f_z_RL*contact_sequence[2][n]
+
+        f_x_RR = f_x_RR*contact_sequence[3][n]
+        f_y_RR = f_y_RR*contact_sequence[3][n]
+        f_z_RR = f_z_RR*contact_sequence[3][n]
+
+
+        # Enforce force constraints
+        f_x_FL, f_y_FL, f_z_FL, \
+        f_x_FR, f_y_FR, f_z_FR, \
+        f_x_RL, f_y_RL, f_z_RL, \
+        f_x_RR, f_y_RR, f_z_RR = self.enforce_force_constraints(f_x_FL, f_y_FL, f_z_FL,
+                                                                f_x_FR, f_y_FR, f_z_FR,
+                                                                f_x_RL, f_y_RL, f_z_RL,
+                                                                f_x_RR, f_y_RR, f_z_RR)
+        
+
+        input = jnp.array([jnp.float32(0), jnp.float32(0), jnp.float32(0),
+                           jnp.float32(0), jnp.float32(0), jnp.float32(0),
+                           jnp.float32(0), jnp.float32(0), jnp.float32(0),
+                           jnp.float32(0), jnp.float32(0), jnp.float32(0),
+                           f_x_FL, f_y_FL, f_z_FL, # foot position fl
+                           f_x_FR, f_y_FR, f_z_FR, # foot position fr
+                           f_x_RL, f_y_RL, f_z_RL, # foot position rl
+                           f_x_RR, f_y_RR, f_z_RR, # foot position rr
+                        ], dtype=dtype_general)
+        
+        return input, reference_force_stance_legs
+    
+
+
+    def compute_predicted_trajectory(self, initial_state, control_parameters, contact_sequence):
+        """
+        Roll out the given parameters (in full precision) and keep the plan along the horizon. 
+
+        Args:
+            initial_state (np.array): actual state of the robot
+            control_parameters (np.array): parameters of the four legs
+            contact_sequence (np.array): contact sequence along the whole horizon
+        Returns:
+            (jnp.array, jnp.array): predicted states of shape (horizon, state_dim), each one after 
+            its step, and GRFs of shape (horizon, 12)
+        """
+
+        force_trajectory = self.compute_force_trajectory(control_parameters)
+
+        def predict_step(state, n):
+            input, _ = self.compute_step_input(force_trajectory[n], contact_sequence, n)
+            current_contact = jnp.array([contact_sequence[0][n], contact_sequence[1][n], 
+                                         contact_sequence[2][n], contact_sequence[3][n]], dtype=dtype_general)
+            state_next = self.robot.integrate_jax(state, input, current_contact, n)
+            return state_next, (state_next, input[12:])
+        
+        _, (predicted_states, predicted_GRFs) = jax.lax.scan(predict_step, initial_state, jnp.arange(self.horizon))
+        return predicted_states, predicted_GRFs
+    
+
+
+    def compute_cost_breakdown(self, initial_state, reference, control_parameters, contact_sequence):
+        """
+        Cost of each term of the registry along the predicted trajectory of the given parameters.
+
+        Args:
+            initial_state (np.array): actual state of the robot
+            reference (np.array): desired state of the robot
+            control_parameters (np.array): parameters of the four legs
+            contact_sequence (np.array): contact sequence along the whole horizon
+        Returns:
+            dict: cost of each term, by name (their sum is the cost of the rollout)
+        """
+
+        predicted_states, predicted_GRFs = self.compute_predicted_trajectory(initial_state, control_parameters, contact_sequence)
+        state_errors = predicted_states - reference[0:self.state_dim]
+
+        # Same input of the cost as in the rollout, f_z is taken with respect to gravity compensation
+        contact_sequence = jnp.asarray(contact_sequence)[:, 0:self.horizon]
+        reference_force_stance_legs = (self.robot.mass * 9.81) / jnp.sum(contact_sequence, axis=0)
+        inputs_for_cost = jnp.concatenate([jnp.zeros((self.horizon, 12), dtype=dtype_general),
+                                           predicted_GRFs.at[:, 2::3].add(-reference_force_stance_legs[:, None])], axis=1)
+
+        return self.cost_registry.compute_cost_breakdown(state_errors, inputs_for_cost)
+    
+
+
     def enforce_force_constraints(self, f_x_FL, f_y_FL, f_z_FL,
                                         f_x_FR, f_y_FR, f_z_FR,
                                         f_x_RL, f_y_RL, f_z_RL,
@@ -515,122 +882,57 @@ class Sampling_MPC:
             (float): cost of the rollout
         """  
 
-        state = initial_state
-        cost = jnp.float32(0.0)
-        n_ = jnp.array([-1,-1,-1,-1])
-
-
-        #FL_num_of_contact = jnp.sum(contact_sequence[0])+1
-        #FR_num_of_contact = jnp.sum(contact_sequence[1])+1
-        #RL_num_of_contact = jnp.sum(contact_sequence[2])+1
-        #RR_num_of_contact = jnp.sum(contact_sequence[3])+1
-
-        FL_num_of_contact = self.horizon
-        FR_num_of_contact = self.horizon
-        RL_num_of_contact = self.horizon
-        RR_num_of_contact = self.horizon
-
-        def iterate_fun(n, carry):
-            cost, state, reference, n_ = carry
-
-
+        cost, _ = self.compute_rollout_segment(initial_state, jnp.float32(0.0), reference, control_parameters, 
+                                               contact_sequence, 0, self.horizon)
+        return cost
+    
 
-            #n_ = n_.at[0].set(n_[0]+1*contact_sequence[0][n])
-            #n_ = n_.at[1].set(n_[1]+1*contact_sequence[1][n])
-            #n_ = n_.at[2].set(n_[2]+1*contact_sequence[2][n])
-            #n_ = n_.at[3].set(n_[3]+1*contact_sequence[3][n])
-            n_ = n_.at[0].set(n)
-            n_ = n_.at[1].set(n)
-            n_ = n_.at[2].set(n)
-            n_ = n_.at[3].set(n)
 
-            
-            f_x_FL, f_y_FL, f_z_FL = self.spline_fun_FL(control_parameters[0:self.num_control_parameters_single_leg], n_[0], FL_num_of_contact)
-            f_x_FR, f_y_FR, f_z_FR = self.spline_fun_FR(control_parameters[self.num_control_parameters_single_leg:self.num_control_parameters_single_leg*2], n_[1], FR_num_of_contact)
-            f_x_RL, f_y_RL, f_z_RL = self.spline_fun_RL(control_parameters[self.num_control_parameters_single_leg*2:self.num_control_parameters_single_leg*3], n_[2], RL_num_of_contact)
-            f_x_RR, f_y_RR, f_z_RR = self.spline_fun_RR(control_parameters[self.num_control_parameters_single_leg*3:self.num_control_parameters_single_leg*4], n_[3], RR_num_of_contact)
-            
+    def compute_rollout_segment(self, initial_state, initial_cost, reference, control_parameters, contact_sequence, 
+                                start, stop):
+        """Integrate the dynamics from step start to step stop (static), accumulating the cost
+        Args:
+            initial_state (np.array): state of the robot at step start
+            initial_cost (float): cost accumulated before step start
+            reference (np.array): desired state of the robot
+            control_parameters (np.array): parameters for the controllers
+            contact_sequence (np.array): contact sequence along the whole horizon
+            start (int): first step of the segment
+            stop (int): step where the segment ends
+        Returns:
+            (float, np.array): accumulated cost and state at step stop
+        """  
 
-            
-            
+        state = initial_state
+        cost = initial_cost
 
-            # The sampling over f_z is a delta over gravity compensation (only for the leg in stance!)
-            number_of_legs_in_stance = contact_sequence[0][n] + contact_sequence[1][n] + contact_sequence[2][n] + contact_sequence[3][n]
-            reference_force_stance_legs = (self.robot.mass * 9.81) / number_of_legs_in_stance
 
+        # The splines are evaluated for the whole horizon before the time loop
+        force_trajectory = self.compute_force_trajectory(control_parameters)
 
-            f_z_FL = reference_force_stance_legs + f_z_FL
-            f_z_FR = reference_force_stance_legs + f_z_FR
-            f_z_RL = reference_force_stance_legs + f_z_RL
-            f_z_RR = reference_force_stance_legs + f_z_RR
-              
 
-            # Foot in swing (contact sequence = 0) have zero force
-            f_x_FL = f_x_FL*contact_sequence[0][n]
-            f_y_FL = f_y_FL*contact_sequence[0][n]
-            f_z_FL = f_z_FL*contact_sequence[0][n]
-            
-            f_x_FR = f_x_FR*contact_sequence[1][n]
-            f_y_FR = f_y_FR*contact_sequence[1][n]
-            f_z_FR = f_z_FR*contact_sequence[1][n]
-
-            f_x_RL = f_x_RL*contact_sequence[2][n]
-            f_y_RL = f_y_RL*contact_sequence[2][n]
-            f_z_RL = f_z_RL*contact_sequence[2][n]
-
-            f_x_RR = f_x_RR*contact_sequence[3][n]
-            f_y_RR = f_y_RR*contact_sequence[3][n]
-            f_z_RR = f_z_RR*contact_sequence[3][n]
-
-
-            # Enforce force constraints
-            f_x_FL, f_y_FL, f_z_FL, \
-            f_x_FR, f_y_FR, f_z_FR, \
-            f_x_RL, f_y_RL, f_z_RL, \
-            f_x_RR, f_y_RR, f_z_RR = self.enforce_force_constraints(f_x_FL, f_y_FL, f_z_FL,
-                                                                    f_x_FR, f_y_FR, f_z_FR,
-                                                                    f_x_RL, f_y_RL, f_z_RL,
-                                                                    f_x_RR, f_y_RR, f_z_RR)
-            
+        def iterate_fun(n, carry, integrator=None):
+            cost, state, reference = carry
 
 
-                                        
-            input = jnp.array([jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                               jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                               jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                               jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                               f_x_FL, f_y_FL, f_z_FL, # foot position fl
-                               f_x_FR, f_y_FR, f_z_FR, # foot position fr
-                               f_x_RL, f_y_RL, f_z_RL, # foot position rl
-                               f_x_RR, f_y_RR, f_z_RR, # foot position rr
-                            ], dtype=dtype_general)
+            # Gravity compensation, swing legs and force constraints
+            input, reference_force_stance_legs = self.compute_step_input(force_trajectory[n], contact_sequence, n)
             
             
             # Integrate the dynamics
             current_contact = jnp.array([contact_sequence[0][n], contact_sequence[1][n], 
                                          contact_sequence[2][n], contact_sequence[3][n]], dtype=dtype_general)
-            state_next = self.robot.integrate_jax(state, input, current_contact, n)
+            state_next = self.robot.integrate_jax(state, input, current_contact, n, self.rollout_compute_dtype, integrator)
             
             
             # Compute the cost
                     
             # Calculate cost regulation state
             state_error = state_next - reference[0:self.state_dim]
-            error_cost = state_error.T@self.Q@state_error
-
-            input_for_cost = jnp.array([jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                f_x_FL, f_y_FL, f_z_FL - reference_force_stance_legs, 
-                f_x_FR, f_y_FR, f_z_FR - reference_force_stance_legs, 
-                f_x_RL, f_y_RL, f_z_RL - reference_force_stance_legs, 
-                f_x_RR, f_y_RR, f_z_RR - reference_force_stance_legs, 
-                ], dtype=dtype_general)
+            input_for_cost = input.at[14::3].add(-reference_force_stance_legs)
 
-
-            # Calculate cost regulation input
-            #error_cost += input_for_cost.T@self.R@input_for_cost
+            # All the terms of the registry (state regulation, input regulation, ...) in one expression
+            error_cost = self.cost_registry.compute_stage_cost(state_error, input_for_cost)
            
                            
            
@@ -642,14 +944,90 @@ class Sampling_MPC:
 
             
 
-            return (cost + error_cost, state_next, reference, n_)
+            return (cost + error_cost, state_next, reference)
 
-        carry = (cost, state, reference, n_)
-        cost, state, reference, n_ = jax.lax.fori_loop(0, self.horizon, iterate_fun, carry)
+        carry = (cost, state, reference)
+        # One loop per stage of the discretization, each with its own integrator
+        for stage_start, stage_stop, integrator in self.robot.get_integration_stages(start, stop):
+            carry = jax.lax.fori_loop(stage_start, stage_stop, functools.partial(iterate_fun, integrator=integrator), carry)
+        cost, state, reference = carry
         
-        return cost
+        return cost, state
+    
 
 
+    def compute_pruned_rollout(self, initial_state, reference, control_parameters_vec, contact_sequence):
+        """Successive-halving rollout: all the samples are integrated up to the first pruning step, then 
+        only the best fraction by partial cost continues to the next one, and so on until the end of 
+        the horizon. The state and the cost of the survivors are carried from one stage to the next.
+        Returns:
+            (np.array, np.array): final costs of the survivors and their indices in control_parameters_vec
+        """  
+
+        vectorized_segment = jax.vmap(self.compute_rollout_segment, in_axes=(0, 0, None, 0, None, None, None))
+
+        states = jnp.tile(initial_state, (self.num_parallel_computations, 1))
+        costs = jnp.zeros((self.num_parallel_computations,), dtype=dtype_general)
+        indices = jnp.arange(self.num_parallel_computations)
+
+        stage_limits = list(self.pruning_steps) + [self.horizon]
+        start = 0
+        for stage, stop in enumerate(stage_limits):
+            if(stage > 0):
+                # Keep the best fraction of the samples (NaN and inf are pruned first)
+                num_survivors = max(1, int(costs.shape[0] * self.pruning_keep_fraction))
+                partial_costs = jnp.where(jnp.isfinite(costs), costs, jnp.inf)
+                _, survivors = jax.lax.top_k(-partial_costs, num_survivors)
+                states, costs, indices = states[survivors], costs[survivors], indices[survivors]
+
+            costs, states = vectorized_segment(states, costs, reference, control_parameters_vec[indices], 
+                                               contact_sequence, start, stop)
+            start = stop
+
+        return costs, indices
+
+
+
+
+    def compute_gradient_refinement(self, state, reference, contact_sequence, candidates, sigma):
+        """
+        Projected gradient descent on the rollout cost, run from each candidate (vmapped). The step has 
+        a fixed length along the normalized gradient, it is taken only if it lowers the cost and then grows, 
+        otherwise it shrinks. Each candidate is projected on a box of 3 sigma around its starting point, 
+        so the parameters without noise do not move.
+
+        Returns:
+            the best refined parameters and their cost
+        """
+
+        cost_and_gradient = jax.value_and_grad(lambda parameters: self.compute_rollout(state, reference, parameters, contact_sequence))
+
+        def refine_candidate(parameters):
+            lower_bound = parameters - 3.*sigma
+            upper_bound = parameters + 3.*sigma
+            cost, gradient = cost_and_gradient(parameters)
+
+            def gradient_step(_, carry):
+                parameters, cost, gradient, step_size = carry
+                direction = gradient / (jnp.linalg.norm(gradient) + 1e-6)
+                candidate = jnp.clip(parameters - step_size*direction, lower_bound, upper_bound)
+                candidate_cost, candidate_gradient = cost_and_gradient(candidate)
+
+                improved = candidate_cost < cost
+                parameters = jnp.where(improved, candidate, parameters)
+                cost = jnp.where(improved, candidate_cost, cost)
+                gradient = jnp.where(improved, candidate_gradient, gradient)
+                step_size = jnp.where(improved, step_size*1.5, step_size*0.5)
+                return parameters, cost, gradient, step_size
+            
+            carry = (parameters, cost, gradient, jnp.float32(self.gradient_refinement_step_size))
+            parameters, cost, _, _ = jax.lax.fori_loop(0, self.gradient_refinement_steps, gradient_step, carry)
+            return parameters, jnp.where(jnp.isfinite(cost), cost, 1000000)
+
+        refined_parameters, refined_costs = jax.vmap(refine_candidate)(candidates)
+        best_index = jnp.argmin(refined_costs)
+        return refined_parameters[best_index], refined_costs[best_index]
+    
 
 
     def with_newkey(self):
@@ -670,57 +1048,31 @@ class Sampling_MPC:
 
 
     
-    def shift_solution(self, best_control_parameters, step):
+    def shift_solution(self, best_control_parameters, advance=None):
         """
-        This function shift the control parameter ahed
+        This function shift the control parameter ahead, for any parametrization (see compute_shift_matrix).
+        The advance is in steps of the horizon, by default one mpc period.
         """ 
 
-
-        best_control_parameters = np.array(best_control_parameters)
-        FL_control = copy.deepcopy(best_control_parameters[0:self.num_control_parameters_single_leg])
-        FR_control = copy.deepcopy(best_control_parameters[self.num_control_parameters_single_leg:self.num_control_parameters_single_leg*2])
-        RL_control = copy.deepcopy(best_control_parameters[self.num_control_parameters_single_leg*2:self.num_control_parameters_single_leg*3])
-        RR_control = copy.deepcopy(best_control_parameters[self.num_control_parameters_single_leg*3:self.num_control_parameters_single_leg*4])
-        
-
-        FL_control_temp = copy.deepcopy(FL_control)
-        FL_control[0], FL_control[2], FL_control[4] = self.spline_fun_FL(FL_control_temp, step)
-        #FL_control[1], FL_control[3], FL_control[5] = controller.spline_fun_FL(FL_control_temp, controller.horizon+step)
-
-        FR_control_temp = copy.deepcopy(FR_control)
-        FR_control[0], FR_control[2], FR_control[4] = self.spline_fun_FR(FR_control_temp, step)
-        #FR_control[1], FR_control[3], FR_control[5] = controller.spline_fun_FR(FR_control_temp, controller.horizon+step)
-        
-        
-        RL_control_temp = copy.deepcopy(RL_control)
-        RL_control[0], RL_control[2], RL_control[4] = self.spline_fun_RL(RL_control_temp, step)
-        #RL_control[1], RL_control[3], RL_control[5] = controller.spline_fun_RL(RL_control_temp, controller.horizon+step)
-        
-        
-        RR_control_temp = copy.deepcopy(RR_control)
-        RR_control[0], RR_control[2], RR_control[4] = self.spline_fun_RR(RR_control_temp, step)
-        #RR_control[1], RR_control[3], RR_control[5] = controller.spline_fun_RR(RR_control_temp, controller.horizon+step)
-
-        
-        best_control_parameters[0:self.num_control_parameters_single_leg] = FL_control
-        best_control_parameters[self.num_control_parameters_single_leg:self.num_control_parameters_single_leg*2] = FR_control
-        best_control_parameters[self.num_control_parameters_single_leg*2:self.num_control_parameters_single_leg*3] = RL_control
-        best_control_parameters[self.num_control_parameters_single_leg*3:self.num_control_parameters_single_leg*4] = RR_control
+        if(advance is None):
+            shift_matrix = self.tick_shift_matrix
+        else:
+            shift_matrix = self.compute_shift_matrix(advance)
         
-        return best_control_parameters
+        return self.shift_control_parameters(jnp.asarray(best_control_parameters, dtype=dtype_general), shift_matrix)
 
 
 
     def prepare_state_and_reference(self, state_current, reference_state, 
-                                    current_contact, previous_contact, mpc_frequency=100):
+                                    current_contact, previous_contact, mpc_frequency=None):
         """
         This function jaxify the current state and reference for further processing.
         """    
 
-        # Shift the previous solution ahead
+        # Shift the previous solution ahead (by default of the mpc period of the config)
         if (config.mpc_params['shift_solution']):
-            index_shift = 1./mpc_frequency
-            self.best_control_parameters = self.shift_solution(self.best_control_parameters, index_shift)
+            advance = None if mpc_frequency is None else 1./(mpc_frequency*self.dt)
+            self.best_control_parameters = self.shift_solution(self.best_control_parameters, advance)
          
 
 
@@ -760,6 +1112,505 @@ class Sampling_MPC:
     
 
 
+    def pack_state_and_reference(self, state_current, reference_state, current_contact):
+        """
+        Jax counterpart of prepare_state_and_reference, it can be traced inside the fused control tick.
+        The feet in swing are substituted with their reference touchdown position.
+        """
+
+        feet = jnp.concatenate((state_current["foot_FL"], state_current["foot_FR"],
+                                state_current["foot_RL"], state_current["foot_RR"])).reshape((12, ))
+        reference_feet = jnp.concatenate((reference_state["ref_foot_FL"].reshape((3,)), reference_state["ref_foot_FR"].reshape((3,)),
+                                          reference_state["ref_foot_RL"].reshape((3,)), reference_state["ref_foot_RR"].reshape((3,))))
+        feet = jnp.where(jnp.repeat(current_contact == 0., 3), reference_feet, feet)
+
+        state_current_jax = jnp.concatenate((state_current["position"], state_current["linear_velocity"],
+                                             state_current["orientation"], state_current["angular_velocity"],
+                                             feet)).reshape((24, )).astype(dtype_general)
+
+        reference_state_jax = jnp.concatenate((reference_state["ref_position"], reference_state["ref_linear_velocity"],
+                                               reference_state["ref_orientation"], reference_state["ref_angular_velocity"],
+                                               reference_feet)).reshape((24, )).astype(dtype_general)
+
+        return state_current_jax, reference_state_jax
+    
+
+
+    def mask_lift_off_legs(self, best_control_parameters, current_contact, previous_contact):
+        """
+        Reset the parameters of the legs that just lifted off, as done in prepare_state_and_reference.
+        """
+
+        lift_off = jnp.logical_and(previous_contact == 1, current_contact == 0)
+        return jnp.where(jnp.repeat(lift_off, self.num_control_parameters_single_leg), 0.0, best_control_parameters)
+    
+
+
+    def get_initial_solver_state(self):
+        """
+        Solver state that is kept on the device between two control ticks.
+        """
+
+        if(self.sampling_method == 'cem_mppi'):
+            sigma = self.sigma_cem_mppi
+        elif(self.sampling_method == 'mppi'):
+            sigma = jnp.ones(self.num_control_parameters, dtype=dtype_general) * self.sigma_mppi
+        else:
+            sigma = jnp.array(self.sigma_random_sampling, dtype=dtype_general)
+
+        solver_state = {'best_control_parameters': jnp.zeros((self.num_control_parameters,), dtype=dtype_general),
+                        'sigma': jnp.array(sigma, dtype=dtype_general),
+                        'key': jax.random.PRNGKey(42)}
+        
+        if(self.num_recycled_samples > 0):
+            # Best samples of the last tick
+            solver_state['recycled_parameters'] = jnp.zeros((self.num_recycled_samples, self.num_control_parameters), dtype=dtype_general)
+
+        return solver_state
+    
+
+
+    def compute_control_fused(self, solver_state, state_current, reference_state, current_contact, previous_contact, 
+                              contact_sequence, timing, nominal_step_frequency, optimize_swing):
+        """
+        A whole control tick in a single function: state packing, shift of the warm start, masking of 
+        the legs at lift-off, sampling, rollout and update for all the sampling iterations. It is jitted with the solver 
+        state donated, so the solution mean, sigma and PRNG key never leave the device.
+        """
+
+        state, reference = self.pack_state_and_reference(state_current, reference_state, current_contact)
+        best_control_parameters = solver_state['best_control_parameters']
+        if(config.mpc_params['shift_solution']):
+            best_control_parameters = self.shift_control_parameters(best_control_parameters, self.tick_shift_matrix)
+        best_control_parameters = self.mask_lift_off_legs(best_control_parameters, current_contact, previous_contact)
+        key = solver_state['key']
+        sigma = solver_state['sigma']
+
+        recycled_samples = None
+        if(self.num_recycled_samples > 0):
+            # The samples of the last tick are moved to the new phase
+            recycled_samples = self.shift_control_parameters(solver_state['recycled_parameters'], self.tick_shift_matrix)
+            recycled_samples = jax.vmap(self.mask_lift_off_legs, in_axes=(0, None, None))(recycled_samples, current_contact, previous_contact)
+
+        outputs = self.compute_control_iterations(state, reference, contact_sequence, best_control_parameters, key, sigma,
+                                                  timing, nominal_step_frequency, optimize_swing, recycled_samples)
+        nmpc_GRFs, \
+        nmpc_footholds, \
+        nmpc_predicted_state, \
+        new_best_control_parameters, \
+        best_cost, \
+        best_freq, \
+        costs, \
+        sigma = outputs[:8]
+
+        solver_state = {'best_control_parameters': new_best_control_parameters,
+                        'sigma': sigma,
+                        'key': outputs[-1]}
+        
+        if(self.num_recycled_samples > 0):
+            # The best samples of the last iteration
+            solver_state['recycled_parameters'] = outputs[8]
+        
+        return nmpc_GRFs, nmpc_footholds, nmpc_predicted_state, best_cost, best_freq, costs, outputs[-2], solver_state
+    
+
+
+    def compute_sampling_iteration(self, state, reference, contact_sequence, best_control_parameters, key, sigma,
+                                   timing, nominal_step_frequency, optimize_swing, recycled_samples=None):
+        """
+        A single sampling iteration with the same outputs for all the sampling methods. Sigma is 
+        updated only by CEM-MPPI, the other methods return it unchanged. With recycled samples 
+        (MPPI only), the best samples of the iteration follow it. The last
+        output is the plan of the solution along the horizon (see compute_predicted_trajectory).
+        """
+
+        if(self.sampling_method == 'cem_mppi'):
+            return self.compute_control(state, reference, contact_sequence, best_control_parameters, key, sigma)
+        
+        if(recycled_samples is not None):
+            outputs = self.compute_control_mppi(state, reference, contact_sequence, best_control_parameters, key,
+                                                timing, nominal_step_frequency, optimize_swing, recycled_samples)
+        else:
+            outputs = self.compute_control(state, reference, contact_sequence, best_control_parameters, key,
+                                           timing, nominal_step_frequency, optimize_swing)
+        return (*outputs[:7], sigma, *outputs[7:])
+    
+
+
+    def compute_control_iterations(self, state, reference, contact_sequence, best_control_parameters, key, sigma,
+                                   timing, nominal_step_frequency, optimize_swing, recycled_samples=None):
+        """
+        Run all the num_sampling_iterations inside a single lax.scan, carrying the solution mean, 
+        sigma and PRNG key. Only the last iteration produces the control outputs. The recycled 
+        samples, if any, are injected in every iteration.
+
+        Returns:
+            the outputs of compute_sampling_iteration of the last iteration (whose last one is the plan 
+            of the solution along the horizon), followed by the updated key
+        """
+
+        if(self.sampling_method == 'cem_mppi'):
+            sigma = self.compute_cem_cholesky_factors(sigma)
+
+        def refinement_iteration(carry, _):
+            best_control_parameters, sigma, key = carry
+            key, subkey = jax.random.split(key)
+            outputs = self.compute_sampling_iteration(state, reference, contact_sequence, best_control_parameters, subkey, sigma,
+                                                      timing, nominal_step_frequency, optimize_swing, recycled_samples)
+            return (outputs[3], outputs[7], key), None
+
+        carry = (best_control_parameters, sigma, key)
+        carry, _ = jax.lax.scan(refinement_iteration, carry, None, length=self.num_sampling_iterations - 1)
+        best_control_parameters, sigma, key = carry
+
+        key, subkey = jax.random.split(key)
+        outputs = self.compute_sampling_iteration(state, reference, contact_sequence, best_control_parameters, subkey, sigma,
+                                                  timing, nominal_step_frequency, optimize_swing, recycled_samples)
+        
+        return (*outputs, key)
+    
+
+
+    def compute_control_batch(self, states, references, contact_sequences, best_control_parameters, keys, sigma,
+                              timings, nominal_step_frequencies, optimize_swing):
+        """
+        compute_control_iterations for a batch of robots. Every argument but sigma and optimize_swing has 
+        a leading robot axis (states and references are packed as in prepare_state_and_reference, and each 
+        robot has its own key, e.g. from jax.random.split).
+
+        Returns:
+            the outputs of compute_control_iterations, each with a leading robot axis
+        """
+
+        batched_iterations = jax.vmap(self.compute_control_iterations, in_axes=(0, 0, 0, 0, 0, None, 0, 0, None))
+        return batched_iterations(states, references, contact_sequences, best_control_parameters, keys, sigma,
+                                  timings, nominal_step_frequencies, optimize_swing)
+    
+
+
+    def compute_control_tick(self, state_current, reference_state, current_contact, previous_contact, 
+                             contact_sequence, timing, nominal_step_frequency, optimize_swing):
+        """
+        Host side of the fused control tick. Only the entries needed by the controller are sent 
+        to the device, and the returned solver state replaces the donated one. The plan of the 
+        solution is kept in predicted_trajectory.
+        """
+
+        state_current = {key: state_current[key] for key in self.state_keys}
+        reference_state = {key: reference_state[key] for key in self.reference_keys}
+        # Fixed dtypes, otherwise the fused tick is traced again when the caller changes them
+        current_contact = np.asarray(current_contact, dtype=dtype_general)
+        previous_contact = np.asarray(previous_contact, dtype=dtype_general)
+
+        nmpc_GRFs, \
+        nmpc_footholds, \
+        nmpc_predicted_state, \
+        best_cost, \
+        best_freq, \
+        costs, \
+        self.predicted_trajectory, \
+        self.solver_state = self.jitted_compute_control_fused(self.solver_state, state_current, reference_state,
+                                                              current_contact, previous_contact, contact_sequence,
+                                                              timing, nominal_step_frequency, optimize_swing)
+        self.best_control_parameters = self.solver_state['best_control_parameters']
+
+        return nmpc_GRFs, nmpc_footholds, nmpc_predicted_state, best_cost, best_freq, costs
+    
+
+
+    def build_sample_tiers(self, sample_tiers, device):
+        """
+        Build a controller for each number of samples in sample_tiers, and dispatch the tick entry point 
+        through compute_control_anytime. The entry points are stateless, so all the tiers share the warm 
+        start, key and solver state. All the tiers are compiled ahead of time and run once to warm up 
+        and once to measure their latency, so no tier compiles, nor is selected blindly, in the control loop.
+        """
+
+        entry_point_name, example_arguments = self.get_entry_point_example_arguments()
+        entry_point = getattr(self, entry_point_name)
+        if(not isinstance(entry_point, AOTCompiledFunction)):
+            entry_point = AOTCompiledFunction(entry_point, *example_arguments)
+        self.sample_tier_entry_points = {self.num_parallel_computations: entry_point}
+
+        for num_samples in sample_tiers:
+            if(num_samples not in self.sample_tier_entry_points):
+                tier_controller = Sampling_MPC(num_parallel_computations=num_samples, device=device,
+                                               use_aot_compilation=True, anytime_sample_tiers=[])
+                self.sample_tier_entry_points[num_samples] = getattr(tier_controller, entry_point_name)
+
+        self.sample_tier_latency = {}
+        for num_samples, entry_point in self.sample_tier_entry_points.items():
+            # The fused tick donates its solver state, hence new arguments at every call
+            jax.block_until_ready(entry_point(*self.get_entry_point_example_arguments()[1]))
+            example_arguments = self.get_entry_point_example_arguments()[1]
+            start_time = time.perf_counter()
+            jax.block_until_ready(entry_point(*example_arguments))
+            self.sample_tier_latency[num_samples] = time.perf_counter() - start_time
+
+        setattr(self, entry_point_name, self.compute_control_anytime)
+    
+
+
+    def select_sample_tier(self):
+        """
+        Largest number of samples whose expected latency fits the deadline, if nothing fits the smallest 
+        tier is used.
+        """
+
+        tiers = sorted(self.sample_tier_latency.keys())
+        selected = tiers[0]
+        for num_samples in tiers:
+            if(self.sample_tier_latency[num_samples] <= self.anytime_deadline):
+                selected = num_samples
+        return selected
+    
+
+
+    def compute_control_anytime(self, *args):
+        """
+        Run the tick entry point of the selected tier and measure its latency. The estimate of that tier 
+        is an exponential moving average, and the ones of the other tiers are scaled by the same factor, 
+        so that a change of the host load moves all of them.
+        """
+
+        num_samples = self.select_sample_tier()
+
+        start_time = time.perf_counter()
+        outputs = jax.block_until_ready(self.sample_tier_entry_points[num_samples](*args))
+        latency = time.perf_counter() - start_time
+
+        previous_latency = self.sample_tier_latency[num_samples]
+        self.sample_tier_latency[num_samples] = 0.8*previous_latency + 0.2*latency
+        load_factor = self.sample_tier_latency[num_samples] / previous_latency
+        for other_samples in self.sample_tier_latency:
+            if(other_samples != num_samples):
+                self.sample_tier_latency[other_samples] *= load_factor
+
+        self.anytime_metrics = {'num_samples': num_samples,
+                                'latency': latency,
+                                'deadline_met': latency <= self.anytime_deadline}
+        return outputs
+    
+
+
+    def compile_entry_points(self):
+        """
+        Lower and compile the entry point used by the controller interface, with arguments of the
+        same types the interface passes at runtime. The jitted function is replaced by its compiled 
+        executable, which falls back to the jitted one (with a warning) for other argument types.
+        """
+
+        entry_point_name, example_arguments = self.get_entry_point_example_arguments()
+        setattr(self, entry_point_name, AOTCompiledFunction(getattr(self, entry_point_name), *example_arguments))
+    
+
+
+    def get_entry_point_example_arguments(self):
+        """
+        Name of the entry point the controller interface calls at every tick, and arguments of the same 
+        types it passes at runtime. The solver state is a new one, as the fused tick donates it.
+        """
+
+        contact_sequence = np.ones((4, self.horizon))
+        timing = np.zeros(4)
+        nominal_step_frequency = config.simulation_params['gait_params'][config.simulation_params['gait']]['step_freq']
+        optimize_swing = 0
+
+        if(self.use_fused_control_tick):
+            state_current = {key: np.zeros(3) for key in self.state_keys}
+            reference_state = {key: np.zeros((1, 3)) if "foot" in key else np.zeros(3) for key in self.reference_keys}
+            contact = np.ones(4, dtype=dtype_general)
+            solver_state = jax.device_put(self.get_initial_solver_state(), self.data_placement)
+            return 'jitted_compute_control_fused', (solver_state, state_current, reference_state, contact, contact,
+                                                    contact_sequence, timing, nominal_step_frequency, optimize_swing)
+        else:
+            state = np.zeros(self.state_dim)
+            reference = np.zeros(self.reference_dim)
+            best_control_parameters = np.zeros(self.num_control_parameters, dtype=dtype_general)
+            # CEM-MPPI carries its covariance factors from one tick to the next, the other methods do not use sigma
+            sigma = self.sigma_cem_mppi if self.sampling_method == 'cem_mppi' else None
+            return 'jitted_compute_control_iterations', (state, reference, contact_sequence, best_control_parameters,
+                                                         self.master_key, sigma, timing, nominal_step_frequency, optimize_swing)
+    
+
+
+    def compute_qmc_points(self, num_samples):
+        """
+        Scrambled low-discrepancy point set in the unit hypercube, computed once. Sobol points are 
+        kept as 32 bit integers, so that every tick can apply a digital shift.
+
+        Returns:
+            (jnp.array): points of shape (num_samples, num_control_parameters)
+        """
+
+        if(self.noise_engine == 'sobol'):
+            sampler = qmc.Sobol(d=self.num_control_parameters, scramble=True, bits=32, seed=42)
+            # The balance properties hold for powers of 2, the extra points are dropped
+            points = sampler.random_base2(int(np.ceil(np.log2(max(num_samples, 1)))))[:num_samples]
+            return jnp.array(np.floor(points * 2**32).astype(np.uint32))
+        
+        sampler = qmc.Halton(d=self.num_control_parameters, scramble=True, seed=42)
+        return jnp.array(sampler.random(num_samples), dtype=dtype_general)
+    
+
+
+    def sample_standard_normal(self, key, num_samples):
+        """
+        Standard normal samples of shape (num_samples, num_control_parameters), from the selected 
+        noise engine. The low-discrepancy points are randomized at every tick (random digital shift 
+        for Sobol, random shift modulo 1 for Halton) and mapped through the inverse normal CDF.
+        """
+
+        if(self.noise_engine == 'gaussian'):
+            return jax.random.normal(key=key, shape=(num_samples, self.num_control_parameters), dtype=dtype_general)
+        
+        return self.transform_qmc_points(key, self.qmc_points[:num_samples])
+    
+
+
+    def transform_qmc_points(self, key, points):
+        """
+        Randomize some low-discrepancy points with the shift drawn from key and map them to standard 
+        normal samples (see sample_standard_normal).
+        """
+
+        if(self.noise_engine == 'sobol'):
+            shift = jax.random.bits(key, (self.num_control_parameters, ), dtype=jnp.uint32)
+            # Only 24 bits are exact in float32, this also keeps the samples away from 0 and 1
+            shifted_points = jnp.right_shift(jnp.bitwise_xor(points, shift), 8)
+            uniform = (shifted_points.astype(dtype_general) + 0.5) / 2**24
+        else:
+            shift = jax.random.uniform(key, (self.num_control_parameters, ), dtype=dtype_general)
+            uniform = jnp.clip(jnp.mod(points + shift, 1.0), 0.5 / 2**24, 1.0 - 0.5 / 2**24)
+
+        return jax.scipy.special.ndtri(uniform)
+    
+
+
+    def sample_gaussian_noise(self, key, sigma):
+        """
+        Gaussian perturbations of the previous solution. The first control parameters is the 
+        old best one, so we add zero noise there.
+        """
+
+        noise = self.sample_standard_normal(key, self.num_parallel_computations - 1)*sigma
+        return jnp.concatenate([jnp.zeros((1, self.num_control_parameters), dtype=dtype_general), noise])
+    
+
+
+
+    def sample_gaussian_noise_chunk(self, key, chunk_index, sigma):
+        """
+        Gaussian perturbations of a single chunk of samples. The i.i.d. noise has a key per chunk, the 
+        low-discrepancy noise takes the points of the chunk (offset by chunk_index) with the shift of the 
+        tick, so the chunks together give the samples of sample_gaussian_noise. As there, the first 
+        sample of the first chunk is the old best one.
+        """
+
+        if(self.noise_engine == 'gaussian'):
+            noise = jax.random.normal(key=jax.random.fold_in(key, chunk_index), shape=(self.rollout_chunk_size, self.num_control_parameters), dtype=dtype_general)
+        else:
+            # The first point is a placeholder for the old best one
+            points = jnp.concatenate([self.qmc_points[:1], self.qmc_points])
+            points = jax.lax.dynamic_slice_in_dim(points, chunk_index*self.rollout_chunk_size, self.rollout_chunk_size)
+            noise = self.transform_qmc_points(key, points)
+
+        noise = noise*sigma
+        return noise.at[0].set(jnp.where(chunk_index == 0, 0., noise[0]))
+    
+
+
+    def compute_mppi_update_chunked(self, state, reference, contact_sequence, best_control_parameters, key, sigma):
+        """
+        MPPI update with the samples evaluated chunk by chunk in a lax.scan, so only one chunk of
+        parameters is alive at a time. The weights are reduced with an online log-sum-exp: the running
+        sums are rescaled every time a chunk finds a lower cost.
+
+        Returns:
+            the updated control parameters, the best cost and the costs of all the samples
+        """
+
+        num_chunks = self.num_parallel_computations // self.rollout_chunk_size
+        temperature = 1.
+
+        def evaluate_chunk(carry, chunk_index):
+            min_cost, sum_exp_costs, weighted_noise = carry
+
+            noise = self.sample_gaussian_noise_chunk(key, chunk_index, sigma)
+            costs = self.jit_vectorized_rollout(state, reference, best_control_parameters + noise, contact_sequence)
+
+            # Saturate the cost in case of NaN or inf
+            costs = jnp.where(jnp.isnan(costs), 1000000, costs)
+            costs = jnp.where(jnp.isinf(costs), 1000000, costs)
+
+            new_min_cost = jnp.minimum(min_cost, jnp.min(costs))
+            rescale = jnp.exp((-1./temperature) * (min_cost - new_min_cost))
+            exp_costs = jnp.exp((-1./temperature) * (costs - new_min_cost))
+
+            sum_exp_costs = sum_exp_costs*rescale + jnp.sum(exp_costs)
+            weighted_noise = weighted_noise*rescale + jnp.dot(exp_costs, noise)
+
+            return (new_min_cost, sum_exp_costs, weighted_noise), costs
+
+        carry = (jnp.array(jnp.inf, dtype=dtype_general), jnp.array(0., dtype=dtype_general),
+                 jnp.zeros((self.num_control_parameters,), dtype=dtype_general))
+        carry, costs = jax.lax.scan(evaluate_chunk, carry, jnp.arange(num_chunks))
+        best_cost, sum_exp_costs, weighted_noise = carry
+
+        best_control_parameters = best_control_parameters + weighted_noise/sum_exp_costs
+
+        return best_control_parameters, best_cost, costs.reshape((self.num_parallel_computations, ))
+    
+
+
+    def compute_mppi_update_sharded(self, state, reference, contact_sequence, best_control_parameters, key, sigma):
+        """
+        MPPI update with the samples split over the devices of the sampling mesh. Each device does 
+        the rollouts of its own samples, and the weighted reduction is done with collectives (global 
+        minimum cost, then sums of the weights and of the weighted noise), as in compute_control_mppi.
+
+        Returns:
+            the updated control parameters, the best cost and the costs of all the samples
+        """
+
+        # Same samples as the single device version
+        additional_random_parameters = self.sample_gaussian_noise(key, sigma)
+        temperature = 1.
+
+        def local_update(noise):
+            costs = self.vectorized_rollout(state, reference, best_control_parameters + noise, contact_sequence)
+
+            # Saturate the cost in case of NaN or inf
+            costs = jnp.where(jnp.isnan(costs), 1000000, costs)
+            costs = jnp.where(jnp.isinf(costs), 1000000, costs)
+
+            best_cost = jax.lax.pmin(jnp.min(costs), 'samples')
+            exp_costs = jnp.exp((-1./temperature) * (costs - best_cost))
+            denom = jax.lax.psum(jnp.sum(exp_costs), 'samples')
+            weighted_noise = jax.lax.psum(jnp.dot(exp_costs, noise), 'samples')
+
+            return best_control_parameters + weighted_noise/denom, best_cost, costs
+
+        # The rollout loop carries replicated and per-device values together, hence check_vma is off
+        sharded_update = jax.shard_map(local_update, mesh=self.sampling_mesh, in_specs=PartitionSpec('samples'),
+                                       out_specs=(PartitionSpec(), PartitionSpec(), PartitionSpec('samples')),
+                                       check_vma=False)
+        
+        return sharded_update(additional_random_parameters)
+    
+
+
+    def inject_recycled_samples(self, additional_random_parameters, best_control_parameters, sigma, recycled_parameters):
+        """
+        Replace the last fresh samples with the recycled ones, expressed as noise around the current 
+        mean. The parameters that are not sampled (zero sigma) are kept at the current mean.
+        """
+
+        recycled_noise = (recycled_parameters - best_control_parameters) * (jnp.broadcast_to(sigma, best_control_parameters.shape) > 0)
+        return jnp.concatenate([additional_random_parameters[:self.num_parallel_computations - self.num_recycled_samples], 
+                                recycled_noise.astype(dtype_general)])
+    
+
 
     def compute_control_random_sampling(self, state, reference, contact_sequence, best_control_parameters, key, timing, nominal_step_frequency, optimize_swing):
         """
@@ -771,25 +1622,24 @@ class Sampling_MPC:
         # Generate random parameters
         
         # The first control parameters is the old best one, so we add zero noise there
-        additional_random_parameters = self.initial_random_parameters*0.0
-
+        num_sample_gaussian_1 = (1 + int(self.num_parallel_computations/3)) - 1
+        num_sample_gaussian_2 = (1 + int(self.num_parallel_computations/3)*2) - (1 + int(self.num_parallel_computations/3))
+        num_samples_uniform = int(self.num_parallel_computations) - (1 + int(self.num_parallel_computations/3)*2)
 
         # FIRST GAUSSIAN
-        num_sample_gaussian_1 = (1 + int(self.num_parallel_computations/3)) - 1
         sigma_gaussian_1 = self.sigma_random_sampling[0]
-        additional_random_parameters = additional_random_parameters.at[1:1 + int(self.num_parallel_computations/3)].set(sigma_gaussian_1*jax.random.normal(key=key, shape=(num_sample_gaussian_1, self.num_control_parameters)))
-        
+        gaussian_1 = sigma_gaussian_1*self.sample_standard_normal(key, num_sample_gaussian_1)
 
         # SECOND GAUSSIAN
-        num_sample_gaussian_2 = (1 + int(self.num_parallel_computations/3)*2) - (1 + int(self.num_parallel_computations/3))
         sigma_gaussian_2 = self.sigma_random_sampling[1]
-        additional_random_parameters = additional_random_parameters.at[1 + int(self.num_parallel_computations/3):1 + int(self.num_parallel_computations/3)*2].set(sigma_gaussian_2*jax.random.normal(key=key, shape=(num_sample_gaussian_2, self.num_control_parameters)))
-     
+        gaussian_2 = sigma_gaussian_2*self.sample_standard_normal(key, num_sample_gaussian_2)
 
         # UNIFORM
         max_sampling_forces = self.sigma_random_sampling[2]
-        num_samples_uniform = int(self.num_parallel_computations) - (1 + int(self.num_parallel_computations/3)*2)
-        additional_random_parameters = additional_random_parameters.at[1 + int(self.num_parallel_computations/3)*2:int(self.num_parallel_computations)].set(jax.random.uniform(key=key, minval=-max_sampling_forces, maxval=max_sampling_forces, shape=(num_samples_uniform, self.num_control_parameters )))
+        uniform = jax.random.uniform(key=key, minval=-max_sampling_forces, maxval=max_sampling_forces, shape=(num_samples_uniform, self.num_control_parameters), dtype=dtype_general)
+
+        additional_random_parameters = jnp.concatenate([jnp.zeros((1, self.num_control_parameters), dtype=dtype_general),
+                                                        gaussian_1, gaussian_2, uniform])
 
 
         # Add sampling to the best old control parameters
@@ -812,233 +1662,295 @@ class Sampling_MPC:
         best_control_parameters = control_parameters_vec[best_index]
 
 
-        # and redistribute it to each leg
-        best_control_parameters_FL = best_control_parameters[0:self.num_control_parameters_single_leg]
-        best_control_parameters_FR = best_control_parameters[self.num_control_parameters_single_leg:self.num_control_parameters_single_leg*2]
-        best_control_parameters_RL = best_control_parameters[self.num_control_parameters_single_leg*2:self.num_control_parameters_single_leg*3]
-        best_control_parameters_RR = best_control_parameters[self.num_control_parameters_single_leg*3:self.num_control_parameters_single_leg*4]
-
+        # Plan of the best parameters along the horizon, its first step gives the GRF and the predicted state
+        predicted_states, predicted_GRFs = self.compute_predicted_trajectory(state, best_control_parameters, contact_sequence)
+        nmpc_GRFs = predicted_GRFs[0]
+        nmpc_footholds = jnp.array([0, 0, 0,
+                                    0, 0, 0,
+                                    0, 0, 0,
+                                    0, 0, 0])
+        nmpc_predicted_state = predicted_states[0]
+        
 
-        # Compute the GRF associated to the best parameter
-        fx_FL, fy_FL, fz_FL = self.spline_fun_FL(best_control_parameters_FL, 0.0, 1)
-        fx_FR, fy_FR, fz_FR = self.spline_fun_FR(best_control_parameters_FR, 0.0, 1)
-        fx_RL, fy_RL, fz_RL = self.spline_fun_RL(best_control_parameters_RL, 0.0, 1)
-        fx_RR, fy_RR, fz_RR = self.spline_fun_RR(best_control_parameters_RR, 0.0, 1)
+        best_freq = 1.4
+        return nmpc_GRFs, nmpc_footholds, nmpc_predicted_state, best_control_parameters, best_cost, best_freq, costs, \
+               (predicted_states, predicted_GRFs)
+    
 
 
-        # Add the gravity compensation to the stance legs and put to zero 
-        # the GRF of the swing legs
-        number_of_legs_in_stance = contact_sequence[0][0] + contact_sequence[1][0] + contact_sequence[2][0] + contact_sequence[3][0]
-        reference_force_stance_legs = (self.robot.mass * 9.81) / number_of_legs_in_stance
 
-        fz_FL = reference_force_stance_legs + fz_FL
-        fz_FR = reference_force_stance_legs + fz_FR
-        fz_RL = reference_force_stance_legs + fz_RL
-        fz_RR = reference_force_stance_legs + fz_RR
-        
-        fx_FL = fx_FL*contact_sequence[0][0]
-        fy_FL = fy_FL*contact_sequence[0][0]
-        fz_FL = fz_FL*contact_sequence[0][0]
+    def compute_control_mppi(self, state, reference, contact_sequence, best_control_parameters, key, timing, nominal_step_frequency, optimize_swing,
+                             recycled_samples=None):
+        """
+        This function computes the control parameters by applying MPPI. If recycled_samples are given, 
+        they replace the last fresh samples as a pool of elites: they are rolled out and can be the best 
+        sample, but they are not drawn from the current gaussian, so they get no weight in the update of 
+        the mean. The best num_recycled_samples samples, fresh or recycled, are returned as well.
+        """          
         
-        fx_FR = fx_FR*contact_sequence[1][0]
-        fy_FR = fy_FR*contact_sequence[1][0]
-        fz_FR = fz_FR*contact_sequence[1][0]
+        # No noise on the parameters that cannot affect the rollout
+        sigma = self.sigma_mppi
+        if(self.use_contact_aware_sampling):
+            sigma = sigma * self.compute_active_parameters_mask(contact_sequence)
+
+        if(self.num_sampling_devices > 1):
+            best_control_parameters, best_cost, costs = self.compute_mppi_update_sharded(state, reference, contact_sequence,
+                                                                                         best_control_parameters, key, sigma)
+        elif(self.rollout_chunk_size is not None):
+            best_control_parameters, best_cost, costs = self.compute_mppi_update_chunked(state, reference, contact_sequence,
+                                                                                         best_control_parameters, key, sigma)
+        else:
+            # Generate random parameters
+            additional_random_parameters = self.sample_gaussian_noise(key, sigma)
+            if(recycled_samples is not None):
+                additional_random_parameters = self.inject_recycled_samples(additional_random_parameters, best_control_parameters,
+                                                                            sigma, recycled_samples)
+    
+            
+            control_parameters_vec = best_control_parameters + additional_random_parameters
 
-        fx_RL = fx_RL*contact_sequence[2][0]
-        fy_RL = fy_RL*contact_sequence[2][0]
-        fz_RL = fz_RL*contact_sequence[2][0]
 
-        fx_RR = fx_RR*contact_sequence[3][0]
-        fy_RR = fy_RR*contact_sequence[3][0]
-        fz_RR = fz_RR*contact_sequence[3][0]
+            # Only the fresh samples are weighted in the update (the recycled ones are the last)
+            num_recycled_samples = self.num_recycled_samples if recycled_samples is not None else 0
+            fresh_samples = jnp.arange(self.num_parallel_computations) < self.num_parallel_computations - num_recycled_samples
 
+            # Do rollout
+            if(len(self.pruning_steps) > 0):
+                # The weights are computed only on the survivors
+                costs, survivors = self.compute_pruned_rollout(state, reference, control_parameters_vec, contact_sequence)
+                additional_random_parameters = additional_random_parameters[survivors]
+                fresh_samples = fresh_samples[survivors]
+            else:
+                costs = self.jit_vectorized_rollout(state, reference, control_parameters_vec, contact_sequence)
 
-        # Enforce force constraints
-        fx_FL, fy_FL, fz_FL, \
-        fx_FR, fy_FR, fz_FR, \
-        fx_RL, fy_RL, fz_RL, \
-        fx_RR, fy_RR, fz_RR =self.enforce_force_constraints(fx_FL, fy_FL, fz_FL,
-                                                            fx_FR, fy_FR, fz_FR,
-                                                            fx_RL, fy_RL, fz_RL,
-                                                            fx_RR, fy_RR, fz_RR)
-        
 
+            # Saturate the cost in case of NaN or inf
+            costs = jnp.where(jnp.isnan(costs), 1000000, costs)
+            costs = jnp.where(jnp.isinf(costs), 1000000, costs)
+            
 
-        nmpc_GRFs = jnp.array([fx_FL, fy_FL, fz_FL,
-                               fx_FR, fy_FR, fz_FR,
-                               fx_RL, fy_RL, fz_RL,
-                               fx_RR, fy_RR, fz_RR])
+            # Take the best found control parameters
+            best_index = jnp.nanargmin(costs)
+            best_cost = costs.take(best_index)
+
+
+            # Compute MPPI update
+            beta = best_cost
+            temperature = 1.
+            if(recycled_samples is not None):
+                # The best samples for the next tick
+                _, best_indices = jax.lax.top_k(-costs, self.num_recycled_samples)
+                new_recycled_parameters = best_control_parameters + additional_random_parameters[best_indices]
+
+                # The weights of the recycled samples are zero, beta is taken on the fresh ones so that they do not underflow
+                beta = jnp.min(jnp.where(fresh_samples, costs, jnp.inf))
+            exp_costs = jnp.where(fresh_samples, jnp.exp((-1./temperature) * (costs - beta)), 0.)
+            denom = np.sum(exp_costs)
+            weights = exp_costs/denom
+            if(self.gradient_refinement_candidates > 0):
+                # The best samples are refined together with the updated mean
+                _, best_indices = jax.lax.top_k(-costs, self.gradient_refinement_candidates)
+                best_samples = best_control_parameters + additional_random_parameters[best_indices]
+            best_control_parameters += jnp.dot(weights, additional_random_parameters)
+
+            if(len(self.pruning_steps) > 0):
+                # The pruned samples get the saturated cost
+                costs = jnp.full((self.num_parallel_computations,), 1000000, dtype=dtype_general).at[survivors].set(costs)
+
+
+        # Gradient steps from the updated mean (and the best samples, only in the dense update)
+        if(self.gradient_refinement_steps > 0):
+            candidates = best_control_parameters[None]
+            if(self.gradient_refinement_candidates > 0 and self.num_sampling_devices == 1 and self.rollout_chunk_size is None):
+                candidates = jnp.concatenate((candidates, best_samples))
+            best_control_parameters, refined_cost = self.compute_gradient_refinement(state, reference, contact_sequence,
+                                                                                     candidates, sigma)
+            best_cost = jnp.minimum(best_cost, refined_cost)
+
+
+        # Plan of the best parameters along the horizon, its first step gives the GRF and the predicted state
+        predicted_states, predicted_GRFs = self.compute_predicted_trajectory(state, best_control_parameters, contact_sequence)
+        nmpc_GRFs = predicted_GRFs[0]
         nmpc_footholds = jnp.array([0, 0, 0,
                                     0, 0, 0,
                                     0, 0, 0,
                                     0, 0, 0])
+        nmpc_predicted_state = predicted_states[0]
         
-
-        # Compute predicted state for IK
-        input = jnp.array([jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    fx_FL, fy_FL, fz_FL,
-                    fx_FR, fy_FR, fz_FR,
-                    fx_RL, fy_RL, fz_RL,
-                    fx_RR, fy_RR, fz_RR,
-                ], dtype=dtype_general)
-        current_contact = jnp.array([contact_sequence[0][0], contact_sequence[1][0], 
-                                        contact_sequence[2][0], contact_sequence[3][0]], dtype=dtype_general)
-        nmpc_predicted_state = self.robot.integrate_jax(state, input, current_contact, 0)
         
-
         best_freq = 1.4
-        return nmpc_GRFs, nmpc_footholds, nmpc_predicted_state, best_control_parameters, best_cost, best_freq, costs
+        
+        if(recycled_samples is not None):
+            return nmpc_GRFs, nmpc_footholds, nmpc_predicted_state, best_control_parameters, best_cost, best_freq, costs, \
+                   new_recycled_parameters, (predicted_states, predicted_GRFs)
+        return nmpc_GRFs, nmpc_footholds, nmpc_predicted_state, best_control_parameters, best_cost, best_freq, costs, \
+               (predicted_states, predicted_GRFs)
     
 
 
 
-    def compute_control_mppi(self, state, reference, contact_sequence, best_control_parameters, key, timing, nominal_step_frequency, optimize_swing):
+    def get_nominal_timing_parameters(self, duty_factor, step_freq):
+        """
+        Timing parameters of a periodic gait: zero phase offsets, the same duty factor for the four legs 
+        and the step frequency, of shape (9, ).
         """
-        This function computes the control parameters by applying MPPI.
-        """          
-        
-        # Generate random parameters
-        # The first control parameters is the old best one, so we add zero noise there
-        additional_random_parameters = self.initial_random_parameters*0.0
-        
-
-        # GAUSSIAN
-        num_sample_gaussian_1 = self.num_parallel_computations-1
-        additional_random_parameters = additional_random_parameters.at[1:self.num_parallel_computations].set(self.sigma_mppi*jax.random.normal(key=key, shape=(num_sample_gaussian_1, self.num_control_parameters)))
- 
-        
-        control_parameters_vec = best_control_parameters + additional_random_parameters
 
+        return jnp.array([0.]*4 + [duty_factor]*4 + [step_freq], dtype=dtype_general)
+    
 
-        
 
-        # Do rollout
-        costs = self.jit_vectorized_rollout(state, reference, control_parameters_vec, contact_sequence)
+    def clip_timing_parameters(self, timing_parameters):
+        """
+        Keep the phase offsets in [-0.5, 0.5), and the duty factors and step frequency in their ranges.
+        """
 
+        phase_offsets = jnp.mod(timing_parameters[0:4] + 0.5, 1.0) - 0.5
+        duty_factors = jnp.clip(timing_parameters[4:8], self.duty_factor_range[0], self.duty_factor_range[1])
+        step_freq = jnp.clip(timing_parameters[8:9], self.step_freq_range[0], self.step_freq_range[1])
+        return jnp.concatenate([phase_offsets, duty_factors, step_freq])
+    
 
-        # Saturate the cost in case of NaN or inf
-        costs = jnp.where(jnp.isnan(costs), 1000000, costs)
-        costs = jnp.where(jnp.isinf(costs), 1000000, costs)
-        
 
-        # Take the best found control parameters
-        best_index = jnp.nanargmin(costs)
-        best_cost = costs.take(best_index)
+    def compute_timing_contact_sequence(self, timing, timing_parameters, current_contact):
+        """
+        Contact sequence along the horizon of the periodic gait shifted by the phase offsets, with the 
+        duty factors and step frequency of the timing parameters. The first step is the current contact, 
+        which the GRFs are applied with, whatever the timing.
 
+        Args:
+            timing (jnp.array): current phase of the legs (from 0 to 1)
+            timing_parameters (jnp.array): phase offsets (4), duty factors (4) and step frequency
+            current_contact (jnp.array): current contact of the legs
+        Returns:
+            (jnp.array): contact sequence of shape (4, horizon)
+        """
 
-        # Compute MPPI update
-        beta = best_cost
-        temperature = 1.
-        exp_costs = jnp.exp((-1./temperature) * (costs - beta))
-        denom = np.sum(exp_costs)
-        weights = exp_costs/denom
-        weighted_inputs = weights[:, jnp.newaxis, jnp.newaxis] * additional_random_parameters.reshape((self.num_parallel_computations,self.num_control_parameters,1))
-        best_control_parameters += jnp.sum(weighted_inputs, axis=0).reshape((self.num_control_parameters, ))
+        timing_parameters = self.clip_timing_parameters(timing_parameters)
+        phase = jnp.mod(timing + timing_parameters[0:4], 1.0)
+        contact_sequence, _ = self.timing_pgg.compute_contact_sequence(simulation_dt=self.dt, t=phase, step_freq=timing_parameters[8], 
+                                                                       duty_factor=timing_parameters[4:8])
+        return contact_sequence.at[:, 0].set(current_contact)
+    
 
 
-        # And redistribute it to each leg
-        best_control_parameters_FL = best_control_parameters[0:self.num_control_parameters_single_leg]
-        best_control_parameters_FR = best_control_parameters[self.num_control_parameters_single_leg:self.num_control_parameters_single_leg*2]
-        best_control_parameters_RL = best_control_parameters[self.num_control_parameters_single_leg*2:self.num_control_parameters_single_leg*3]
-        best_control_parameters_RR = best_control_parameters[self.num_control_parameters_single_leg*3:self.num_control_parameters_single_leg*4]
+    def compute_timing_rollout(self, initial_state, reference, control_parameters, timing_parameters, timing, current_contact):
+        """
+        Cost of a rollout whose contact sequence comes from its own timing parameters.
+        """
 
+        contact_sequence = self.compute_timing_contact_sequence(timing, timing_parameters, current_contact)
+        return self.compute_rollout(initial_state, reference, control_parameters, contact_sequence)
+    
 
-        # Compute the GRF associated to the best parameter
-        fx_FL, fy_FL, fz_FL = self.spline_fun_FL(best_control_parameters_FL, 0.0, 1)
-        fx_FR, fy_FR, fz_FR = self.spline_fun_FR(best_control_parameters_FR, 0.0, 1)
-        fx_RL, fy_RL, fz_RL = self.spline_fun_RL(best_control_parameters_RL, 0.0, 1)
-        fx_RR, fy_RR, fz_RR = self.spline_fun_RR(best_control_parameters_RR, 0.0, 1)
 
+    def compute_mppi_gait_timing_update(self, state, reference, current_contact, best_control_parameters, best_timing_parameters, key, timing):
+        """
+        MPPI over the forces and the gait timing together: each sample perturbs both, builds its contact 
+        sequence from its timing parameters and is rolled out with it. The MPPI weights update both means, 
+        so a single sampling pass replaces the loop over gait candidates.
 
-        # Add the gravity compensation to the stance legs and put to zero 
-        # the GRF of the swing legs
-        number_of_legs_in_stance = contact_sequence[0][0] + contact_sequence[1][0] + contact_sequence[2][0] + contact_sequence[3][0]
-        reference_force_stance_legs = (self.robot.mass * 9.81) / number_of_legs_in_stance
+        Returns:
+            the updated control parameters and timing parameters, the best cost and the costs of the samples
+        """
 
+        force_key, timing_key = jax.random.split(key)
+        force_noise = self.sample_gaussian_noise(force_key, self.sigma_mppi)
+        timing_noise = jax.random.normal(timing_key, (self.num_parallel_computations, 9), dtype=dtype_general)*self.sigma_gait_timing
+        timing_noise = timing_noise.at[0].set(0.)
 
-        fz_FL = reference_force_stance_legs + fz_FL
-        fz_FR = reference_force_stance_legs + fz_FR
-        fz_RL = reference_force_stance_legs + fz_RL
-        fz_RR = reference_force_stance_legs + fz_RR
-        
-        fx_FL = fx_FL*contact_sequence[0][0]
-        fy_FL = fy_FL*contact_sequence[0][0]
-        fz_FL = fz_FL*contact_sequence[0][0]
+        costs = jax.vmap(self.compute_timing_rollout, in_axes=(None, None, 0, 0, None, None))(state, reference, 
+                                                                                               best_control_parameters + force_noise,
+                                                                                               best_timing_parameters + timing_noise, 
+                                                                                               timing, current_contact)
         
-        fx_FR = fx_FR*contact_sequence[1][0]
-        fy_FR = fy_FR*contact_sequence[1][0]
-        fz_FR = fz_FR*contact_sequence[1][0]
+        # Saturate the cost in case of NaN or inf (e.g. no leg in stance)
+        costs = jnp.where(jnp.isnan(costs), 1000000, costs)
+        costs = jnp.where(jnp.isinf(costs), 1000000, costs)
 
-        fx_RL = fx_RL*contact_sequence[2][0]
-        fy_RL = fy_RL*contact_sequence[2][0]
-        fz_RL = fz_RL*contact_sequence[2][0]
+        # Compute MPPI update, over the forces and the timing
+        best_cost = jnp.min(costs)
+        temperature = 1.
+        exp_costs = jnp.exp((-1./temperature) * (costs - best_cost))
+        weights = exp_costs/jnp.sum(exp_costs)
+        best_control_parameters += jnp.dot(weights, force_noise)
+        best_timing_parameters = self.clip_timing_parameters(best_timing_parameters + jnp.dot(weights, timing_noise))
 
-        fx_RR = fx_RR*contact_sequence[3][0]
-        fy_RR = fy_RR*contact_sequence[3][0]
-        fz_RR = fz_RR*contact_sequence[3][0]
+        return best_control_parameters, best_timing_parameters, best_cost, costs
+    
 
 
-        # Enforce force constraints
-        fx_FL, fy_FL, fz_FL, \
-        fx_FR, fy_FR, fz_FR, \
-        fx_RL, fy_RL, fz_RL, \
-        fx_RR, fy_RR, fz_RR =self.enforce_force_constraints(fx_FL, fy_FL, fz_FL,
-                                                            fx_FR, fy_FR, fz_FR,
-                                                            fx_RL, fy_RL, fz_RL,
-                                                            fx_RR, fy_RR, fz_RR)
-
-
-        nmpc_GRFs = jnp.array([fx_FL, fy_FL, fz_FL,
-                               fx_FR, fy_FR, fz_FR,
-                               fx_RL, fy_RL, fz_RL,
-                               fx_RR, fy_RR, fz_RR])
-        nmpc_footholds = jnp.array([0, 0, 0,
-                                    0, 0, 0,
-                                    0, 0, 0,
-                                    0, 0, 0])
-        
+    def compute_control_gait_timing_iterations(self, state, reference, current_contact, best_control_parameters, best_timing_parameters, 
+                                               key, timing):
+        """
+        Run all the num_sampling_iterations of compute_mppi_gait_timing_update inside a single lax.scan, 
+        carrying the means of the forces and of the timing and the PRNG key (as compute_control_iterations).
+        The new timing replaces the one in use only if it lowers its cost by gait_timing_min_improvement,
+        the plan is then rolled out once with the contact sequence of the kept timing.
 
-        # Compute predicted state for IK
-        input = jnp.array([jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    fx_FL, fy_FL, fz_FL,
-                    fx_FR, fy_FR, fz_FR,
-                    fx_RL, fy_RL, fz_RL,
-                    fx_RR, fy_RR, fz_RR,
-                ], dtype=dtype_general)
-        current_contact = jnp.array([contact_sequence[0][0], contact_sequence[1][0], 
-                                        contact_sequence[2][0], contact_sequence[3][0]], dtype=dtype_general)
-        nmpc_predicted_state = self.robot.integrate_jax(state, input, current_contact, 0)
-        
-        
-        best_freq = 1.4
-        
-        return nmpc_GRFs, nmpc_footholds, nmpc_predicted_state, best_control_parameters, best_cost, best_freq, costs
+        Returns:
+            GRFs, footholds and predicted state of the first step, control parameters, best cost, step 
+            frequency, costs of the samples of the last iteration, timing parameters, contact sequence, 
+            predicted states and GRFs along the horizon (see compute_predicted_trajectory) and the updated key
+        """
+
+        def refinement_iteration(carry, _):
+            best_control_parameters, best_timing_parameters, key = carry
+            key, subkey = jax.random.split(key)
+            best_control_parameters, best_timing_parameters, best_cost, costs = self.compute_mppi_gait_timing_update(state, reference, 
+                                                                                    current_contact, best_control_parameters, 
+                                                                                    best_timing_parameters, subkey, timing)
+            return (best_control_parameters, best_timing_parameters, key), (best_cost, costs)
+
+        carry = (best_control_parameters, best_timing_parameters, key)
+        carry, (best_costs, costs) = jax.lax.scan(refinement_iteration, carry, None, length=self.num_sampling_iterations)
+        best_control_parameters, new_timing_parameters, key = carry
+
+        # The first sample of the first iteration is the warm start with the timing in use
+        improved = best_costs[-1] < (1. - self.gait_timing_min_improvement) * costs[0, 0]
+        best_timing_parameters = jnp.where(improved, new_timing_parameters, best_timing_parameters)
+
+        # Plan along the horizon with the contact sequence of the kept timing, its first step gives the GRF and the predicted state
+        contact_sequence = self.compute_timing_contact_sequence(timing, best_timing_parameters, current_contact)
+        predicted_states, predicted_GRFs = self.compute_predicted_trajectory(state, best_control_parameters, contact_sequence)
+        nmpc_footholds = jnp.zeros(12)
+
+        return predicted_GRFs[0], nmpc_footholds, predicted_states[0], best_control_parameters, best_costs[-1], \
+               best_timing_parameters[8], costs[-1], best_timing_parameters, contact_sequence, (predicted_states, predicted_GRFs), key
     
 
 
+    def compute_cem_cholesky_factors(self, sigma):
+        """
+        Cholesky factors of the block covariance of CEM-MPPI, of shape (4, p, p). A scalar or a vector
+        of standard deviations gives diagonal blocks, factors are returned as they are.
+        """
+
+        sigma = jnp.asarray(sigma, dtype=dtype_general)
+        if(sigma.ndim == 3):
+            return sigma
+        
+        standard_deviations = jnp.broadcast_to(sigma, (self.num_control_parameters, ))
+        return jax.vmap(jnp.diag)(standard_deviations.reshape((4, self.num_control_parameters_single_leg)))
+    
+
 
     def compute_control_cem_mppi(self, state, reference, contact_sequence, best_control_parameters, key, sigma, timing = None, nominal_step_frequency = None):
         """
-        This function computes the control parameters by applying CEM-MPPI.
+        This function computes the control parameters by applying CEM-MPPI. The noise of each leg is drawn 
+        with the Cholesky factor of its covariance (sigma, of shape (4, p, p) with p parameters per leg), the 
+        mean gets the MPPI update and the covariance is smoothed towards the one of the elite samples.
         """          
         
-        # Generate random parameters
-        # The first control parameters is the old best one, so we add zero noise there
-        additional_random_parameters = self.initial_random_parameters*0.0
-        
-
-        # GAUSSIAN
-        num_sample_gaussian_1 = self.num_parallel_computations-1
-
-        additional_random_parameters = additional_random_parameters.at[1:self.num_parallel_computations].set(jax.random.normal(key=key, shape=(num_sample_gaussian_1, self.num_control_parameters))*sigma)
- 
+        # Generate random parameters, correlated within each leg
+        standard_normal = self.sample_standard_normal(key, self.num_parallel_computations - 1)
+        standard_normal = standard_normal.reshape((-1, 4, self.num_control_parameters_single_leg))
+        noise = jnp.einsum('lpq,nlq->nlp', sigma, standard_normal).reshape((-1, self.num_control_parameters))
+        if(self.use_contact_aware_sampling):
+            # No noise on the parameters that cannot affect the rollout
+            noise = noise * self.compute_active_parameters_mask(contact_sequence)
         
+        # The first sample is the old best one
+        additional_random_parameters = jnp.concatenate([jnp.zeros((1, self.num_control_parameters), dtype=dtype_general), noise])
         control_parameters_vec = best_control_parameters + additional_random_parameters
 
 
@@ -1063,97 +1975,40 @@ class Sampling_MPC:
         exp_costs = jnp.exp((-1./temperature) * (costs - beta))
         denom = np.sum(exp_costs)
         weights = exp_costs/denom
-        weighted_inputs = weights[:, jnp.newaxis, jnp.newaxis] * additional_random_parameters.reshape((self.num_parallel_computations,self.num_control_parameters,1))
-        best_control_parameters += jnp.sum(weighted_inputs, axis=0).reshape((self.num_control_parameters, ))
+        best_control_parameters += jnp.dot(weights, additional_random_parameters)
 
 
-        # And redistribute it to each leg
-        best_control_parameters_FL = best_control_parameters[0:self.num_control_parameters_single_leg]
-        best_control_parameters_FR = best_control_parameters[self.num_control_parameters_single_leg:self.num_control_parameters_single_leg*2]
-        best_control_parameters_RL = best_control_parameters[self.num_control_parameters_single_leg*2:self.num_control_parameters_single_leg*3]
-        best_control_parameters_RR = best_control_parameters[self.num_control_parameters_single_leg*3:self.num_control_parameters_single_leg*4]
-
-
-        # Compute the GRF associated to the best parameter
-        fx_FL, fy_FL, fz_FL = self.spline_fun_FL(best_control_parameters_FL, 0.0, 1)
-        fx_FR, fy_FR, fz_FR = self.spline_fun_FR(best_control_parameters_FR, 0.0, 1)
-        fx_RL, fy_RL, fz_RL = self.spline_fun_RL(best_control_parameters_RL, 0.0, 1)
-        fx_RR, fy_RR, fz_RR = self.spline_fun_RR(best_control_parameters_RR, 0.0, 1)
-
-
-        # Add the gravity compensation to the stance legs and put to zero 
-        # the GRF of the swing legs
-        number_of_legs_in_stance = contact_sequence[0][0] + contact_sequence[1][0] + contact_sequence[2][0] + contact_sequence[3][0]
-        reference_force_stance_legs = (self.robot.mass * 9.81) / number_of_legs_in_stance
-
-        fz_FL = reference_force_stance_legs + fz_FL
-        fz_FR = reference_force_stance_legs + fz_FR
-        fz_RL = reference_force_stance_legs + fz_RL
-        fz_RR = reference_force_stance_legs + fz_RR
-        
-        fx_FL = fx_FL*contact_sequence[0][0]
-        fy_FL = fy_FL*contact_sequence[0][0]
-        fz_FL = fz_FL*contact_sequence[0][0]
-        
-        fx_FR = fx_FR*contact_sequence[1][0]
-        fy_FR = fy_FR*contact_sequence[1][0]
-        fz_FR = fz_FR*contact_sequence[1][0]
-
-        fx_RL = fx_RL*contact_sequence[2][0]
-        fy_RL = fy_RL*contact_sequence[2][0]
-        fz_RL = fz_RL*contact_sequence[2][0]
-
-        fx_RR = fx_RR*contact_sequence[3][0]
-        fy_RR = fy_RR*contact_sequence[3][0]
-        fz_RR = fz_RR*contact_sequence[3][0]
-
-
-
-        # Enforce force constraints
-        fx_FL, fy_FL, fz_FL, \
-        fx_FR, fy_FR, fz_FR, \
-        fx_RL, fy_RL, fz_RL, \
-        fx_RR, fy_RR, fz_RR =self.enforce_force_constraints(fx_FL, fy_FL, fz_FL,
-                                                            fx_FR, fy_FR, fz_FR,
-                                                            fx_RL, fy_RL, fz_RL,
-                                                            fx_RR, fy_RR, fz_RR)
-
-
-        nmpc_GRFs = jnp.array([fx_FL, fy_FL, fz_FL,
-                               fx_FR, fy_FR, fz_FR,
-                               fx_RL, fy_RL, fz_RL,
-                               fx_RR, fy_RR, fz_RR])
+        # Plan of the best parameters along the horizon, its first step gives the GRF and the predicted state
+        predicted_states, predicted_GRFs = self.compute_predicted_trajectory(state, best_control_parameters, contact_sequence)
+        nmpc_GRFs = predicted_GRFs[0]
         nmpc_footholds = jnp.array([0, 0, 0,
                                     0, 0, 0,
                                     0, 0, 0,
                                     0, 0, 0])
-        # Compute predicted state for IK
-        input = jnp.array([jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    jnp.float32(0), jnp.float32(0), jnp.float32(0),
-                    fx_FL, fy_FL, fz_FL,
-                    fx_FR, fy_FR, fz_FR,
-                    fx_RL, fy_RL, fz_RL,
-                    fx_RR, fy_RR, fz_RR,
-                ], dtype=dtype_general)
-        current_contact = jnp.array([contact_sequence[0][0], contact_sequence[1][0], 
-                                        contact_sequence[2][0], contact_sequence[3][0]], dtype=dtype_general)
-        nmpc_predicted_state = self.robot.integrate_jax(state, input, current_contact, 0)
+        nmpc_predicted_state = predicted_states[0]
 
         
-        indexes = jnp.argsort(costs)[:10]
-        elite = additional_random_parameters[indexes]
-        new_sigma_cem_mppi = jnp.cov(elite, rowvar=False) +  np.eye(self.num_control_parameters)*1e-8
-        new_sigma_cem_mppi = jnp.diag(new_sigma_cem_mppi)
-        new_sigma_cem_mppi = jnp.sqrt(new_sigma_cem_mppi)
-        new_sigma_cem_mppi = jnp.where(new_sigma_cem_mppi > 5, 5, new_sigma_cem_mppi)
-        new_sigma_cem_mppi = jnp.where(new_sigma_cem_mppi < 0.2, 0.2, new_sigma_cem_mppi)
+        # Covariance of the elites of each leg (top_k, no full sort of the costs)
+        num_elites = max(2, int(self.num_parallel_computations * self.cem_elite_fraction))
+        _, elite_indices = jax.lax.top_k(-costs, num_elites)
+        elite = additional_random_parameters[elite_indices].reshape((num_elites, 4, self.num_control_parameters_single_leg))
+        elite = elite - jnp.mean(elite, axis=0)
+        elite_covariance = jnp.einsum('nlp,nlq->lpq', elite, elite) / (num_elites - 1)
+
+        # Exponential smoothing with the covariance of this iteration, and its standard deviations 
+        # along the principal directions are kept within [0.2, 5]
+        covariance = jnp.einsum('lpk,lqk->lpq', sigma, sigma)
+        covariance = self.cem_covariance_smoothing*elite_covariance + (1. - self.cem_covariance_smoothing)*covariance
+        eigenvalues, eigenvectors = jnp.linalg.eigh(covariance)
+        eigenvalues = jnp.clip(eigenvalues, 0.2**2, 5.**2)
+        covariance = jnp.einsum('lpk,lk,lqk->lpq', eigenvectors, eigenvalues, eigenvectors)
+        new_sigma_cem_mppi = jnp.linalg.cholesky(covariance)
 
         
         best_freq = 1.65
         
-        return nmpc_GRFs, nmpc_footholds, nmpc_predicted_state, best_control_parameters, best_cost, best_freq, costs, new_sigma_cem_mppi
+        return nmpc_GRFs, nmpc_footholds, nmpc_predicted_state, best_control_parameters, best_cost, best_freq, costs, new_sigma_cem_mppi, \
+               (predicted_states, predicted_GRFs)
 
     
     def reset(self):
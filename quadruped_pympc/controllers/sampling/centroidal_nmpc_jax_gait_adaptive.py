@@ -15,6 +15,7 @@ sys.path.append(dir_path + '/../')
 sys.path.append(dir_path + '/../helpers/')
 
 from quadruped_pympc import config
+from quadruped_pympc.helpers.jax_compilation import enable_persistent_compilation_cache, AOTCompiledFunction
 from centroidal_model_jax import Centroidal_Model_JAX
 from quadruped_pympc.helpers.periodic_gait_generator_jax import PeriodicGaitGeneratorJax
 
@@ -63,6 +64,9 @@ class Sampling_MPC:
                 print("GPU not available, using CPU")
         else:
             self.device = jax.devices('cpu')[0]
+
+        # Executables stored on disk are loaded instead of compiled again (None disables it)
+        self.compilation_cache_path = enable_persistent_compilation_cache(config.mpc_params.get('compilation_cache_dir', None))
         
 
         
@@ -253,8 +257,8 @@ class Sampling_MPC:
         self.jitted_compute_contact_sequence = jax.jit(self.pgg.compute_contact_sequence, device=self.device)
 
 
-        # jitting the vmap function!
-        self.vectorized_rollout = jax.vmap(self.compute_rollout, in_axes=(None, None, None, 0, 0), out_axes=0)
+        # jitting the vmap function! The samples share the table of contact sequences, and gather theirs by index
+        self.vectorized_rollout = jax.vmap(self.compute_rollout, in_axes=(None, None, None, None, 0, 0), out_axes=0)
         self.jit_vectorized_rollout = jax.jit(self.vectorized_rollout, device=self.device)
 
         # the first call of jax is very slow, hence we should do this since the beginning 
@@ -263,20 +267,23 @@ class Sampling_MPC:
         initial_reference = jnp.zeros((self.reference_dim,), dtype=dtype_general)
 
 
+        self.step_freq_delta = jnp.array(config.mpc_params['step_freq_available'])
+
         self.control_parameters_vec = random.uniform(self.master_key, (self.num_control_parameters*self.num_parallel_computations, ), minval=-100., maxval=100.)
-        step_frequencies_vec = jax.random.uniform(self.master_key, shape=(self.num_parallel_computations, 1))
+        frequency_indices_vec = jax.random.choice(self.master_key, self.step_freq_delta.shape[0], shape=(self.num_parallel_computations, ))
  
         
-        temp = self.pgg.get_t()
+        temp = self.compute_contact_sequence_table(self.pgg.get_t(), self.step_freq_delta)
         temp2 = self.control_parameters_vec.reshape(self.num_parallel_computations, self.num_control_parameters)
-        temp3 = step_frequencies_vec.reshape(self.num_parallel_computations, )
         self.jit_vectorized_rollout(initial_state, initial_reference, 
                                     temp,
+                                    self.step_freq_delta,
                                     temp2, 
-                                    temp3)
-        
+                                    frequency_indices_vec)
 
-        self.step_freq_delta = jnp.array(config.mpc_params['step_freq_available'])
+        # Compile ahead of time the entry point called at every tick, so the first tick does not stall
+        if(config.mpc_params.get('use_aot_compilation', False)):
+            self.compile_entry_points()
         
         
         
@@ -524,13 +531,32 @@ class Sampling_MPC:
     
 
 
-    def compute_rollout(self, initial_state, reference, timing, control_parameters, step_frequency):
+    def compute_contact_sequence_table(self, timing, step_frequencies):
+        """
+        Contact sequence of each candidate step frequency, computed once per tick outside the vmap
+        over the samples (which gather theirs by index).
+
+        Args:
+            timing (np.array): phase of the legs
+            step_frequencies (jnp.array): candidate step frequencies
+        Returns:
+            (jnp.array): contact sequences of shape (num_frequencies, 4, horizon)
+        """
+
+        compute_contact_sequence = lambda step_frequency: self.jitted_compute_contact_sequence(simulation_dt=0.002, t=timing, step_freq=step_frequency)[0]
+        return jax.vmap(compute_contact_sequence)(step_frequencies)
+    
+
+
+    def compute_rollout(self, initial_state, reference, contact_sequences, step_frequencies, control_parameters, frequency_index):
         """Calculate cost of a rollout of the dynamics given random parameters
         Args:
             initial_state (np.array): actual state of the robot
             reference (np.array): desired state of the robot
+            contact_sequences (jnp.array): contact sequence of each candidate step frequency (see compute_contact_sequence_table)
+            step_frequencies (jnp.array): candidate step frequencies
             control_parameters (np.array): parameters for the controllers
-            parameters (np.array): parameters for the simplified dynamics
+            frequency_index (int): index of the step frequency of this sample
         Returns:
             (float): cost of the rollout
         """  
@@ -539,7 +565,8 @@ class Sampling_MPC:
         cost = jnp.float32(0.0)
         n_ = jnp.array([-1,-1,-1,-1])
 
-        contact_sequence, _ = self.jitted_compute_contact_sequence(simulation_dt=0.002, t=timing, step_freq=step_frequency)
+        contact_sequence = contact_sequences[frequency_index]
+        step_frequency = step_frequencies[frequency_index]
 
         FL_num_of_contact = jnp.sum(contact_sequence[0])+1
         FR_num_of_contact = jnp.sum(contact_sequence[1])+1
@@ -674,6 +701,32 @@ class Sampling_MPC:
     def get_sigma(self):
         return self.sigma_cem_mppi
     
+
+
+    def compile_entry_points(self):
+        """
+        Lower and compile jitted_compute_control with arguments of the same types the controller
+        interface passes at runtime (contact sequence generation and rollout are inlined in it).
+        The compiled executable falls back to the jitted function for other argument types.
+        """
+
+        # with_newkey splits the key outside the compiled function
+        jax.random.split(self.master_key)
+
+        # The interface calls the CEM-MPPI variant with a different signature
+        if(self.sampling_method == 'cem_mppi'):
+            return
+
+        state = np.zeros(self.state_dim)
+        reference = np.zeros(self.reference_dim)
+        contact_sequence = np.ones((4, self.horizon))
+        best_control_parameters = np.zeros(self.num_control_parameters, dtype=dtype_general)
+        timing = np.zeros(4)
+        nominal_step_frequency = config.simulation_params['gait_params'][config.simulation_params['gait']]['step_freq']
+        self.jitted_compute_control = AOTCompiledFunction(self.jitted_compute_control, state, reference, contact_sequence,
+                                                          best_control_parameters, self.master_key, timing,
+                                                          nominal_step_frequency, 0)
+    
     
 
 
@@ -808,11 +861,13 @@ class Sampling_MPC:
 
 
         #step_frequencies_vec = jax.random.choice(key, available_freq_increment, shape=(self.num_parallel_computations, ))*optimize_swing + nominal_step_frequency
-        step_frequencies_vec = jax.random.choice(key, available_freq_increment, shape=(self.num_parallel_computations, ))
+        frequency_indices_vec = jax.random.choice(key, available_freq_increment.shape[0], shape=(self.num_parallel_computations, ))
+        step_frequencies_vec = available_freq_increment[frequency_indices_vec]
 
 
-        # Do rollout
-        costs = self.jit_vectorized_rollout(state, reference, timing, control_parameters_vec, step_frequencies_vec)
+        # Do rollout, with one contact sequence per candidate step frequency
+        contact_sequences = self.compute_contact_sequence_table(timing, available_freq_increment)
+        costs = self.jit_vectorized_rollout(state, reference, contact_sequences, available_freq_increment, control_parameters_vec, frequency_indices_vec)
 
 
         # Saturate the cost in case of NaN or inf
@@ -929,11 +984,13 @@ class Sampling_MPC:
 
         # Sampling step frequency
         available_freq_increment = self.step_freq_delta
-        step_frequencies_vec = jax.random.choice(key, available_freq_increment, shape=(self.num_parallel_computations, ))#*optimize_swing + nominal_step_frequency
+        frequency_indices_vec = jax.random.choice(key, available_freq_increment.shape[0], shape=(self.num_parallel_computations, ))#*optimize_swing + nominal_step_frequency
+        step_frequencies_vec = available_freq_increment[frequency_indices_vec]
      
 
-        # Do rollout
-        costs = self.jit_vectorized_rollout(state, reference, timing, control_parameters_vec, step_frequencies_vec)
+        # Do rollout, with one contact sequence per candidate step frequency
+        contact_sequences = self.compute_contact_sequence_table(timing, available_freq_increment)
+        costs = self.jit_vectorized_rollout(state, reference, contact_sequences, available_freq_increment, control_parameters_vec, frequency_indices_vec)
 
 
         # Saturate the cost in case of NaN or inf
@@ -1061,13 +1118,15 @@ class Sampling_MPC:
        
 
         # Sampling step frequency
-        available_freq_increment = jnp.array([0.0, 0.2, 0.4])
-        step_frequencies_vec = jax.random.choice(key, available_freq_increment, shape=(self.num_parallel_computations, ))*optimize_swing + nominal_step_frequency
+        available_freq_increment = jnp.array([0.0, 0.2, 0.4])*optimize_swing + nominal_step_frequency
+        frequency_indices_vec = jax.random.choice(key, available_freq_increment.shape[0], shape=(self.num_parallel_computations, ))
+        step_frequencies_vec = available_freq_increment[frequency_indices_vec]
 
 
 
-        # Do rollout
-        costs = self.jit_vectorized_rollout(state, reference, timing, control_parameters_vec, step_frequencies_vec)
+        # Do rollout, with one contact sequence per candidate step frequency
+        contact_sequences = self.compute_contact_sequence_table(timing, available_freq_increment)
+        costs = self.jit_vectorized_rollout(state, reference, contact_sequences, available_freq_increment, control_parameters_vec, frequency_indices_vec)
 
 
         # Saturate the cost in case of NaN or inf
@@ -0,0 +1,167 @@
+# Description: This file contains the class CostRegistry that collects the terms of the
+# stage cost of the sampling-based controllers
+
+import numpy as np
+
+import jax
+import jax.numpy as jnp
+
+
+
+dtype_general='float32'
+
+
+
+class CostRegistry:
+    def __init__(self, state_dim, input_dim) -> None:
+        """
+        Registry of the stage cost terms. Every term is declared on some entries of the state error
+        or of the input, and all the diagonal quadratic terms are merged in a single weight vector,
+        so the stage cost is one elementwise expression with no dense matmul.
+
+        Args:
+            state_dim (int): dimension of the state error
+            input_dim (int): dimension of the input
+        """
+
+        self.dims = {'state': state_dim, 'input': input_dim}
+        self.terms = []
+
+
+
+    def get_indices(self, source, indices):
+        """
+        Entries of the state error ('state') or of the input ('input') as an array of indices.
+        """
+
+        if(source not in self.dims):
+            raise ValueError(f"Unknown cost source: {source}")
+        if(isinstance(indices, slice)):
+            indices = range(self.dims[source])[indices]
+        return np.atleast_1d(np.asarray(indices, dtype=int))
+
+
+
+    def add_term(self, name, kind, source=None, indices=None, weights=1., **params):
+        """
+        Declare a cost term. kind is 'quadratic' (w*e^2), 'huber' (quadratic up to delta, then linear),
+        'barrier' (relaxed log barrier keeping the entries within lower and upper, quadratic within
+        delta of the bounds and outside them, by default delta is a tenth of the interval) or 'custom' (function(state_error, input) returning a scalar).
+        """
+
+        if(kind not in ['quadratic', 'huber', 'barrier', 'custom']):
+            raise ValueError(f"Unknown cost term: {kind}")
+        if(any(term['name'] == name for term in self.terms)):
+            raise ValueError(f"Cost term {name} already declared")
+
+        if(kind == 'barrier' and params.get('delta') is None):
+            params['delta'] = 0.1*(params['upper'] - params['lower'])
+
+        term = {'name': name, 'kind': kind, **params}
+        if(kind != 'custom'):
+            term['source'] = source
+            term['indices'] = self.get_indices(source, indices)
+            term['weights'] = np.broadcast_to(np.asarray(weights, dtype=dtype_general), term['indices'].shape)
+        self.terms.append(term)
+
+
+
+    def add_quadratic(self, name, source, indices, weights):
+        self.add_term(name, 'quadratic', source, indices, weights)
+
+    def add_huber(self, name, source, indices, weights, delta):
+        self.add_term(name, 'huber', source, indices, weights, delta=delta)
+
+    def add_barrier(self, name, source, indices, weights, lower, upper, delta=None):
+        self.add_term(name, 'barrier', source, indices, weights, lower=lower, upper=upper, delta=delta)
+
+    def add_custom(self, name, function):
+        self.add_term(name, 'custom', function=function)
+
+
+
+    def get_quadratic_weights(self, source):
+        """
+        Sum of the weights of all the quadratic terms on the entries of source.
+        """
+
+        weights = np.zeros(self.dims[source], dtype=dtype_general)
+        for term in self.terms:
+            if(term['kind'] == 'quadratic' and term['source'] == source):
+                np.add.at(weights, term['indices'], term['weights'])
+        return jnp.array(weights)
+
+
+
+    def compute_term(self, term, state_error, input):
+        """
+        Cost of a single term.
+        """
+
+        if(term['kind'] == 'custom'):
+            return term['function'](state_error, input)
+
+        values = (state_error if term['source'] == 'state' else input)[term['indices']]
+        if(term['kind'] == 'quadratic'):
+            costs = values**2
+        elif(term['kind'] == 'huber'):
+            delta = term['delta']
+            costs = jnp.where(jnp.abs(values) <= delta, 0.5*values**2, delta*(jnp.abs(values) - 0.5*delta))
+        else:
+            costs = self.relaxed_log_barrier(values - term['lower'], term['delta']) + \
+                    self.relaxed_log_barrier(term['upper'] - values, term['delta'])
+        return jnp.sum(term['weights'] * costs)
+
+
+
+    def relaxed_log_barrier(self, distance, delta):
+        """
+        -log(distance), continued by a quadratic below delta so it is finite outside the bounds.
+        """
+
+        safe_distance = jnp.maximum(distance, delta)
+        quadratic = 0.5*(((distance - 2.*delta)/delta)**2 - 1.) - jnp.log(delta)
+        return jnp.where(distance > delta, -jnp.log(safe_distance), quadratic)
+
+
+
+    def compute_stage_cost(self, state_error, input):
+        """
+        Stage cost of the rollout: the merged quadratic terms, plus the other terms one by one.
+        """
+
+        cost = jnp.sum(self.state_weights * state_error**2)
+        if(self.has_input_weights):
+            cost += jnp.sum(self.input_weights * input**2)
+        for term in self.terms:
+            if(term['kind'] != 'quadratic'):
+                cost += self.compute_term(term, state_error, input)
+        return cost
+
+
+
+    def compute_cost_breakdown(self, state_errors, inputs):
+        """
+        Cost of each term summed along a trajectory.
+
+        Args:
+            state_errors (jnp.array): state errors of shape (steps, state_dim)
+            inputs (jnp.array): inputs of shape (steps, input_dim)
+        Returns:
+            dict: cost of each term, by name
+        """
+
+        return {term['name']: jnp.sum(jax.vmap(lambda state_error, input: self.compute_term(term, state_error, input))(state_errors, inputs))
+                for term in self.terms}
+
+
+
+    def compile(self):
+        """
+        Merge the quadratic terms, to be called once all the terms are declared (before tracing the rollout).
+        """
+
+        self.state_weights = self.get_quadratic_weights('state')
+        self.input_weights = self.get_quadratic_weights('input')
+        self.has_input_weights = bool(np.any(np.asarray(self.input_weights) != 0))
+        return self
@@ -1,17 +1,22 @@
+import sys
 import numpy as np
 import jax
 import jax.numpy as jnp
 
 from quadruped_pympc.controllers.sampling.centroidal_nmpc_jax import Sampling_MPC
 from quadruped_pympc.helpers.gait_adapter import GaitAdapter
+from quadruped_pympc.helpers.random_gait_generator_jax import RandomGaitGeneratorJax
+from quadruped_pympc.helpers.gait_bank import GaitBank
+from quadruped_pympc.helpers.jax_compilation import AOTCompiledFunction
 from quadruped_pympc.helpers.quadruped_utils import GaitType
 from quadruped_pympc import config
 
 class RandomGaitMPPI(Sampling_MPC):
     """MPPI-based controller that optimizes both GRF and gait patterns"""
     
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, *args, use_aot_compilation=None, **kwargs):
+        # The entry points of a tick are the gait ones below, they are compiled ahead of time at the end
+        super().__init__(*args, use_aot_compilation=False, **kwargs)
         
         # Gait optimization parameters
         self.num_gait_samples = config.mpc_params.get('num_gait_samples', 20)
@@ -28,14 +33,81 @@ class RandomGaitMPPI(Sampling_MPC):
             step_freq=step_freq,
             gait_type=gait_type,
             horizon=self.horizon,
-            use_random_gait=True
+            use_random_gait=True,
+            random_gait_dt=self.dt
         )
         
+        # The candidates are contact sequences of the horizon, so they are generated with its timestep: the leg
+        # timers count the steps of the horizon spent in the current state, a tick moves them on by tick_steps
+        self.tick_steps = 1.0 / (config.simulation_params['mpc_frequency'] * self.dt)
+        
         # Track current contacts for continuity
         self.current_contacts = np.ones(4)
+        
+        # Generate the candidates on the device, inside the jitted call (see compute_control_random_gaits),
+        # with the same constraints and timestep (the one of the horizon) of the host generator of the gait adapter
+        self.use_jax_gait_generator = config.mpc_params.get('use_jax_gait_generator', False)
+        self.gait_generator_jax = RandomGaitGeneratorJax(
+            horizon=self.horizon,
+            dt=self.dt,
+            params=self.gait_adapter.random_generator.params
+        )
+        self.leg_states, self.leg_timers = self.gait_generator_jax.get_initial_phase()
+        
+        # Serve most candidates from a bank of the sequences already generated from the same phase
+        # of the legs, plus a few new ones (see GaitBank), None to generate all of them at every tick.
+        # The phases are indexed in steps of the horizon, as the leg timers and the step counts of the generator
+        self.gait_bank = None
+        if config.mpc_params.get('use_gait_bank', False):
+            self.gait_bank = GaitBank(
+                horizon=self.horizon,
+                max_phases=config.mpc_params.get('gait_bank_max_phases', 64),
+                max_sequences_per_phase=config.mpc_params.get('gait_bank_max_sequences_per_phase', 64),
+                timer_cap=max(self.gait_generator_jax.max_stance_steps, self.gait_generator_jax.min_swing_steps)
+            )
+            self.gait_bank_fresh_samples = config.mpc_params.get('gait_bank_fresh_samples', 4)
+            self.jitted_compute_contact_sequences = jax.jit(self.gait_generator_jax.compute_contact_sequences, 
+                                                            static_argnums=3, device=self.jit_device)
+
+        # Sampling_MPC.__init__ binds compute_control to compute_control_mppi as an instance attribute, and the 
+        # interface runs a tick through jitted_compute_control_iterations, so the gait path is wired in here: 
+        # the candidate gaits are generated (on the host, or on the device), then all of them are solved in one compiled call
+        if self.use_fused_control_tick or self.optimize_gait_timing or hasattr(self, 'sample_tier_entry_points'):
+            print("Error: RandomGaitMPPI does not support use_fused_control_tick, optimize_gait_timing nor anytime_sample_tiers")
+            sys.exit(1)
+        self.jitted_compute_control_gaits = jax.jit(self.compute_control_gaits, device=self.jit_device)
+        self.jitted_compute_control_random_gaits = jax.jit(self.compute_control_random_gaits, device=self.jit_device)
+        self.jitted_compute_control_iterations = self.compute_control_iterations_with_gait
+        
+        if use_aot_compilation is None:
+            use_aot_compilation = config.mpc_params.get('use_aot_compilation', False)
+        if use_aot_compilation:
+            self.compile_entry_points()
 
-        # Overriding jitted compute_control method
-        self.jitted_compute_control = jax.jit(self.compute_control, device=self.device)
+    def compile_entry_points(self):
+        """Lower and compile the gait entry points, with arguments of the same types compute_control_iterations_with_gait 
+        passes at runtime (see Sampling_MPC.compile_entry_points)"""
+        state = np.zeros(self.state_dim)
+        reference = np.zeros(self.reference_dim)
+        best_control_parameters = np.zeros(self.num_control_parameters, dtype=np.float32)
+        sigma = self.sigma_cem_mppi if self.sampling_method == 'cem_mppi' else None
+        timing = np.zeros(4)
+        nominal_step_frequency = config.simulation_params['gait_params'][config.simulation_params['gait']]['step_freq']
+        optimize_swing = 0
+        leg_states, leg_timers = np.ones(4, dtype=np.float32), np.zeros(4, dtype=np.float32)
+        
+        if self.use_jax_gait_generator and self.gait_bank is None:
+            self.jitted_compute_control_random_gaits = AOTCompiledFunction(self.jitted_compute_control_random_gaits, state, reference,
+                                                                           leg_states, leg_timers, best_control_parameters,
+                                                                           self.master_key, sigma, timing, nominal_step_frequency,
+                                                                           optimize_swing)
+        else:
+            current_contacts = np.ones(4)
+            contact_sequences = jnp.ones((self.num_gait_samples, 4, self.horizon))
+            self.jitted_compute_control_gaits = AOTCompiledFunction(self.jitted_compute_control_gaits, state, reference,
+                                                                    current_contacts, contact_sequences, best_control_parameters,
+                                                                    self.master_key, sigma, timing, nominal_step_frequency,
+                                                                    optimize_swing)
 
     def generate_contact_sequences(self, num_sequences, current_contacts=None):
         """Generate multiple candidate contact sequences
@@ -47,15 +119,16 @@ class RandomGaitMPPI(Sampling_MPC):
         Returns:
             List of contact sequences
         """
-        print("GENERATING CONTACT SEQUENCES....................")
         sequences = []
         
         # Use current contacts if provided, otherwise use stored contacts
         if current_contacts is not None:
             self.current_contacts = current_contacts.copy()
         
-        # Generate candidate sequences
+        # Generate candidate sequences, each one from the phase of the legs
         for i in range(num_sequences):
+            self.gait_adapter.current_contact = np.array(self.leg_states, dtype=np.float64)
+            self.gait_adapter.random_generator.leg_timers = np.array(self.leg_timers, dtype=np.float64)
             sequence = self.gait_adapter.compute_contact_sequence()
             sequences.append(sequence)
         
@@ -65,6 +138,25 @@ class RandomGaitMPPI(Sampling_MPC):
             
         return sequences
 
+    def compute_sequence_stability_costs(self, contact_sequences):
+        """Compute the stability cost of a batch of sequences
+        
+        Args:
+            contact_sequences: Contact sequences of shape (num_sequences, 4, horizon)
+            
+        Returns:
+            Stability costs of shape (num_sequences, ) (lower is better)
+        """
+        # Check minimum number of supporting legs
+        legs_in_stance = jnp.sum(contact_sequences, axis=1)
+        cost = 1000.0 * jnp.sum(jnp.maximum(self.min_support_legs - legs_in_stance, 0.0), axis=1)
+        
+        # Penalize rapid transitions (optional)
+        transitions = jnp.sum(jnp.abs(jnp.diff(contact_sequences, axis=2)), axis=(1, 2))
+        cost += transitions * 10.0
+        
+        return cost
+
     def evaluate_sequence_stability(self, sequence, state):
         """Compute stability cost for a sequence
         
@@ -75,71 +167,126 @@ class RandomGaitMPPI(Sampling_MPC):
         Returns:
             Stability cost (lower is better)
         """
-        cost = 0.0
+        return float(self.compute_sequence_stability_costs(jnp.asarray(sequence)[None])[0])
+
+    def update_leg_phase(self, current_contacts):
+        """Move the phase of the legs on by one tick, to the contact the controller is called with. The timers
+        are in steps of the horizon (the unit of the generators), a tick lasts tick_steps of them
         
-        # Check minimum number of supporting legs
-        for t in range(sequence.shape[1]):
-            legs_in_stance = np.sum(sequence[:, t])
-            if legs_in_stance < self.min_support_legs:
-                cost += 1000.0 * (self.min_support_legs - legs_in_stance)
+        Args:
+            current_contacts: Current contact state of the legs
+        """
+        leg_states, leg_timers = np.asarray(self.leg_states), np.asarray(self.leg_timers)
+        current_contacts = np.asarray(current_contacts, dtype=np.float32)
+        self.leg_timers = np.where(current_contacts == leg_states, leg_timers + self.tick_steps, self.tick_steps).astype(np.float32)
+        self.leg_states = current_contacts
+
+    def compute_control_gaits(self, state, reference, current_contacts, contact_sequences, best_control_parameters, key, sigma,
+                              timing, nominal_step_frequency, optimize_swing):
+        """Optimize the forces of all the candidate gaits and select the best one, on the device
         
-        # Penalize rapid transitions (optional)
-        for t in range(1, sequence.shape[1]):
-            transitions = np.sum(np.abs(sequence[:, t] - sequence[:, t-1]))
-            cost += transitions * 10.0
+        compute_control_iterations is vmapped over the gaits, so the rollout runs over gaits and force samples together.
+        The candidates are the steps after the current one, whose contact is current_contacts: the GRFs of the solution
+        are applied with it, so it is the first step of every sequence that is solved.
         
-        return cost
+        Args:
+            state: Current state vector
+            reference: Reference state trajectory
+            current_contacts: Current contact state of the legs
+            contact_sequences: Candidate contact sequences of shape (num_sequences, 4, horizon)
+            best_control_parameters: Previous best GRF parameters
+            key: JAX random key (the same noise is used for every gait)
+            sigma, timing, nominal_step_frequency, optimize_swing: As in compute_control_iterations
+            
+        Returns:
+            The outputs of compute_control_iterations for the best gait, followed by its contact sequence and its index
+        """
+        current_step = jnp.broadcast_to(jnp.asarray(current_contacts, dtype=contact_sequences.dtype)[None, :, None],
+                                        (contact_sequences.shape[0], 4, 1))
+        contact_sequences = jnp.concatenate([current_step, contact_sequences[:, :, :-1]], axis=2)
+        
+        def solve_gait(contact_sequence):
+            return Sampling_MPC.compute_control_iterations(self, state, reference, contact_sequence, best_control_parameters, key,
+                                                           sigma, timing, nominal_step_frequency, optimize_swing)
+        
+        results = jax.vmap(solve_gait)(contact_sequences)
+        
+        # Add gait stability cost
+        total_costs = results[4] + self.compute_sequence_stability_costs(contact_sequences) * self.gait_stability_weight
+        best_gait = jnp.argmin(total_costs)
+        
+        best_result = jax.tree_util.tree_map(lambda result: result[best_gait], results)
+        return tuple(best_result) + (contact_sequences[best_gait], best_gait)
 
-    def compute_control_mppi_with_gait(self, state, reference, current_contacts, best_control_parameters, key):
-        """Compute optimal control with integrated gait planning
+    def compute_control_random_gaits(self, state, reference, leg_states, leg_timers, best_control_parameters, key, sigma,
+                                     timing, nominal_step_frequency, optimize_swing):
+        """Generate the candidate gaits from the phase of the legs and solve them, all on the device
         
         Args:
             state: Current state vector
             reference: Reference state trajectory
-            current_contacts: Current contact state
+            leg_states: Current contact state of the legs
+            leg_timers: Steps already spent by the legs in their current state
             best_control_parameters: Previous best GRF parameters
             key: JAX random key
+            sigma, timing, nominal_step_frequency, optimize_swing: As in compute_control_iterations
             
         Returns:
-            GRF, footholds, predicted state, parameters, cost, frequency, costs
+            The outputs of compute_control_gaits
         """
-        # Generate multiple candidate gait sequences
-        candidate_sequences = self.generate_contact_sequences(self.num_gait_samples, current_contacts)
+        gait_key, sampling_key = jax.random.split(key)
+        contact_sequences, _ = self.gait_generator_jax.compute_contact_sequences(gait_key, leg_states, leg_timers, self.num_gait_samples)
+        
+        return self.compute_control_gaits(state, reference, leg_states, contact_sequences, best_control_parameters, sampling_key,
+                                          sigma, timing, nominal_step_frequency, optimize_swing)
+
+    def compute_control_iterations_with_gait(self, state, reference, contact_sequence, best_control_parameters, key, sigma,
+                                             timing, nominal_step_frequency, optimize_swing):
+        """Entry point of a tick, in place of compute_control_iterations (same arguments and outputs)
         
-        best_cost = float('inf')
-        best_result = None
+        The candidate gaits are generated from the phase of the legs, then all of them are solved with
+        jitted_compute_control_gaits, and the best contact sequence is stored in best_sequence. With 
+        use_jax_gait_generator, the generation runs in the same compiled call (jitted_compute_control_random_gaits),
+        with use_gait_bank most candidates are served by the bank of the phase of the legs.
+        
+        Args:
+            contact_sequence: Contact sequence of the periodic gait generator, only its first step (the current contact) is used
+            the others: As in compute_control_iterations
+            
+        Returns:
+            The outputs of compute_control_iterations for the best gait
+        """
+        current_contacts = np.asarray(contact_sequence)[:, 0]
+        self.update_leg_phase(current_contacts)
         
-        # For each candidate sequence, optimize forces
-        for sequence in candidate_sequences:
-            # Call standard MPPI to optimize forces for this sequence
-            nmpc_GRFs, nmpc_footholds, predicted_state, parameters, cost, freq, costs = \
-                super().compute_control_mppi(state, reference, sequence, best_control_parameters, key, None, None, None)
+        if self.use_jax_gait_generator and self.gait_bank is None:
+            *best_result, best_sequence, best_gait = self.jitted_compute_control_random_gaits(state, reference, self.leg_states, self.leg_timers,
+                                                                                              best_control_parameters, key, sigma,
+                                                                                              timing, nominal_step_frequency, optimize_swing)
+        else:
+            if self.gait_bank is not None:
+                # Look up the candidates of the phase of the legs, the new ones are generated on the device
+                gait_key, key = jax.random.split(key)
+                generate_fun = lambda num_sequences: self.jitted_compute_contact_sequences(gait_key, self.leg_states, self.leg_timers,
+                                                                                           num_sequences)[0]
+                candidate_sequences = self.gait_bank.get_candidates(self.leg_states, self.leg_timers, self.num_gait_samples,
+                                                                    self.gait_bank_fresh_samples, generate_fun)
+            else:
+                # Generate multiple candidate gait sequences
+                candidate_sequences = np.stack(self.generate_contact_sequences(self.num_gait_samples, current_contacts))
             
-            # Add gait stability cost
-            stability_cost = self.evaluate_sequence_stability(sequence, state)
-            total_cost = cost + stability_cost * self.gait_stability_weight
+            # Optimize the forces of every candidate sequence in one call
+            *best_result, best_sequence, best_gait = self.jitted_compute_control_gaits(state, reference, current_contacts,
+                                                                                       jnp.array(candidate_sequences),
+                                                                                       best_control_parameters, key, sigma,
+                                                                                       timing, nominal_step_frequency, optimize_swing)
             
-            # Track best result
-            if total_cost < best_cost:
-                best_cost = total_cost
-                best_result = (nmpc_GRFs, nmpc_footholds, predicted_state, parameters, cost, freq, costs)
-                best_sequence = sequence
+            if self.gait_bank is not None:
+                # The selected sequence stays in the bank
+                self.gait_bank.promote(self.leg_states, self.leg_timers, candidate_sequences[int(best_gait)])
         
         # Store the best sequence for future use
-        self.best_sequence = best_sequence
-        self.current_contacts = best_sequence[:, 0]
-        
-        return best_result
-    
-    # def compute_control(self, state, reference, contact_sequence, best_control_parameters, key, *args, **kwargs):
-    def compute_control(self, state, reference, contact_sequence, best_control_parameters, key, timing, nominal_step_frequency, optimize_swing):    
-        """Main entry point for control computation
-        
-        This redirects to our gait-optimizing version instead of the standard one
-        """
-        print("ENTERING GAIT-OPTIMIZING MPPI..........................")
-        # Use current contacts from the provided sequence (first timestep)
-        current_contacts = contact_sequence[:, 0] if contact_sequence is not None else None
+        self.best_sequence = np.asarray(best_sequence)
+        self.current_contacts = self.best_sequence[:, 0]
         
-        # Call our custom implementation 
-        return self.compute_control_mppi_with_gait(state, reference, current_contacts, best_control_parameters, key)
\ No newline at end of file
+        return tuple(best_result)
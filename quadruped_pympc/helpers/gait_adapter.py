@@ -19,7 +19,8 @@ class GaitAdapter:
                  gait_type: GaitType, 
                  horizon: int,
                  use_random_gait: bool = False,
-                 random_gait_params: Optional[GaitParameters] = None):
+                 random_gait_params: Optional[GaitParameters] = None,
+                 random_gait_dt: Optional[float] = None):
         """Initialize the gait adapter
         
         Args:
@@ -29,11 +30,13 @@ class GaitAdapter:
             horizon: Prediction horizon length
             use_random_gait: Whether to use random gait generation
             random_gait_params: Parameters for random gait generator
+            random_gait_dt: Timestep of the random sequences, None for a tenth of the gait period
         """
         self.use_random_gait = use_random_gait
         self.horizon = horizon
         self.duty_factor = duty_factor
         self.step_freq = step_freq
+        self.random_gait_dt = random_gait_dt
         
         # Initialize both generators
         self.periodic_generator = PeriodicGaitGenerator(
@@ -78,8 +81,10 @@ class GaitAdapter:
             contact_sequence: Binary contact sequence for all legs
         """
         if self.use_random_gait:
-            # For random gait, we use a uniform dt based on step frequency
-            dt = 1.0 / (self.step_freq * 10) if self.step_freq > 0 else 0.02
+            # For random gait, we use a uniform dt based on step frequency (unless given)
+            dt = self.random_gait_dt
+            if dt is None:
+                dt = 1.0 / (self.step_freq * 10) if self.step_freq > 0 else 0.02
             sequence = self.random_generator.generate_contact_sequence(
                 horizon=self.horizon,
                 dt=dt,
@@ -0,0 +1,137 @@
+import numpy as np
+from collections import OrderedDict
+from typing import Callable
+
+class GaitBank:
+    """Stores feasible contact sequences as packed bitmasks, indexed by the phase of the legs
+
+    The sequences generated from a phase (contact state and steps spent in it by each leg) are
+    feasible again whenever the legs are back in that phase, hence they are served by lookup
+    instead of being generated again. Each sequence is stored once (by the hash of its bits),
+    and both the phases and their sequences are evicted least recently used first.
+    """
+
+    def __init__(self, horizon: int, max_phases: int = 64, max_sequences_per_phase: int = 64, timer_cap: int = 64):
+        """Initialize the bank
+
+        Args:
+            horizon: Number of timesteps of the sequences
+            max_phases: Number of phases kept in the bank
+            max_sequences_per_phase: Number of sequences kept for each phase
+            timer_cap: Leg timers are clipped to it in the index, as longer times do not change the feasible sequences
+                (in steps of the generator, as the timers)
+        """
+        self.n_legs = 4
+        self.horizon = horizon
+        self.max_phases = max_phases
+        self.max_sequences_per_phase = max_sequences_per_phase
+        self.timer_cap = timer_cap
+
+        # phase key -> (sequence hash -> packed sequence), both in least recently used order
+        self.phases = OrderedDict()
+
+    def pack(self, sequence: np.ndarray) -> np.ndarray:
+        """Pack a (4, horizon) binary sequence into a (4, ceil(horizon/8)) uint8 bitmask"""
+        return np.packbits(np.asarray(sequence) > 0.5, axis=1)
+
+    def unpack(self, packed: np.ndarray) -> np.ndarray:
+        """Unpack a bitmask into a (4, horizon) binary sequence"""
+        return np.unpackbits(packed, axis=1, count=self.horizon).astype(np.float64)
+
+    def get_phase_key(self, leg_states: np.ndarray, leg_timers: np.ndarray) -> tuple:
+        """Index of the bank: contact state and (clipped) timer of each leg
+
+        The timers are in steps of the generator, and can be fractional when a control tick is shorter
+        than a step. The generator compares them with whole numbers of steps, so timers with the same
+        floor give the same sequences and share the key.
+        """
+        leg_states = np.asarray(leg_states).astype(int)
+        leg_timers = np.floor(np.minimum(np.asarray(leg_timers), self.timer_cap)).astype(int)
+        return tuple(leg_states) + tuple(leg_timers)
+
+    def __len__(self):
+        return sum(len(sequences) for sequences in self.phases.values())
+
+    def _get_phase(self, phase_key: tuple) -> OrderedDict:
+        """Sequences of a phase, creating it (and evicting the oldest phase) if needed"""
+        if phase_key not in self.phases:
+            self.phases[phase_key] = OrderedDict()
+            if len(self.phases) > self.max_phases:
+                self.phases.popitem(last=False)
+        self.phases.move_to_end(phase_key)
+        return self.phases[phase_key]
+
+    def add(self, leg_states: np.ndarray, leg_timers: np.ndarray, sequences: np.ndarray) -> int:
+        """Store sequences generated from the given phase
+
+        Args:
+            leg_states: Contact state of the legs the sequences start from
+            leg_timers: Steps spent by the legs in their state
+            sequences: Sequences of shape (num_sequences, 4, horizon)
+
+        Returns:
+            Number of sequences that were not in the bank
+        """
+        stored = self._get_phase(self.get_phase_key(leg_states, leg_timers))
+        num_new = 0
+        for sequence in sequences:
+            num_new += self._store(stored, self.pack(sequence))
+        return num_new
+
+    def _store(self, stored: OrderedDict, packed: np.ndarray) -> bool:
+        """Store a packed sequence as the most recently used of its phase, returns whether it is new"""
+        sequence_hash = packed.tobytes()
+        is_new = sequence_hash not in stored
+        stored[sequence_hash] = packed
+        stored.move_to_end(sequence_hash)
+        if len(stored) > self.max_sequences_per_phase:
+            stored.popitem(last=False)
+        return is_new
+
+    def get_candidates(self,
+                       leg_states: np.ndarray,
+                       leg_timers: np.ndarray,
+                       num_candidates: int,
+                       num_fresh: int,
+                       generate_fun: Callable[[int], np.ndarray]) -> np.ndarray:
+        """Serve candidate sequences for the given phase: the most recently used ones of the bank plus
+        num_fresh new samples for exploration (all new samples if the bank has too few)
+
+        Args:
+            leg_states: Current contact state of the legs
+            leg_timers: Steps already spent by the legs in their current state
+            num_candidates: Number of candidates
+            num_fresh: Number of new samples
+            generate_fun: Generates the given number of sequences from the phase, of shape (num, 4, horizon)
+
+        Returns:
+            Candidates of shape (num_candidates, 4, horizon), without repetitions unless the bank and
+            the new samples together have fewer distinct sequences
+        """
+        stored = self._get_phase(self.get_phase_key(leg_states, leg_timers))
+        if len(stored) < num_candidates - num_fresh:
+            num_fresh = num_candidates
+
+        # The new samples first, then the most recently used sequences of the bank that are not among them
+        candidates = OrderedDict()
+        for sequence in np.asarray(generate_fun(num_fresh)):
+            packed = self.pack(sequence)
+            candidates.setdefault(packed.tobytes(), packed)
+        for sequence_hash in reversed(stored):
+            if len(candidates) >= num_candidates:
+                break
+            candidates.setdefault(sequence_hash, stored[sequence_hash])
+        candidates = list(candidates.values())[:num_candidates]
+        for packed in candidates:
+            self._store(stored, packed)
+
+        # Fixed number of candidates (for the compiled solve), padding with repetitions if needed
+        return np.stack([self.unpack(candidates[i % len(candidates)]) for i in range(num_candidates)])
+
+    def promote(self, leg_states: np.ndarray, leg_timers: np.ndarray, sequence: np.ndarray):
+        """Mark a sequence (e.g. the selected one) as the most recently used of its phase"""
+        self.add(leg_states, leg_timers, sequence[None])
+
+    def reset(self):
+        """Empty the bank"""
+        self.phases.clear()
@@ -0,0 +1,93 @@
+import os
+import warnings
+
+import jax
+from jax.experimental.compilation_cache import compilation_cache
+
+
+# Folder of the persistent compilation cache of this process, None if not enabled
+_compilation_cache_dir = None
+
+
+def enable_persistent_compilation_cache(cache_dir):
+    """Store the XLA executables on disk, so that a new process loads them instead of compiling again.
+
+    The folder is set once per process: the cache keys already include the shapes of the arguments, so
+    all the controllers (and their configurations) share it, and the next calls only return it.
+
+    Args:
+        cache_dir (str): folder of the cache, if None the persistent cache is not enabled
+
+    Returns:
+        str: folder where the executables are stored, None if the persistent cache is not used
+    """
+
+    global _compilation_cache_dir
+
+    if cache_dir is None or _compilation_cache_dir is not None:
+        if cache_dir is not None and os.path.expanduser(cache_dir) != _compilation_cache_dir:
+            warnings.warn(f"the compilation cache is already stored in {_compilation_cache_dir}, {cache_dir} is not used")
+        return _compilation_cache_dir
+
+    path = os.path.expanduser(cache_dir)
+    os.makedirs(path, exist_ok=True)
+
+    jax.config.update('jax_compilation_cache_dir', path)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+    jax.config.update('jax_persistent_cache_min_entry_size_bytes', 0)
+
+    # jax initializes the cache at its first compilation, this makes it pick up the folder if something was compiled before
+    compilation_cache.reset_cache()
+
+    _compilation_cache_dir = path
+    return path
+
+
+def configure_host_devices(num_devices):
+    """Split the host CPU in several jax devices, e.g. to shard the samples of the sampling controller
+    (num_sampling_devices). This works only before jax is initialized, hence the entry script calls it
+    before creating the controller.
+
+    Args:
+        num_devices (int): number of CPU devices, 1 keeps the default of jax
+
+    Returns:
+        bool: True if the CPU devices are set, False if jax was already initialized
+    """
+
+    if num_devices <= 1:
+        return True
+
+    try:
+        jax.config.update('jax_num_cpu_devices', num_devices)
+    except RuntimeError:
+        warnings.warn(f"jax is already initialized, the host CPU cannot be split in {num_devices} devices")
+        return False
+    return True
+
+
+class AOTCompiledFunction:
+    """A jitted function that is lowered and compiled ahead of time for some example arguments.
+
+    The calls are dispatched to the compiled executable, hence the first call does not trigger
+    any compilation. If the arguments do not match the ones used for the compilation (or if the
+    function is called while tracing), it falls back to the jitted function, which compiles again:
+    the first fallback is reported with a warning.
+    """
+
+    def __init__(self, jitted_fun, *example_args):
+        self.jitted_fun = jitted_fun
+        self.compiled_fun = jitted_fun.lower(*example_args).compile()
+        self.fallback_reported = False
+
+    def __call__(self, *args):
+        try:
+            return self.compiled_fun(*args)
+        except TypeError as error:
+            if not self.fallback_reported:
+                warnings.warn(f"the arguments do not match the ahead-of-time compiled function, the jitted one is used: {error}")
+                self.fallback_reported = True
+            return self.jitted_fun(*args)
+
+    def lower(self, *args):
+        return self.jitted_fun.lower(*args)
@@ -46,6 +46,8 @@ class PeriodicGaitGenerator:
         self.time_before_switch_freq = 0
 
     def run(self, dt, new_step_freq):
+        # duty_factor can be given per leg (e.g. optimized by the sampling controller)
+        duty_factor = np.broadcast_to(self.duty_factor, (self.n_contact,))
         contact = np.zeros(self.n_contact)
         for leg in range(self.n_contact):
 
@@ -69,7 +71,7 @@ class PeriodicGaitGenerator:
             else:
                 # During the gait, we check if the time is below the duty factor
                 # if so, the contact is 1, otherwise it is 0
-                if self._phase_signal[leg] < self.duty_factor:
+                if self._phase_signal[leg] < duty_factor[leg]:
                     contact[leg] = 1
                 else:
                     contact[leg] = 0
@@ -65,7 +65,12 @@ class PeriodicGaitGeneratorJax:
         return contact, t"""
     
 
-    def run(self, t, step_freq):
+    def run(self, t, step_freq, duty_factor=None):
+        # duty_factor can be given per leg, otherwise the one of the gait is used
+        if(duty_factor is None):
+            duty_factor = self.duty_factor
+        duty_factor = jnp.broadcast_to(duty_factor, (self.n_contact,))
+
         contact = jnp.zeros(self.n_contact)
         #for leg in range(self.n_contact):
             
@@ -83,10 +88,10 @@ class PeriodicGaitGeneratorJax:
         t = t.at[2].set(t[2] + self.mpc_dt*step_freq)
         t = t.at[3].set(t[3] + self.mpc_dt*step_freq)
 
-        contact = contact.at[0].set(jnp.where(t[0] < self.duty_factor, 1.0, 0.0))
-        contact = contact.at[1].set(jnp.where(t[1] < self.duty_factor, 1.0, 0.0))
-        contact = contact.at[2].set(jnp.where(t[2] < self.duty_factor, 1.0, 0.0))
-        contact = contact.at[3].set(jnp.where(t[3] < self.duty_factor, 1.0, 0.0))
+        contact = contact.at[0].set(jnp.where(t[0] < duty_factor[0], 1.0, 0.0))
+        contact = contact.at[1].set(jnp.where(t[1] < duty_factor[1], 1.0, 0.0))
+        contact = contact.at[2].set(jnp.where(t[2] < duty_factor[2], 1.0, 0.0))
+        contact = contact.at[3].set(jnp.where(t[3] < duty_factor[3], 1.0, 0.0))
 
         
 
@@ -139,7 +144,7 @@ class PeriodicGaitGeneratorJax:
 
         return contact_sequence, new_t"""
     
-    def compute_contact_sequence(self, simulation_dt, t, step_freq):
+    def compute_contact_sequence(self, simulation_dt, t, step_freq, duty_factor=None):
         t_init = jnp.array(t)
         
         contact_sequence = jnp.zeros((self.n_contact, self.horizon))
@@ -149,7 +154,7 @@ class PeriodicGaitGeneratorJax:
         
         def body_fn(n, carry):
             new_t, contact_sequence = carry
-            new_contact_sequence, new_t = self.run(new_t, step_freq)
+            new_contact_sequence, new_t = self.run(new_t, step_freq, duty_factor)
             contact_sequence = contact_sequence.at[:, n].set(new_contact_sequence)
             return (new_t, contact_sequence)#, None
 
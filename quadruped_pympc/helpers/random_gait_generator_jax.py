@@ -0,0 +1,108 @@
+import jax
+import jax.numpy as jnp
+from typing import Optional
+
+from quadruped_pympc.helpers.random_gait_generator import GaitParameters
+
+class RandomGaitGeneratorJax:
+    """Generates random but feasible gait patterns in JAX, many candidates at once
+
+    The phase of the legs (state and steps spent in it) is an explicit input, so the
+    generator can run inside a jitted controller instead of on the host.
+    """
+
+    def __init__(self, horizon: int, dt: float, params: Optional[GaitParameters] = None, swing_probability: float = 0.3):
+        """Initialize the generator
+
+        Args:
+            horizon: Number of timesteps to generate
+            dt: Timestep duration
+            params: Gait constraints
+            swing_probability: Chance that a leg allowed to swing starts it at each step
+        """
+        self.params = params or GaitParameters()
+        self.n_legs = 4
+        self.horizon = horizon
+        self.dt = dt
+        self.swing_probability = swing_probability
+
+        # Convert time constraints to steps
+        self.min_stance_steps = int(self.params.min_stance_duration / dt)
+        self.max_stance_steps = int(self.params.max_stance_duration / dt)
+        self.min_swing_steps = int(self.params.min_swing_duration / dt)
+        self.max_swing_steps = int(self.params.max_swing_duration / dt)
+
+    def get_initial_phase(self, current_contacts=None):
+        """Phase of the legs at the start: all in stance (or current_contacts), with zero steps spent in it"""
+        if current_contacts is None:
+            leg_states = jnp.ones(self.n_legs)
+        else:
+            leg_states = jnp.asarray(current_contacts, dtype=jnp.float32)
+        return leg_states, jnp.zeros(self.n_legs)
+
+    def _can_start_swing(self, leg_states, leg_idx: int):
+        """Check if transitioning leg to swing maintains stability"""
+        # Keep diagonal leg coordination (avoids flying phases): don't swing both diagonal legs
+        if self.params.enforce_diagonal_coordination:
+            return leg_states[3-leg_idx] != 0
+        return jnp.bool_(True)
+
+    def step(self, leg_states, leg_timers, random_values):
+        """Advance the phase of the legs by one timestep
+
+        The legs are updated one after the other, as the diagonal coordination looks at
+        the new state of the legs already updated in this timestep.
+
+        Args:
+            leg_states: Contact state of the legs (1=stance, 0=swing)
+            leg_timers: Steps spent by the legs in their state
+            random_values: Uniform samples deciding the lift-offs, one per leg
+
+        Returns:
+            leg_states, leg_timers after the timestep
+        """
+        for leg in range(self.n_legs):
+            in_stance = leg_states[leg] == 1
+
+            # Lift-off after the minimum stance, at random or when the maximum stance is reached
+            lift_off = in_stance & (leg_timers[leg] >= self.min_stance_steps) & self._can_start_swing(leg_states, leg) & \
+                       ((random_values[leg] < self.swing_probability) | (leg_timers[leg] >= self.max_stance_steps))
+
+            # Touch-down after the minimum swing (which is within the maximum one)
+            touch_down = ~in_stance & (leg_timers[leg] >= self.min_swing_steps)
+
+            leg_states = leg_states.at[leg].set(jnp.where(lift_off, 0.0, jnp.where(touch_down, 1.0, leg_states[leg])))
+            leg_timers = leg_timers.at[leg].set(jnp.where(lift_off | touch_down, 0.0, leg_timers[leg]) + 1)
+
+        return leg_states, leg_timers
+
+    def compute_contact_sequence(self, key, leg_states, leg_timers):
+        """Generate a random but feasible contact sequence with a lax.scan over the horizon
+
+        Args:
+            key: JAX random key
+            leg_states: Current contact state of the legs
+            leg_timers: Steps already spent by the legs in their current state
+
+        Returns:
+            contact_sequence: Array of shape (4, horizon) with binary contact states
+            timer_sequence: Array of shape (4, horizon) with the steps spent in the state after each timestep
+        """
+        random_values = jax.random.uniform(key, (self.horizon, self.n_legs))
+
+        def body_fn(carry, random_values_step):
+            carry = self.step(*carry, random_values_step)
+            return carry, carry
+
+        _, (states, timers) = jax.lax.scan(body_fn, (jnp.asarray(leg_states, dtype=jnp.float32),
+                                                     jnp.asarray(leg_timers, dtype=jnp.float32)), random_values)
+        return states.T, timers.T
+
+    def compute_contact_sequences(self, key, leg_states, leg_timers, num_sequences: int):
+        """Generate num_sequences candidate contact sequences from the same phase, vmapped over the candidates
+
+        Returns:
+            contact_sequences, timer_sequences: Arrays of shape (num_sequences, 4, horizon)
+        """
+        keys = jax.random.split(key, num_sequences)
+        return jax.vmap(self.compute_contact_sequence, in_axes=(0, None, None))(keys, leg_states, leg_timers)
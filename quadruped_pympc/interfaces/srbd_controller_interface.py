@@ -20,6 +20,10 @@ class SRBDControllerInterface:
         self.use_random_gait = cfg.mpc_params.get('use_random_gait', False)
 
         self.previous_contact_mpc = np.array([1, 1, 1, 1])
+
+        # Gait timing (phase offsets, duty factors and step frequency) optimized by the sampling controller
+        # at the last tick, to be applied to the periodic gait generator (None if not optimized)
+        self.best_timing_parameters = None
         
         # 'nominal' optimized directly the GRF
         # 'input_rates' optimizes the delta GRF
@@ -114,54 +118,9 @@ class SRBDControllerInterface:
        
         # If we use sampling
         if (self.type == 'sampling'):
-
-            # Convert data to jax and shift previous solution
-            state_current_jax, \
-            reference_state_jax, = self.controller.prepare_state_and_reference(state_current,
-                                                                            ref_state,
-                                                                            current_contact,
-                                                                            self.previous_contact_mpc)
-            self.previous_contact_mpc = current_contact
-
-            for iter_sampling in range(self.controller.num_sampling_iterations):
-                self.controller = self.controller.with_newkey()
-                if (self.controller.sampling_method == 'cem_mppi'):
-                    if (iter_sampling == 0):
-                        self.controller = self.controller.with_newsigma(cfg.mpc_params['sigma_cem_mppi'])
-
-                    nmpc_GRFs, \
-                    nmpc_footholds, \
-                    nmpc_predicted_state,\
-                    self.controller.best_control_parameters, \
-                    best_cost, \
-                    best_sample_freq, \
-                    costs, \
-                    sigma_cem_mppi = self.controller.jitted_compute_control(state_current_jax, reference_state_jax,
-                                                                contact_sequence, self.controller.best_control_parameters,
-                                                                self.controller.master_key, self.controller.sigma_cem_mppi)
-                    self.controller = self.controller.with_newsigma(sigma_cem_mppi)
-                else:
-                    nominal_sample_freq = pgg_step_freq
-                    nmpc_GRFs, \
-                    nmpc_footholds, \
-                    nmpc_predicted_state,\
-                    self.controller.best_control_parameters, \
-                    best_cost, \
-                    best_sample_freq, \
-                    costs = self.controller.jitted_compute_control(state_current_jax, reference_state_jax,
-                                                        contact_sequence, self.controller.best_control_parameters,
-                                                        self.controller.master_key, pgg_phase_signal,
-                                                        nominal_sample_freq, optimize_swing)
-
-            nmpc_footholds = LegsAttr(FL=ref_state["ref_foot_FL"][0],
-                                        FR=ref_state["ref_foot_FR"][0],
-                                        RL=ref_state["ref_foot_RL"][0],
-                                        RR=ref_state["ref_foot_RR"][0])
-            nmpc_GRFs = np.array(nmpc_GRFs)
-            
-            nmpc_joints_pos = None
-            nmpc_joints_vel = None
-            nmpc_joints_acc = None
+            pending_control = self.dispatch_sampling_control(state_current, ref_state, contact_sequence,
+                                                             pgg_phase_signal, pgg_step_freq, optimize_swing)
+            return self.collect_sampling_control(pending_control)
 
         # If we use Gradient-Based MPC
         else:
@@ -233,6 +192,178 @@ class SRBDControllerInterface:
         return nmpc_GRFs, nmpc_footholds, nmpc_joints_pos, nmpc_joints_vel, nmpc_joints_acc, best_sample_freq, nmpc_predicted_state
     
 
+    def dispatch_sampling_control(self, 
+                                  state_current: dict,
+                                  ref_state: dict,
+                                  contact_sequence: np.ndarray,
+                                  pgg_phase_signal: np.ndarray,
+                                  pgg_step_freq: float,
+                                  optimize_swing: int) -> dict:
+        """Launch the sampling controller without waiting for its result. Jax dispatches the computation 
+        asynchronously, so the returned outputs are still being computed on the device.
+
+        Args:
+            state_current (dict): The current state of the robot
+            ref_state (dict): The reference state of the robot
+            contact_sequence (np.ndarray): The contact sequence of the robot
+            pgg_phase_signal (np.ndarray): The periodic gait generator phase signal of the legs (from 0 to 1)
+            pgg_step_freq (float): The step frequency of the periodic gait generator
+            optimize_swing (int): The flag to optimize the swing
+
+        Returns:
+            dict: The pending outputs of the controller, to be passed to collect_sampling_control
+        """
+
+        current_contact = np.array([contact_sequence[0][0],
+                                    contact_sequence[1][0],
+                                    contact_sequence[2][0],
+                                    contact_sequence[3][0]])
+        best_timing_parameters = None
+
+        if getattr(self.controller, 'use_fused_control_tick', False):
+
+            # The whole tick runs in a single jitted call, the solver state stays on the device
+            nmpc_GRFs, \
+            nmpc_footholds, \
+            nmpc_predicted_state, \
+            best_cost, \
+            best_sample_freq, \
+            costs = self.controller.compute_control_tick(state_current, ref_state, current_contact,
+                                                         self.previous_contact_mpc, contact_sequence,
+                                                         pgg_phase_signal, pgg_step_freq, optimize_swing)
+            self.previous_contact_mpc = current_contact
+
+        else:
+
+            # Convert data to jax and shift previous solution
+            state_current_jax, \
+            reference_state_jax, = self.controller.prepare_state_and_reference(state_current,
+                                                                            ref_state,
+                                                                            current_contact,
+                                                                            self.previous_contact_mpc)
+            self.previous_contact_mpc = current_contact
+
+            if getattr(self.controller, 'optimize_gait_timing', False):
+                # Forces and gait timing are sampled together, all the iterations run inside a single compiled lax.scan.
+                # The optimized step frequency is returned as best_sample_freq, the phase offsets and duty factors
+                # are handed over to the periodic gait generator (see collect_sampling_control)
+                self.controller = self.controller.with_newkey()
+                nmpc_GRFs, \
+                nmpc_footholds, \
+                nmpc_predicted_state, \
+                self.controller.best_control_parameters, \
+                best_cost, \
+                best_sample_freq, \
+                costs, \
+                best_timing_parameters, \
+                _, \
+                self.controller.predicted_trajectory, \
+                _ = self.controller.jitted_compute_control_gait_timing(state_current_jax, reference_state_jax, current_contact,
+                                                                      self.controller.best_control_parameters, 
+                                                                      self.controller.best_timing_parameters,
+                                                                      self.controller.master_key, pgg_phase_signal)
+
+                # Once applied to the periodic gait generator, the phase offsets are part of pgg_phase_signal
+                self.controller.best_timing_parameters = best_timing_parameters.at[0:4].set(0.)
+
+            elif hasattr(self.controller, 'jitted_compute_control_iterations'):
+                # All the sampling iterations run inside a single compiled lax.scan
+                # (sigma is used only by CEM-MPPI, whose covariance is carried from one tick to the next)
+                self.controller = self.controller.with_newkey()
+                sigma = self.controller.sigma_cem_mppi if self.controller.sampling_method == 'cem_mppi' else None
+
+                nmpc_GRFs, \
+                nmpc_footholds, \
+                nmpc_predicted_state, \
+                self.controller.best_control_parameters, \
+                best_cost, \
+                best_sample_freq, \
+                costs, \
+                sigma, \
+                self.controller.predicted_trajectory, \
+                _ = self.controller.jitted_compute_control_iterations(state_current_jax, reference_state_jax,
+                                                                    contact_sequence, self.controller.best_control_parameters,
+                                                                    self.controller.master_key, sigma,
+                                                                    pgg_phase_signal, pgg_step_freq, optimize_swing)
+                if (self.controller.sampling_method == 'cem_mppi'):
+                    self.controller = self.controller.with_newsigma(sigma)
+
+            else:
+                # The gait-adaptive sampling controller still loops over the iterations in python
+                for iter_sampling in range(self.controller.num_sampling_iterations):
+                    self.controller = self.controller.with_newkey()
+                    if (self.controller.sampling_method == 'cem_mppi'):
+                        if (iter_sampling == 0):
+                            self.controller = self.controller.with_newsigma(cfg.mpc_params['sigma_cem_mppi'])
+
+                        nmpc_GRFs, \
+                        nmpc_footholds, \
+                        nmpc_predicted_state,\
+                        self.controller.best_control_parameters, \
+                        best_cost, \
+                        best_sample_freq, \
+                        costs, \
+                        sigma_cem_mppi = self.controller.jitted_compute_control(state_current_jax, reference_state_jax,
+                                                                    contact_sequence, self.controller.best_control_parameters,
+                                                                    self.controller.master_key, self.controller.sigma_cem_mppi)
+                        self.controller = self.controller.with_newsigma(sigma_cem_mppi)
+                    else:
+                        nominal_sample_freq = pgg_step_freq
+                        nmpc_GRFs, \
+                        nmpc_footholds, \
+                        nmpc_predicted_state,\
+                        self.controller.best_control_parameters, \
+                        best_cost, \
+                        best_sample_freq, \
+                        costs = self.controller.jitted_compute_control(state_current_jax, reference_state_jax,
+                                                            contact_sequence, self.controller.best_control_parameters,
+                                                            self.controller.master_key, pgg_phase_signal,
+                                                            nominal_sample_freq, optimize_swing)
+
+        nmpc_footholds = LegsAttr(FL=ref_state["ref_foot_FL"][0],
+                                    FR=ref_state["ref_foot_FR"][0],
+                                    RL=ref_state["ref_foot_RL"][0],
+                                    RR=ref_state["ref_foot_RR"][0])
+
+        return {'nmpc_GRFs': nmpc_GRFs,
+                'nmpc_footholds': nmpc_footholds,
+                'nmpc_predicted_state': nmpc_predicted_state,
+                'best_sample_freq': best_sample_freq,
+                'best_timing_parameters': best_timing_parameters,
+                'current_contact': current_contact}
+    
+
+    def is_sampling_control_ready(self, pending_control: dict) -> bool:
+        """Check, without blocking, if the device has finished computing the pending outputs."""
+
+        # The outputs computed on the device are jax arrays, the other entries are always ready
+        device_outputs = (pending_control['nmpc_GRFs'], pending_control['nmpc_predicted_state'], pending_control['best_sample_freq'])
+        return all(output.is_ready() for output in device_outputs if hasattr(output, 'is_ready'))
+
+
+    def collect_sampling_control(self, pending_control: dict) -> [LegsAttr, LegsAttr, LegsAttr, LegsAttr, LegsAttr, float]:
+        """Wait for the pending outputs of dispatch_sampling_control and convert them as compute_control does.
+
+        Args:
+            pending_control (dict): The pending outputs of the controller
+
+        Returns:
+            tuple: The GRFs and the feet positions in world frame, and the best sample frequency
+        """
+
+        current_contact = pending_control['current_contact']
+        if(pending_control['best_timing_parameters'] is not None):
+            self.best_timing_parameters = np.array(pending_control['best_timing_parameters'])
+        nmpc_GRFs = np.array(pending_control['nmpc_GRFs'])
+        nmpc_GRFs = LegsAttr(FL=nmpc_GRFs[0:3] * current_contact[0],
+                                FR=nmpc_GRFs[3:6] * current_contact[1],
+                                RL=nmpc_GRFs[6:9] * current_contact[2],
+                                RR=nmpc_GRFs[9:12] * current_contact[3])
+
+        return nmpc_GRFs, pending_control['nmpc_footholds'], None, None, None, \
+               pending_control['best_sample_freq'], pending_control['nmpc_predicted_state']
+    
+
     def compute_RTI(self):
         self.controller.acados_ocp_solver.options_set('rti_phase', 1)
         self.controller.acados_ocp_solver.solve()
@@ -74,6 +74,12 @@ class WBInterface:
                                         generator=swing_generator)
 
 
+        # Gait timing optimized by the sampling controller (see apply_gait_timing): phase drift of each leg 
+        # from the nominal phase, and duty factors waiting for the apex of the swing
+        self.gait_phase_drift = np.zeros(4)
+        self.pending_duty_factors = None
+
+
         # Terrain estimator -----------------------------------------------------------------------
         self.terrain_computation = TerrainEstimator()
 
@@ -331,7 +337,7 @@ class WBInterface:
         # -------------------------------------------------------------------------------------------------
 
 
-        if(cfg.mpc_params['optimize_step_freq']):
+        if(cfg.mpc_params['optimize_step_freq'] or cfg.mpc_params.get('optimize_gait_timing', False)):
             # we can always optimize the step freq, or just at the apex of the swing
             # to avoid possible jittering in the solution
             optimize_swing = self.stc.check_apex_condition(self.current_contact)
@@ -388,10 +394,14 @@ class WBInterface:
         
 
         # If we have optimized the gait, we set all the timing parameters
+        # (a single swing period for all the legs, from their mean duty factor if it is given per leg)
         if (optimize_swing == 1):
+            if(self.pending_duty_factors is not None):
+                self.pgg.duty_factor = self.pending_duty_factors
+                self.pending_duty_factors = None
             self.pgg.step_freq = np.array([best_sample_freq])[0]
-            self.frg.stance_time = (1 / self.pgg.step_freq) * self.pgg.duty_factor
-            swing_period = (1 - self.pgg.duty_factor) * (1 / self.pgg.step_freq)
+            self.frg.stance_time = (1 / self.pgg.step_freq) * np.mean(self.pgg.duty_factor)
+            swing_period = (1 - np.mean(self.pgg.duty_factor)) * (1 / self.pgg.step_freq)
             self.stc.regenerate_swing_trajectory_generator(step_height=self.step_height, swing_period=swing_period)
         
         
@@ -504,6 +514,26 @@ class WBInterface:
     
 
 
+    def apply_gait_timing(self,
+                          phase_offsets: np.ndarray,
+                          duty_factors: np.ndarray):
+        """Shift the phase of the legs of the periodic gait generator, as optimized by the sampling controller,
+        at most gait_timing_max_phase_drift away from the nominal phase. The duty factors change the swing period,
+        so they wait for the apex of the swing to be applied with the step frequency (best_sample_freq)
+
+        Args:
+            phase_offsets (np.ndarray): phase offset of each leg, as a fraction of the gait cycle
+            duty_factors (np.ndarray): duty factor of each leg
+        """
+
+        max_phase_drift = cfg.mpc_params.get('gait_timing_max_phase_drift', 0.25)
+        phase_drift = np.clip(self.gait_phase_drift + phase_offsets, -max_phase_drift, max_phase_drift)
+        self.pgg.set_phase_signal((self.pgg.phase_signal + phase_drift - self.gait_phase_drift) % 1.0, self.pgg._init)
+        self.gait_phase_drift = phase_drift
+        self.pending_duty_factors = np.array(duty_factors)
+
+
+
     def reset(self, 
               initial_feet_pos: LegsAttr):
         """Reset the whole body interface
@@ -520,4 +550,6 @@ class WBInterface:
         if(cfg.simulation_params['visual_foothold_adaptation'] != 'blind'):
             self.vfa.reset()
         self.current_contact = np.array([1, 1, 1, 1])
+        self.gait_phase_drift = np.zeros(4)
+        self.pending_duty_factors = None
         return
\ No newline at end of file
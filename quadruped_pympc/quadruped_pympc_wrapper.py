@@ -49,6 +49,12 @@ class QuadrupedPyMPC_Wrapper:
                                         RL=np.zeros(3), RR=np.zeros(3))
         self.nmpc_predicted_state = np.zeros(12)
         self.best_sample_freq = self.wb_interface.pgg.step_freq
+
+        # Asynchronous dispatch of the sampling mpc: solve in flight and number of mpc ticks since its launch
+        self.use_async_mpc_dispatch = cfg.mpc_params['type'] == 'sampling' and cfg.mpc_params.get('use_async_mpc_dispatch', False)
+        self.async_mpc_max_staleness = cfg.mpc_params.get('async_mpc_max_staleness', 1)
+        self.pending_mpc_control = None
+        self.pending_mpc_age = 0
         
 
         self.quadrupedpympc_observables_names = quadrupedpympc_observables_names
@@ -135,7 +141,28 @@ class QuadrupedPyMPC_Wrapper:
 
 
         # Solve OCP ---------------------------------------------------------------------------------------
-        if step_num % round(1 / (self.mpc_frequency * simulation_dt)) == 0:
+        if step_num % round(1 / (self.mpc_frequency * simulation_dt)) == 0 and self.use_async_mpc_dispatch:
+
+            # Swap in the solution in flight if it is ready, or if the previous one is too old
+            if self.pending_mpc_control is not None:
+                self.pending_mpc_age += 1
+                if(self.srbd_controller_interface.is_sampling_control_ready(self.pending_mpc_control) or
+                   self.pending_mpc_age >= self.async_mpc_max_staleness):
+                    self.collect_pending_mpc_control()
+
+            # Launch the next solve from the latest state, the torques use the current solution meanwhile
+            if self.pending_mpc_control is None:
+                self.pending_mpc_control = self.srbd_controller_interface.dispatch_sampling_control(state_current,
+                                                                    ref_state,
+                                                                    contact_sequence,
+                                                                    self.wb_interface.pgg.phase_signal,
+                                                                    self.wb_interface.pgg.step_freq,
+                                                                    optimize_swing)
+                self.pending_mpc_age = 0
+                if self.async_mpc_max_staleness == 0:
+                    self.collect_pending_mpc_control()
+
+        elif step_num % round(1 / (self.mpc_frequency * simulation_dt)) == 0:
 
             self.nmpc_GRFs,  \
             self.nmpc_footholds, \
@@ -151,6 +178,8 @@ class QuadrupedPyMPC_Wrapper:
                                                                     self.wb_interface.pgg.step_freq,
                                                                     optimize_swing)
             
+            self.apply_optimized_gait_timing()
+
             if(cfg.mpc_params['type'] != 'sampling' and cfg.mpc_params['use_RTI']):
                 # If the controller is gradient and is using RTI, we need to linearize the mpc after its computation
                 # this helps to minize the delay between new state->control in a real case scenario.
@@ -234,7 +263,13 @@ class QuadrupedPyMPC_Wrapper:
                 data = {'phase_signal': self.wb_interface.pgg._phase_signal}
             elif obs_name == 'lift_off_positions':
                 data = {'lift_off_positions': self.wb_interface.frg.lift_off_positions}
-            
+            elif obs_name == 'nmpc_predicted_trajectory':
+                # Predicted states and GRFs of the sampling mpc along the horizon
+                data = {'nmpc_predicted_trajectory': getattr(self.srbd_controller_interface.controller, 'predicted_trajectory', None)}
+            elif obs_name == 'anytime_metrics':
+                # Samples and latency of the last tick of the sampling mpc in anytime mode
+                data = {'anytime_metrics': getattr(self.srbd_controller_interface.controller, 'anytime_metrics', {})}
+
             else:
                 data = {}
                 raise ValueError(f"Unknown observable name: {obs_name}")
@@ -246,6 +281,31 @@ class QuadrupedPyMPC_Wrapper:
         
     
 
+    def collect_pending_mpc_control(self,):
+        """ Wait for the solve in flight and use its solution from now on."""
+
+        self.nmpc_GRFs, \
+        self.nmpc_footholds, \
+        self.nmpc_joints_pos, \
+        self.nmpc_joints_vel, \
+        self.nmpc_joints_acc, \
+        self.best_sample_freq, \
+        self.nmpc_predicted_state = self.srbd_controller_interface.collect_sampling_control(self.pending_mpc_control)
+        self.pending_mpc_control = None
+        self.apply_optimized_gait_timing()
+
+
+
+    def apply_optimized_gait_timing(self,):
+        """ Hand the phase offsets and duty factors optimized by the sampling controller, if any, over to the periodic gait generator."""
+
+        best_timing_parameters = self.srbd_controller_interface.best_timing_parameters
+        if best_timing_parameters is not None:
+            self.wb_interface.apply_gait_timing(best_timing_parameters[0:4], best_timing_parameters[4:8])
+            self.srbd_controller_interface.best_timing_parameters = None
+
+
+
     def get_obs(self,) -> dict:
         """ Get some user-defined observables from withing the control loop.
 
@@ -261,6 +321,7 @@ class QuadrupedPyMPC_Wrapper:
         """ Reset the controller."""
 
         self.wb_interface.reset(initial_feet_pos)
+        self.pending_mpc_control = None
         self.srbd_controller_interface.controller.reset()
         
 
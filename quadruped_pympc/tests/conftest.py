@@ -0,0 +1,6 @@
+from quadruped_pympc.helpers.jax_compilation import configure_host_devices
+
+
+def pytest_configure(config):
+    # Two host CPU devices for the sharded sampling test, before any test module uses jax
+    configure_host_devices(2)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from quadruped_pympc.helpers.gait_bank import GaitBank
+
+def _random_sequences(rng, num_sequences, horizon=12):
+    return (rng.random((num_sequences, 4, horizon)) > 0.3).astype(np.float64)
+
+def test_sequences_are_packed_in_bits():
+    bank = GaitBank(horizon=12)
+    sequence = _random_sequences(np.random.default_rng(0), 1)[0]
+
+    packed = bank.pack(sequence)
+    assert packed.dtype == np.uint8
+    assert packed.shape == (4, 2)
+    assert np.array_equal(bank.unpack(packed), sequence)
+
+def test_sequences_are_deduplicated_and_evicted_least_recently_used():
+    bank = GaitBank(horizon=12, max_phases=2, max_sequences_per_phase=3)
+    sequences = _random_sequences(np.random.default_rng(1), 4)
+    phase = (np.ones(4), np.array([1, 2, 3, 4]))
+
+    assert bank.add(*phase, sequences[:2]) == 2
+    assert bank.add(*phase, sequences[:2]) == 0
+    assert len(bank) == 2
+
+    # The first sequence was used again, hence the second one is evicted
+    bank.promote(*phase, sequences[0])
+    bank.add(*phase, sequences[2:4])
+    stored = list(bank.phases[bank.get_phase_key(*phase)])
+    assert stored == [bank.pack(sequence).tobytes() for sequence in sequences[[0, 2, 3]]]
+
+    # Timers beyond the cap give the same phase, a third phase evicts the oldest one
+    assert bank.get_phase_key(np.ones(4), np.array([1, 2, 3, 100])) == bank.get_phase_key(np.ones(4), np.array([1, 2, 3, 64]))
+    bank.add(np.zeros(4), np.ones(4), sequences[:1])
+    bank.add(np.zeros(4), np.ones(4) * 2, sequences[:1])
+    assert bank.get_phase_key(*phase) not in bank.phases
+
+def test_fractional_timers_share_the_key_of_their_whole_steps():
+    bank = GaitBank(horizon=12, timer_cap=10)
+    leg_states = np.ones(4)
+
+    # Half a step later the generator makes the same decisions, a whole step later it may not
+    assert bank.get_phase_key(leg_states, np.full(4, 3.0)) == bank.get_phase_key(leg_states, np.full(4, 3.5))
+    assert bank.get_phase_key(leg_states, np.full(4, 3.5)) != bank.get_phase_key(leg_states, np.full(4, 4.0))
+    assert bank.get_phase_key(leg_states, np.full(4, 10.5)) == bank.get_phase_key(leg_states, np.full(4, 30.0))
+
+def test_candidates_are_served_from_the_bank_plus_fresh_samples():
+    bank = GaitBank(horizon=12)
+    rng = np.random.default_rng(2)
+    requested = []
+    def generate_fun(num_sequences):
+        requested.append(num_sequences)
+        return _random_sequences(rng, num_sequences)
+    phase = (np.ones(4), np.zeros(4))
+
+    # The bank is empty at first, then only the fresh samples are generated
+    first = bank.get_candidates(*phase, 8, 2, generate_fun)
+    second = bank.get_candidates(*phase, 8, 2, generate_fun)
+    assert requested == [8, 2]
+    assert first.shape == second.shape == (8, 4, 12)
+
+    hashes = [bank.pack(sequence).tobytes() for sequence in second]
+    assert len(set(hashes)) == 8
+    assert len(set(hashes) & set(bank.pack(sequence).tobytes() for sequence in first)) == 6
+
+@pytest.mark.parametrize("num_distinct", [1, 3])
+def test_candidates_are_padded_when_too_few_sequences_exist(num_distinct):
+    bank = GaitBank(horizon=12)
+    sequences = _random_sequences(np.random.default_rng(3), num_distinct)
+    generate_fun = lambda num_sequences: sequences[np.arange(num_sequences) % num_distinct]
+
+    candidates = bank.get_candidates(np.ones(4), np.zeros(4), 5, 2, generate_fun)
+    assert candidates.shape == (5, 4, 12)
+    assert len(np.unique(candidates.reshape(5, -1), axis=0)) == num_distinct
@@ -0,0 +1,53 @@
+import numpy as np
+import jax
+import jax.numpy as jnp
+from quadruped_pympc.helpers.random_gait_generator import GaitParameters
+from quadruped_pympc.helpers.random_gait_generator_jax import RandomGaitGeneratorJax
+
+def _complete_periods(sequence, value):
+    """Lengths of the periods of a leg in the given state, excluding the first and the last (possibly cut)"""
+    changes = np.flatnonzero(np.diff(sequence)) + 1
+    bounds = np.concatenate([[0], changes, [len(sequence)]])
+    return [stop - start for start, stop in zip(bounds[1:-2], bounds[2:-1]) if sequence[start] == value]
+
+def test_batched_sequences_respect_the_durations():
+    params = GaitParameters(min_stance_duration=0.1, max_stance_duration=0.2,
+                            min_swing_duration=0.06, max_swing_duration=0.1)
+    generator = RandomGaitGeneratorJax(horizon=60, dt=0.02, params=params)
+    leg_states, leg_timers = generator.get_initial_phase()
+
+    sequences, timers = jax.jit(generator.compute_contact_sequences, static_argnums=3)(jax.random.PRNGKey(0), leg_states, leg_timers, 500)
+    sequences = np.asarray(sequences)
+    assert sequences.shape == (500, 4, 60)
+    assert np.all(np.logical_or(sequences == 0, sequences == 1))
+    assert len(np.unique(sequences.reshape(500, -1), axis=0)) > 1
+
+    for sequence in sequences:
+        for leg in range(4):
+            for duration in _complete_periods(sequence[leg], 1):
+                assert generator.min_stance_steps <= duration <= generator.max_stance_steps
+            for duration in _complete_periods(sequence[leg], 0):
+                assert generator.min_swing_steps <= duration <= generator.max_swing_steps
+
+def test_diagonal_legs_do_not_swing_together():
+    generator = RandomGaitGeneratorJax(horizon=40, dt=0.02, params=GaitParameters(enforce_diagonal_coordination=True))
+    sequences, _ = generator.compute_contact_sequences(jax.random.PRNGKey(1), *generator.get_initial_phase(), 200)
+    sequences = np.asarray(sequences)
+
+    assert np.any(sequences == 0)
+    for leg1, leg2 in [(0, 3), (1, 2)]:  # FL-RR, FR-RL
+        assert not np.any(np.logical_and(sequences[:, leg1] == 0, sequences[:, leg2] == 0))
+
+def test_sequences_continue_from_the_phase_of_the_legs():
+    generator = RandomGaitGeneratorJax(horizon=10, dt=0.02)
+
+    # FL is at the end of its swing, FR just started it
+    leg_states = jnp.array([0.0, 0.0, 1.0, 1.0])
+    leg_timers = jnp.array([generator.min_swing_steps, 1, 0, 0])
+    sequences, timers = generator.compute_contact_sequences(jax.random.PRNGKey(2), leg_states, leg_timers, 50)
+    sequences, timers = np.asarray(sequences), np.asarray(timers)
+
+    assert np.all(sequences[:, 0, 0] == 1)
+    assert np.all(timers[:, 0, 0] == 1)
+    assert np.all(sequences[:, 1, :generator.min_swing_steps - 1] == 0)
+    assert np.all(timers[:, 1, 0] == 2)
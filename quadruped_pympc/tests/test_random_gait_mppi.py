@@ -1,7 +1,11 @@
 import numpy as np
 import matplotlib.pyplot as plt
+import jax
+import jax.numpy as jnp
+from quadruped_pympc import config
 from quadruped_pympc.controllers.sampling.random_gait_mppi import RandomGaitMPPI
 from quadruped_pympc.helpers.quadruped_utils import GaitType
+from quadruped_pympc.helpers.jax_compilation import AOTCompiledFunction
 
 def test_random_gait_mppi_integration():
     """Test that random gait MPPI can be initialized and run"""
@@ -48,5 +52,202 @@ def test_random_gait_mppi_integration():
     plt.tight_layout()
     plt.savefig("random_gait_mppi_sequences.png")
 
+def test_all_gaits_are_solved_in_one_call(monkeypatch):
+    """Test that the vectorized solve picks the gait the per-sequence loop would pick"""
+    
+    monkeypatch.setitem(config.mpc_params, 'num_parallel_computations', 64)
+    monkeypatch.setitem(config.mpc_params, 'num_gait_samples', 4)
+    controller = RandomGaitMPPI()
+    
+    state = jnp.zeros(24).at[2].set(0.27)
+    reference = jnp.zeros(controller.reference_dim).at[2].set(0.3).at[3].set(0.3)
+    key = jax.random.PRNGKey(0)
+    current_contacts = np.array([1.0, 0.0, 1.0, 1.0])
+    sequences = np.stack(controller.generate_contact_sequences(controller.num_gait_samples))
+    
+    *best_result, best_sequence, best_gait = controller.jitted_compute_control_gaits(state, reference, current_contacts, jnp.array(sequences),
+                                                                                     controller.best_control_parameters, key, None,
+                                                                                     None, None, 0)
+    
+    # The current contact comes first, followed by the candidate steps
+    assert np.array_equal(best_sequence[:, 0], current_contacts)
+    assert np.array_equal(best_sequence[:, 1:], sequences[int(best_gait), :, :-1])
+    
+    # One solve per sequence, plus its stability cost
+    total_costs = []
+    for sequence in sequences:
+        sequence = np.concatenate([current_contacts[:, None], sequence[:, :-1]], axis=1)
+        result = controller.compute_control_iterations(state, reference, jnp.array(sequence), controller.best_control_parameters, 
+                                                       key, None, None, None, 0)
+        total_costs.append(float(result[4]) + controller.evaluate_sequence_stability(sequence, state) * controller.gait_stability_weight)
+        if len(total_costs) - 1 == int(best_gait):
+            expected_result = result
+    
+    assert np.isclose(min(total_costs), total_costs[int(best_gait)], rtol=1e-4)
+    assert np.allclose(best_result[0], expected_result[0], atol=1e-3)
+    assert np.allclose(best_result[3], expected_result[3], atol=1e-3)
+
+def _stance_before_lift_off(controller, sequences, leg, stance_ticks):
+    """Seconds the leg stays in stance before its first lift-off in each candidate, after stance_ticks ticks in stance"""
+    tick_period = 1.0 / config.simulation_params['mpc_frequency']
+    durations = []
+    for sequence in sequences:
+        lift_offs = np.flatnonzero(sequence[leg] == 0)
+        if len(lift_offs) > 0:
+            durations.append(stance_ticks * tick_period + lift_offs[0] * controller.dt)
+    return np.array(durations)
+
+def _leg_in_stance_for(controller, stance_ticks):
+    """Phase of the legs after FR swung for 3 ticks, then stayed in stance for stance_ticks ticks"""
+    for tick in range(3):
+        controller.update_leg_phase(np.array([1.0, 0.0, 1.0, 1.0]))
+    for tick in range(stance_ticks):
+        controller.update_leg_phase(np.ones(4))
+
+def test_lift_off_respects_the_minimum_stance_duration(monkeypatch):
+    """Test that the leg timers, counted in ticks, are in the unit of the generator, so a lift-off waits min_stance_duration seconds"""
+    
+    monkeypatch.setitem(config.mpc_params, 'num_parallel_computations', 64)
+    controller = RandomGaitMPPI()
+    min_stance_duration = controller.gait_adapter.random_generator.params.min_stance_duration
+    stance_ticks = 20
+    _leg_in_stance_for(controller, stance_ticks)
+    
+    np.random.seed(0)
+    sequences = controller.generate_contact_sequences(50)
+    durations = _stance_before_lift_off(controller, sequences, 1, stance_ticks)
+    
+    # Some candidates lift FR off within the horizon, none before the minimum stance (up to the rounding to the timestep)
+    assert len(durations) > 0
+    assert np.all(durations >= min_stance_duration - controller.dt)
+
+def test_device_lift_off_respects_the_minimum_stance_duration(monkeypatch):
+    """Test that the candidates generated on the device wait min_stance_duration seconds before a lift-off"""
+    
+    monkeypatch.setitem(config.mpc_params, 'num_parallel_computations', 64)
+    controller = RandomGaitMPPI()
+    min_stance_duration = controller.gait_adapter.random_generator.params.min_stance_duration
+    stance_ticks = 20
+    _leg_in_stance_for(controller, stance_ticks)
+    
+    sequences, _ = controller.gait_generator_jax.compute_contact_sequences(jax.random.PRNGKey(0), controller.leg_states,
+                                                                           controller.leg_timers, 200)
+    durations = _stance_before_lift_off(controller, np.asarray(sequences), 1, stance_ticks)
+    
+    assert len(durations) > 0
+    assert np.all(durations >= min_stance_duration - controller.dt)
+
+def _make_interface():
+    """SRBD interface of the default sampling controller, and a function running one of its ticks with FR in swing"""
+    from quadruped_pympc.interfaces.srbd_controller_interface import SRBDControllerInterface
+    from quadruped_pympc.tests.test_sampling_mpc import _dummy_state_and_reference
+    interface = SRBDControllerInterface()
+    controller = interface.controller
+    
+    # Count the calls of the compiled solve of the candidate gaits
+    solved_gaits = []
+    compute_control_gaits = controller.jitted_compute_control_gaits
+    def counted_compute_control_gaits(*args):
+        solved_gaits.append(args[3].shape[0])
+        return compute_control_gaits(*args)
+    counted_compute_control_gaits.__wrapped__ = compute_control_gaits
+    controller.jitted_compute_control_gaits = counted_compute_control_gaits
+    
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, interface.horizon))
+    contact_sequence[1, :5] = 0
+    run_tick = lambda: interface.compute_control(state_current, ref_state, contact_sequence, None, np.zeros(4), 1.4, 0)
+    return interface, solved_gaits, run_tick
+
+def test_interface_tick_runs_the_gait_path(monkeypatch):
+    """Test that a tick of the interface solves the candidate gaits of RandomGaitMPPI"""
+    
+    monkeypatch.setitem(config.mpc_params, 'num_parallel_computations', 64)
+    monkeypatch.setitem(config.mpc_params, 'num_gait_samples', 4)
+    interface, solved_gaits, run_tick = _make_interface()
+    controller = interface.controller
+    for tick in range(2):
+        outputs = run_tick()
+    
+    assert isinstance(controller, RandomGaitMPPI)
+    assert solved_gaits == [4, 4]
+    assert isinstance(controller.jitted_compute_control, jax.stages.Wrapped)
+    assert np.array_equal(controller.best_sequence[:, 0], [1, 0, 1, 1])
+    assert np.array_equal(controller.leg_states, [1, 0, 1, 1])
+    assert np.allclose(controller.leg_timers, 2 * controller.tick_steps)
+    assert np.allclose(outputs[0].FR, 0.0)
+    assert np.all(np.isfinite(controller.best_control_parameters))
+
+def test_interface_tick_generates_the_gaits_on_the_device(monkeypatch):
+    """Test that with the JAX generator the candidate gaits are generated and solved in one compiled call"""
+    
+    monkeypatch.setitem(config.mpc_params, 'num_parallel_computations', 64)
+    monkeypatch.setitem(config.mpc_params, 'num_gait_samples', 4)
+    monkeypatch.setitem(config.mpc_params, 'use_jax_gait_generator', True)
+    interface, solved_gaits, run_tick = _make_interface()
+    controller = interface.controller
+    for tick in range(2):
+        outputs = run_tick()
+    
+    # The host solve of the candidates is not called
+    assert solved_gaits == []
+    assert controller.best_sequence.shape == (4, controller.horizon)
+    assert np.array_equal(controller.best_sequence[:, 0], [1, 0, 1, 1])
+    assert np.allclose(controller.leg_timers, 2 * controller.tick_steps)
+    assert np.allclose(outputs[0].FR, 0.0)
+    assert np.all(np.isfinite(controller.best_control_parameters))
+
+def test_interface_tick_serves_the_gaits_from_the_bank(monkeypatch):
+    """Test that the candidates come from the bank after the first tick, which then keeps the selected gait"""
+    
+    monkeypatch.setitem(config.mpc_params, 'num_parallel_computations', 64)
+    monkeypatch.setitem(config.mpc_params, 'num_gait_samples', 4)
+    monkeypatch.setitem(config.mpc_params, 'use_gait_bank', True)
+    monkeypatch.setitem(config.mpc_params, 'gait_bank_fresh_samples', 1)
+    interface, solved_gaits, run_tick = _make_interface()
+    controller = interface.controller
+    
+    # Count the new sequences generated on the device
+    generated = []
+    compute_contact_sequences = controller.jitted_compute_contact_sequences
+    def counted_compute_contact_sequences(key, leg_states, leg_timers, num_sequences):
+        generated.append(num_sequences)
+        return compute_contact_sequences(key, leg_states, leg_timers, num_sequences)
+    controller.jitted_compute_contact_sequences = counted_compute_contact_sequences
+    
+    for tick in range(3):
+        # Always the same phase of the legs, long enough in their state to change it within the horizon
+        controller.leg_states, controller.leg_timers = np.array([1.0, 0.0, 1.0, 1.0]), np.full(4, 20.0)
+        outputs = run_tick()
+    
+    # 4 sequences at the first tick, then 1 new per tick
+    assert solved_gaits == [4, 4, 4]
+    assert generated == [4, 1, 1]
+    stored = list(controller.gait_bank.phases[controller.gait_bank.get_phase_key(np.array([1, 0, 1, 1]), np.full(4, 20.0 + controller.tick_steps))])
+    assert len(stored) <= 6
+    selected = controller.gait_bank.unpack(np.frombuffer(stored[-1], dtype=np.uint8).reshape(4, -1))
+    assert np.array_equal(selected[:, :-1], controller.best_sequence[:, 1:])
+    assert np.allclose(outputs[0].FR, 0.0)
+
+def test_interface_tick_uses_the_aot_compiled_gait_solve(monkeypatch):
+    """Test that the compiled solve of the candidate gaits matches the arguments of a tick, hence it does not fall back"""
+    
+    monkeypatch.setitem(config.mpc_params, 'num_parallel_computations', 64)
+    monkeypatch.setitem(config.mpc_params, 'num_gait_samples', 4)
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', True)
+    interface, solved_gaits, run_tick = _make_interface()
+    compiled_gaits = interface.controller.jitted_compute_control_gaits.__wrapped__
+    
+    fallbacks = []
+    jitted_fun = compiled_gaits.jitted_fun
+    compiled_gaits.jitted_fun = lambda *args: fallbacks.append(args) or jitted_fun(*args)
+    for tick in range(2):
+        outputs = run_tick()
+    
+    assert isinstance(compiled_gaits, AOTCompiledFunction)
+    assert solved_gaits == [4, 4]
+    assert fallbacks == []
+    assert np.allclose(outputs[0].FR, 0.0)
+
 if __name__ == "__main__":
-    test_random_gait_mppi_integration()
\ No newline at end of file
+    test_random_gait_mppi_integration()
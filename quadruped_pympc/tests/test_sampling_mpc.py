@@ -0,0 +1,792 @@
+import numpy as np
+import pytest
+import jax
+import jax.numpy as jnp
+
+from quadruped_pympc import config
+from quadruped_pympc.controllers.sampling.centroidal_nmpc_jax import Sampling_MPC
+
+
+@pytest.fixture
+def small_mpc_params(monkeypatch):
+    # Keep the number of samples small, the tests only check the sampling logic
+    monkeypatch.setitem(config.mpc_params, 'num_parallel_computations', 64)
+    monkeypatch.setitem(config.mpc_params, 'num_splines', 3)
+    return config.mpc_params
+
+
+@pytest.mark.parametrize("control_parametrization", ['linear_spline_1', 'linear_spline_2', 'linear_spline_N',
+                                                     'cubic_spline_1', 'cubic_spline_2', 'cubic_spline_N',
+                                                     'zero_order'])
+def test_spline_basis_matches_spline_functions(small_mpc_params, monkeypatch, control_parametrization):
+    monkeypatch.setitem(config.mpc_params, 'control_parametrization', control_parametrization)
+    controller = Sampling_MPC(device="cpu")
+
+    num_parameters = controller.num_control_parameters_single_leg
+    assert controller.spline_basis.shape == (4, controller.horizon, 3, num_parameters)
+
+    parameters = np.random.RandomState(0).randn(controller.num_control_parameters).astype(np.float32)
+    force_trajectory = controller.compute_force_trajectory(jnp.array(parameters))
+    assert force_trajectory.shape == (controller.horizon, 4, 3)
+
+    spline_funs = [controller.spline_fun_FL, controller.spline_fun_FR, controller.spline_fun_RL, controller.spline_fun_RR]
+    for n in range(controller.horizon):
+        for leg, spline_fun in enumerate(spline_funs):
+            leg_parameters = jnp.array(parameters[leg*num_parameters:(leg+1)*num_parameters])
+            expected = np.array(spline_fun(leg_parameters, n, controller.horizon))
+            assert np.allclose(force_trajectory[n, leg], expected, atol=1e-5)
+
+
+def _dummy_state_and_reference():
+    state_current = dict(position=np.array([0.0, 0.0, 0.33]), linear_velocity=np.array([0.1, 0.0, 0.0]),
+                         orientation=np.zeros(3), angular_velocity=np.zeros(3),
+                         foot_FL=np.array([0.3, 0.2, 0.0]), foot_FR=np.array([0.3, -0.2, 0.0]),
+                         foot_RL=np.array([-0.3, 0.2, 0.0]), foot_RR=np.array([-0.3, -0.2, 0.0]))
+    ref_state = dict(ref_position=np.array([0.0, 0.0, 0.35]), ref_linear_velocity=np.array([0.3, 0.0, 0.0]),
+                     ref_orientation=np.zeros(3), ref_angular_velocity=np.zeros(3),
+                     ref_foot_FL=np.array([[0.35, 0.2, 0.0]]), ref_foot_FR=np.array([[0.35, -0.2, 0.0]]),
+                     ref_foot_RL=np.array([[-0.25, 0.2, 0.0]]), ref_foot_RR=np.array([[-0.25, -0.2, 0.0]]))
+    return state_current, ref_state
+
+
+def test_fused_control_tick_matches_host_path(small_mpc_params):
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, controller.horizon))
+    contact_sequence[1, :4] = 0
+    current_contact = contact_sequence[:, 0]
+    previous_contact = np.ones(4)
+
+    warm_start = np.random.RandomState(1).randn(controller.num_control_parameters).astype(np.float32)
+    controller.solver_state['best_control_parameters'] = jnp.array(warm_start)
+    key = controller.solver_state['key']
+
+    # Host path, with the same key used inside the fused tick
+    controller.best_control_parameters = warm_start.copy()
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, current_contact, previous_contact)
+    _, subkey = jax.random.split(key)
+    expected = controller.jitted_compute_control(state_jax, reference_jax, contact_sequence, controller.best_control_parameters,
+                                                 subkey, None, None, None)
+
+    nmpc_GRFs, _, nmpc_predicted_state, best_cost, _, costs = controller.compute_control_tick(state_current, ref_state,
+                                                                                              current_contact, previous_contact,
+                                                                                              contact_sequence, None, None, None)
+
+    assert np.allclose(nmpc_GRFs, expected[0], atol=1e-3)
+    assert np.allclose(nmpc_predicted_state, expected[2], atol=1e-4)
+    assert np.allclose(controller.best_control_parameters, expected[3], atol=1e-4)
+    assert np.allclose(costs, expected[6], rtol=1e-4)
+
+
+def test_scanned_sampling_iterations_match_python_loop(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'num_sampling_iterations', 3)
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, controller.horizon))
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+
+    key = jax.random.PRNGKey(0)
+    outputs = controller.jitted_compute_control_iterations(state_jax, reference_jax, contact_sequence,
+                                                           controller.best_control_parameters, key, 0.0, None, None, None)
+
+    best_control_parameters = controller.best_control_parameters
+    for _ in range(controller.num_sampling_iterations):
+        key, subkey = jax.random.split(key)
+        expected = controller.jitted_compute_control(state_jax, reference_jax, contact_sequence, best_control_parameters,
+                                                     subkey, None, None, None)
+        best_control_parameters = expected[3]
+
+    assert np.allclose(outputs[0], expected[0], atol=1e-3)
+    assert np.allclose(outputs[3], best_control_parameters, atol=1e-4)
+    assert np.array_equal(outputs[-1], key)
+
+
+def test_aot_compiled_entry_point_is_used_at_runtime(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', True)
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, controller.horizon))
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+
+    # Same argument types as the controller interface (no sigma for MPPI), hence no fallback to the jitted function
+    args = (state_jax, reference_jax, contact_sequence, controller.best_control_parameters, controller.master_key,
+            None, np.zeros(4), 1.4, 0)
+    outputs = controller.jitted_compute_control_iterations.compiled_fun(*args)
+    expected = controller.jitted_compute_control_iterations.jitted_fun(*args)
+
+    assert np.allclose(outputs[0], expected[0])
+    assert np.allclose(outputs[3], expected[3])
+
+
+def test_chunked_mppi_update_matches_dense_update(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'rollout_chunk_size', 16)
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, controller.horizon))
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    best_control_parameters = jnp.array(np.random.RandomState(2).randn(controller.num_control_parameters).astype(np.float32))
+    key = jax.random.PRNGKey(3)
+
+    updated, best_cost, costs = jax.jit(controller.compute_mppi_update_chunked)(state_jax, reference_jax, contact_sequence,
+                                                                               best_control_parameters, key, 3.0)
+
+    # Same samples, evaluated all at once
+    noise = jnp.concatenate([controller.sample_gaussian_noise_chunk(key, i, 3.0) for i in range(4)])
+    assert np.allclose(noise[0], 0.0)
+    expected_costs = controller.jit_vectorized_rollout(state_jax, reference_jax, best_control_parameters + noise, contact_sequence)
+    weights = jax.nn.softmax(-expected_costs)
+    expected = best_control_parameters + jnp.dot(weights, noise)
+
+    assert np.allclose(costs, expected_costs, rtol=1e-5)
+    assert np.isclose(best_cost, jnp.min(expected_costs))
+    assert np.allclose(updated, expected, atol=1e-4)
+
+
+def test_aot_compiled_function_reports_its_fallback():
+    from quadruped_pympc.helpers.jax_compilation import AOTCompiledFunction
+    compiled_double = AOTCompiledFunction(jax.jit(lambda x: 2*x), np.zeros(3, dtype=np.float32))
+    assert np.allclose(compiled_double(np.ones(3, dtype=np.float32)), 2.0)
+
+    # Other shapes are compiled again by the jitted function, the first time with a warning
+    with pytest.warns(UserWarning, match="ahead-of-time"):
+        assert np.allclose(compiled_double(np.ones(4, dtype=np.float32)), 2.0)
+    assert compiled_double.fallback_reported
+
+
+def test_host_devices_cannot_change_once_jax_is_initialized():
+    from quadruped_pympc.helpers.jax_compilation import configure_host_devices
+    jax.devices('cpu')
+    assert configure_host_devices(1)
+    with pytest.warns(UserWarning, match="already initialized"):
+        assert not configure_host_devices(len(jax.devices('cpu')) + 1)
+
+
+@pytest.mark.skipif(len(jax.devices('cpu')) < 2, reason="needs two host CPU devices")
+def test_sharded_mppi_matches_single_device(small_mpc_params, monkeypatch):
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, config.mpc_params['horizon']))
+    contact_sequence[2, :5] = 0
+    key = jax.random.PRNGKey(4)
+
+    outputs = []
+    for num_sampling_devices in [1, 2]:
+        monkeypatch.setitem(config.mpc_params, 'num_sampling_devices', num_sampling_devices)
+        controller = Sampling_MPC(device="cpu")
+        state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+        outputs.append(controller.jitted_compute_control(state_jax, reference_jax, contact_sequence,
+                                                         controller.best_control_parameters, key, None, None, None))
+
+    assert np.allclose(outputs[0][0], outputs[1][0], atol=1e-3)
+    assert np.allclose(outputs[0][3], outputs[1][3], atol=1e-4)
+    assert np.allclose(outputs[0][4], outputs[1][4])
+    assert np.allclose(outputs[0][6], outputs[1][6], rtol=1e-5)
+
+
+def test_pruned_rollout_keeps_best_partial_costs(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'rollout_pruning_steps', [4])
+    monkeypatch.setitem(config.mpc_params, 'rollout_pruning_keep_fraction', 0.25)
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, controller.horizon))
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    control_parameters_vec = controller.sample_gaussian_noise(jax.random.PRNGKey(5), 3.0)
+
+    costs, survivors = jax.jit(controller.compute_pruned_rollout)(state_jax, reference_jax, control_parameters_vec, contact_sequence)
+    assert costs.shape == (controller.num_parallel_computations // 4, )
+
+    # The carried state and cost give the same result as a full rollout
+    full_costs = controller.jit_vectorized_rollout(state_jax, reference_jax, control_parameters_vec, contact_sequence)
+    assert np.allclose(costs, full_costs[survivors], rtol=1e-4)
+
+    partial_cost = jax.vmap(controller.compute_rollout_segment, in_axes=(None, None, None, 0, None, None, None))
+    partial_costs, _ = partial_cost(state_jax, 0.0, reference_jax, control_parameters_vec, jnp.array(contact_sequence), 0, 4)
+    assert np.max(partial_costs[survivors]) <= np.min(np.delete(partial_costs, survivors))
+
+
+def test_contact_aware_sampling_skips_swing_parameters(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'control_parametrization', 'linear_spline_1')
+    monkeypatch.setitem(config.mpc_params, 'use_contact_aware_sampling', True)
+    controller = Sampling_MPC(device="cpu")
+    num_parameters = controller.num_control_parameters_single_leg
+    contact_sequence = np.ones((4, controller.horizon))
+    contact_sequence[0, :] = 0
+    contact_sequence[3, 1:] = 0
+
+    mask = np.array(controller.compute_active_parameters_mask(jnp.array(contact_sequence)))
+    assert np.all(mask[:num_parameters] == 0)
+    assert np.all(mask[num_parameters:3*num_parameters] == 1)
+    # At the first step the linear spline depends only on its initial value
+    assert np.array_equal(mask[3*num_parameters:], [1, 0, 1, 0, 1, 0])
+
+    state_current, ref_state = _dummy_state_and_reference()
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    best_control_parameters = controller.jitted_compute_control(state_jax, reference_jax, contact_sequence,
+                                                                controller.best_control_parameters, jax.random.PRNGKey(6),
+                                                                None, None, None)[3]
+    assert np.allclose(np.array(best_control_parameters)[mask == 0], 0.0)
+    assert not np.allclose(np.array(best_control_parameters)[mask == 1], 0.0)
+
+
+@pytest.mark.parametrize("noise_engine", ['sobol', 'halton'])
+def test_low_discrepancy_noise_is_standard_normal(small_mpc_params, monkeypatch, noise_engine):
+    monkeypatch.setitem(config.mpc_params, 'num_parallel_computations', 1025)
+    monkeypatch.setitem(config.mpc_params, 'noise_engine', noise_engine)
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', False)
+    controller = Sampling_MPC(device="cpu")
+
+    sample = jax.jit(controller.sample_standard_normal, static_argnums=1)
+    samples = np.array(sample(jax.random.PRNGKey(7), 1024))
+    assert samples.shape == (1024, controller.num_control_parameters)
+    assert np.all(np.isfinite(samples))
+    assert np.allclose(samples.mean(axis=0), 0.0, atol=0.05)
+    assert np.allclose(samples.std(axis=0), 1.0, atol=0.05)
+
+    # A new random shift at every tick
+    assert not np.allclose(samples, sample(jax.random.PRNGKey(8), 1024))
+
+    noise = controller.sample_gaussian_noise(jax.random.PRNGKey(7), 3.0)
+    assert np.allclose(noise[0], 0.0)
+    assert np.allclose(noise[1:], 3.0*samples, atol=1e-4)
+
+
+@pytest.mark.parametrize("noise_engine", ['sobol', 'halton'])
+def test_chunked_low_discrepancy_noise_matches_dense_noise(small_mpc_params, monkeypatch, noise_engine):
+    monkeypatch.setitem(config.mpc_params, 'noise_engine', noise_engine)
+    monkeypatch.setitem(config.mpc_params, 'rollout_chunk_size', 16)
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', False)
+    controller = Sampling_MPC(device="cpu")
+    key = jax.random.PRNGKey(7)
+
+    # Each chunk takes its own points of the set, with the same shift
+    sample_chunk = jax.jit(controller.sample_gaussian_noise_chunk)
+    num_chunks = controller.num_parallel_computations // controller.rollout_chunk_size
+    noise = np.concatenate([sample_chunk(key, i, 3.0) for i in range(num_chunks)])
+    assert np.allclose(noise, controller.sample_gaussian_noise(key, 3.0), atol=1e-4)
+
+
+@pytest.mark.parametrize("rollout_precision, tolerance", [('bfloat16', 0.05), ('float16', 0.01)])
+def test_reduced_precision_rollout_matches_float32(small_mpc_params, monkeypatch, rollout_precision, tolerance):
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', False)
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, config.mpc_params['horizon']))
+    contact_sequence[0, 3:8] = 0
+    contact_sequence[3, 3:8] = 0
+
+    costs = {}
+    for precision in ['float32', rollout_precision]:
+        monkeypatch.setitem(config.mpc_params, 'rollout_precision', precision)
+        controller = Sampling_MPC(device="cpu")
+        state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+        control_parameters_vec = controller.sample_gaussian_noise(jax.random.PRNGKey(9), 3.0)
+        costs[precision] = np.array(controller.jit_vectorized_rollout(state_jax, reference_jax, control_parameters_vec, contact_sequence))
+
+    assert costs[rollout_precision].dtype == np.float32
+    assert np.allclose(costs[rollout_precision], costs['float32'], rtol=tolerance)
+    assert np.argmin(costs['float32']) in np.argsort(costs[rollout_precision])[:3]
+
+
+def test_shift_matrix_moves_zero_order_parameters_ahead(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'control_parametrization', 'zero_order')
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', False)
+    controller = Sampling_MPC(device="cpu")
+    horizon = controller.horizon
+
+    assert np.allclose(controller.compute_shift_matrix(0.0), np.identity(controller.num_control_parameters_single_leg), atol=1e-5)
+
+    parameters = np.random.RandomState(10).randn(controller.num_control_parameters).astype(np.float32)
+    shifted = np.array(controller.shift_control_parameters(jnp.array(parameters), controller.compute_shift_matrix(1.0)))
+    # f_x of the first leg: one step ahead, the last step is held
+    assert np.allclose(shifted[:horizon-1], parameters[1:horizon], atol=1e-5)
+    assert np.isclose(shifted[horizon-1], parameters[horizon-1], atol=1e-5)
+
+
+@pytest.mark.parametrize("control_parametrization", ['linear_spline_1', 'linear_spline_N', 'cubic_spline_1', 'cubic_spline_N'])
+def test_shift_solution_moves_the_warm_start_ahead(small_mpc_params, monkeypatch, control_parametrization):
+    monkeypatch.setitem(config.mpc_params, 'control_parametrization', control_parametrization)
+    monkeypatch.setitem(config.mpc_params, 'shift_solution', True)
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', False)
+    controller = Sampling_MPC(device="cpu")
+    horizon = controller.horizon
+
+    parameters = jnp.array(np.random.RandomState(12).randn(controller.num_control_parameters).astype(np.float32))
+    forces = controller.compute_force_trajectory(parameters)
+    assert np.allclose(controller.compute_force_trajectory(controller.shift_solution(parameters, 0.0)), forces, atol=1e-4)
+    if(control_parametrization == 'cubic_spline_1'):
+        # A cubic moved ahead is still a cubic, only the last steps (held at the end of the horizon) are off
+        shifted_forces = controller.compute_force_trajectory(controller.shift_solution(parameters, 2.0))
+        assert np.allclose(shifted_forces[:horizon-3], forces[2:horizon-1], atol=0.05*np.abs(forces).max())
+
+    # The host path shifts the warm start by one mpc period at every tick
+    state_current, ref_state = _dummy_state_and_reference()
+    controller.best_control_parameters = parameters
+    controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    tick_advance = 1. / (config.simulation_params['mpc_frequency'] * controller.dt)
+    expected = controller.shift_control_parameters(parameters, controller.compute_shift_matrix(tick_advance))
+    assert np.allclose(controller.best_control_parameters, expected, atol=1e-5)
+
+
+def test_recycled_samples_are_the_best_of_the_last_tick(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'num_recycled_samples', 8)
+    monkeypatch.setitem(config.mpc_params, 'use_fused_control_tick', True)
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, controller.horizon))
+
+
+    _, _, _, best_cost, _, costs = controller.compute_control_tick(state_current, ref_state, np.ones(4), np.ones(4),
+                                                                   contact_sequence, np.zeros(4), 1.4, 0)
+    recycled_parameters = controller.solver_state['recycled_parameters']
+    assert recycled_parameters.shape == (8, controller.num_control_parameters)
+
+    state_jax, reference_jax = controller.pack_state_and_reference(state_current, ref_state, jnp.ones(4))
+    recycled_costs = controller.jit_vectorized_rollout(state_jax, reference_jax, recycled_parameters, contact_sequence)
+    assert np.allclose(recycled_costs, np.sort(costs)[:8], rtol=1e-4)
+    assert np.isclose(recycled_costs[0], best_cost, rtol=1e-4)
+
+
+def test_recycled_samples_do_not_move_the_mean(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'num_recycled_samples', 8)
+    monkeypatch.setitem(config.mpc_params, 'use_fused_control_tick', True)
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, controller.horizon))
+    state_jax, reference_jax = controller.pack_state_and_reference(state_current, ref_state, jnp.ones(4))
+    key = jax.random.PRNGKey(4)
+    compute_control_mppi = jax.jit(lambda *args: controller.compute_control_mppi(*args))
+
+    # On the same problem, a pool of zeros and a pool of the best samples of a first pass give the same mean
+    args = (state_jax, reference_jax, contact_sequence, controller.best_control_parameters, key, np.zeros(4), 1.4, 0)
+    outputs = compute_control_mppi(*args, jnp.zeros((8, controller.num_control_parameters)))
+    elites = outputs[7]
+    outputs_with_elites = compute_control_mppi(*args, elites)
+    assert np.allclose(outputs_with_elites[3], outputs[3], atol=1e-5)
+
+    # It is the mean of the fresh samples alone, while the elites can still be recycled
+    num_fresh_samples = controller.num_parallel_computations - 8
+    noise = controller.sample_gaussian_noise(key, controller.sigma_mppi)[:num_fresh_samples]
+    costs = np.array(outputs_with_elites[6][:num_fresh_samples])
+    weights = np.exp(-(costs - costs.min()))
+    expected = controller.best_control_parameters + np.dot(weights / weights.sum(), noise)
+    assert np.allclose(outputs_with_elites[3], expected, atol=1e-4)
+    assert np.isclose(outputs_with_elites[4], min(costs.min(), outputs_with_elites[6][num_fresh_samples:].min()))
+
+
+def test_recycling_is_rejected_outside_the_fused_dense_mppi(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'num_recycled_samples', 8)
+    monkeypatch.setitem(config.mpc_params, 'use_fused_control_tick', True)
+    monkeypatch.setitem(config.mpc_params, 'rollout_chunk_size', 16)
+    with pytest.raises(SystemExit):
+        Sampling_MPC(device="cpu")
+
+
+def test_anytime_mode_selects_largest_tier_within_deadline(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'anytime_sample_tiers', [32, 64, 128])
+    monkeypatch.setitem(config.mpc_params, 'anytime_deadline', 0.01)
+    controller = Sampling_MPC(device="cpu")
+    assert sorted(controller.sample_tier_latency) == [32, 64, 128]
+    assert config.mpc_params['num_parallel_computations'] == 64
+
+    # All the tiers are measured when the controller is created
+    assert all(latency > 0 for latency in controller.sample_tier_latency.values())
+    controller.sample_tier_latency.update({32: 0.004, 64: 0.006, 128: 0.02})
+    assert controller.select_sample_tier() == 64
+    controller.sample_tier_latency[32] = 0.02
+    assert controller.select_sample_tier() == 64
+    controller.sample_tier_latency.update({32: 0.02, 64: 0.02})
+    assert controller.select_sample_tier() == 32
+    controller.sample_tier_latency[128] = 0.002
+    assert controller.select_sample_tier() == 128
+
+    # Every call updates the estimate of its tier, and scales the others by the same factor
+    state_current, ref_state = _dummy_state_and_reference()
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    outputs = controller.jitted_compute_control_iterations(state_jax, reference_jax, np.ones((4, controller.horizon)),
+                                                           controller.best_control_parameters, controller.master_key,
+                                                           None, np.zeros(4), 1.4, 0)
+    assert controller.anytime_metrics['num_samples'] == 128
+    assert outputs[6].shape == (128, )
+    expected_latency = 0.8*0.002 + 0.2*controller.anytime_metrics['latency']
+    assert np.isclose(controller.sample_tier_latency[128], expected_latency)
+    assert np.isclose(controller.sample_tier_latency[32], 0.02 * expected_latency / 0.002)
+
+    # The tiers do not change the config, nor build tiers of their own
+    assert config.mpc_params['anytime_sample_tiers'] == [32, 64, 128]
+    tier_controller = controller.sample_tier_entry_points[128].jitted_fun.__wrapped__.__self__
+    assert tier_controller.num_parallel_computations == 128
+    assert tier_controller.anytime_metrics == {} and not hasattr(tier_controller, 'sample_tier_latency')
+
+
+@pytest.mark.parametrize("use_fused_control_tick", [False, True])
+def test_anytime_tiers_do_not_compile_in_the_control_loop(small_mpc_params, monkeypatch, use_fused_control_tick):
+    monkeypatch.setitem(config.mpc_params, 'anytime_sample_tiers', [32, 64, 128])
+    monkeypatch.setitem(config.mpc_params, 'use_fused_control_tick', use_fused_control_tick)
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', False)
+    monkeypatch.setitem(config.mpc_params, 'use_random_gait', False)
+    from quadruped_pympc.interfaces.srbd_controller_interface import SRBDControllerInterface
+    from quadruped_pympc.helpers.jax_compilation import AOTCompiledFunction
+    from quadruped_pympc.helpers.periodic_gait_generator import PeriodicGaitGenerator
+    interface = SRBDControllerInterface()
+    controller = interface.controller
+    state_current, ref_state = _dummy_state_and_reference()
+    pgg = PeriodicGaitGenerator(duty_factor=0.65, step_freq=1.4, gait_type=0, horizon=interface.horizon)
+    contact_sequence = pgg.compute_contact_sequence([interface.mpc_dt], [interface.horizon])
+
+    # Every tier, also the one of the controller itself, runs its compiled executable
+    fallbacks = []
+    for num_samples, entry_point in controller.sample_tier_entry_points.items():
+        assert isinstance(entry_point, AOTCompiledFunction)
+        entry_point.jitted_fun = lambda *args, num_samples=num_samples: fallbacks.append(num_samples)
+
+    # Whichever tier is selected by the interface tick
+    for num_samples in [32, 64, 128]:
+        controller.sample_tier_latency = {tier: 1e-6 if tier <= num_samples else 1e6 for tier in controller.sample_tier_latency}
+        interface.compute_control(state_current, ref_state, contact_sequence, None, pgg.phase_signal, 1.4, 0)
+        assert controller.anytime_metrics['num_samples'] == num_samples
+    assert fallbacks == []
+
+
+def test_batched_control_matches_single_robot_calls(small_mpc_params):
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+
+    num_robots = 3
+    states = np.stack([state_jax + 0.01*robot for robot in range(num_robots)])
+    references = np.stack([reference_jax]*num_robots)
+    contact_sequences = np.ones((num_robots, 4, controller.horizon))
+    contact_sequences[1, 2, :5] = 0
+    best_control_parameters = np.random.RandomState(2).randn(num_robots, controller.num_control_parameters).astype(np.float32)
+    keys = jax.random.split(controller.master_key, num_robots)
+    timings = np.zeros((num_robots, 4))
+    nominal_step_frequencies = np.full(num_robots, 1.4)
+
+    outputs = controller.jitted_compute_control_batch(states, references, contact_sequences, best_control_parameters,
+                                                      keys, 0.0, timings, nominal_step_frequencies, 0)
+    assert outputs[0].shape == (num_robots, 12)
+
+    for robot in range(num_robots):
+        expected = controller.jitted_compute_control_iterations(states[robot], references[robot], contact_sequences[robot],
+                                                                best_control_parameters[robot], keys[robot], 0.0,
+                                                                timings[robot], nominal_step_frequencies[robot], 0)
+        assert np.allclose(outputs[0][robot], expected[0], atol=1e-3)
+        assert np.allclose(outputs[3][robot], expected[3], atol=1e-4)
+
+
+def test_async_dispatch_matches_blocking_control(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'use_random_gait', False)
+    from quadruped_pympc.interfaces.srbd_controller_interface import SRBDControllerInterface
+    interface = SRBDControllerInterface()
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, interface.horizon))
+    contact_sequence[3, 0] = 0
+
+    key = interface.controller.master_key
+    expected = interface.compute_control(state_current, ref_state, contact_sequence, None, np.zeros(4), 1.4, 0)
+
+    interface.controller.master_key = key
+    interface.controller.best_control_parameters = np.zeros(interface.controller.num_control_parameters, dtype=np.float32)
+    interface.previous_contact_mpc = np.ones(4)
+    pending_control = interface.dispatch_sampling_control(state_current, ref_state, contact_sequence, np.zeros(4), 1.4, 0)
+    outputs = interface.collect_sampling_control(pending_control)
+
+    assert interface.is_sampling_control_ready(pending_control)
+    for leg in ('FL', 'FR', 'RL', 'RR'):
+        assert np.allclose(outputs[0][leg], expected[0][leg], atol=1e-3)
+    assert np.allclose(outputs[0]['RR'], 0.0)
+    assert np.allclose(outputs[6], expected[6], atol=1e-4)
+
+
+def test_gradient_refinement_lowers_the_mppi_cost(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'sampling_method', 'mppi')
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = jnp.ones((4, controller.horizon))
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    key = jax.random.PRNGKey(3)
+
+    expected = controller.jitted_compute_control(state_jax, reference_jax, contact_sequence, controller.best_control_parameters,
+                                                 key, None, None, None)
+
+    # A new function, otherwise jax reuses the trace of jitted_compute_control
+    controller.gradient_refinement_steps = 5
+    controller.gradient_refinement_candidates = 4
+    outputs = jax.jit(lambda *args: controller.compute_control_mppi(*args))(state_jax, reference_jax, contact_sequence,
+                                                                           controller.best_control_parameters, key, None, None, None)
+
+    rollout_cost = jax.jit(controller.compute_rollout)
+    refined_cost = rollout_cost(state_jax, reference_jax, outputs[3], contact_sequence)
+    assert refined_cost < rollout_cost(state_jax, reference_jax, expected[3], contact_sequence)
+    assert np.isclose(outputs[4], min(expected[4], refined_cost), rtol=1e-4)
+
+
+def test_predicted_trajectory_is_the_rollout_of_the_solution(small_mpc_params):
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, controller.horizon))
+    contact_sequence[0, 3:7] = 0
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+
+    outputs = controller.jitted_compute_control_iterations(state_jax, reference_jax, contact_sequence, controller.best_control_parameters,
+                                                           jax.random.PRNGKey(0), 0.0, None, None, None)
+    predicted_states, predicted_GRFs = outputs[-2]
+    assert predicted_states.shape == (controller.horizon, controller.state_dim)
+    assert predicted_GRFs.shape == (controller.horizon, 12)
+
+    # The first step is the control applied now, and the plan has the cost of the rollout
+    assert np.allclose(predicted_GRFs[0], outputs[0])
+    assert np.allclose(predicted_states[0], outputs[2])
+    assert np.allclose(predicted_GRFs[3:7, 0:3], 0.0)
+    state_errors = predicted_states - reference_jax[:controller.state_dim]
+    plan_cost = np.einsum('hi,ij,hj->', state_errors, controller.Q, state_errors)
+    rollout_cost = controller.compute_rollout(state_jax, reference_jax, outputs[3], jnp.array(contact_sequence))
+    assert np.isclose(plan_cost, rollout_cost, rtol=1e-3)
+
+
+def test_cost_registry_terms_sum_to_the_rollout_cost(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'sampling_cost_terms', [
+        {'name': 'grf_regularization', 'kind': 'huber', 'source': 'input', 'indices': slice(12, 24), 'weights': 0.1, 'delta': 20.},
+        {'name': 'com_height_limits', 'kind': 'barrier', 'source': 'state', 'indices': [2], 'weights': 1., 'lower': -0.05, 'upper': 0.05},
+        {'name': 'yaw_rate', 'kind': 'custom', 'function': lambda state_error, input: 10. * state_error[11]**2}])
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = jnp.array(np.ones((4, controller.horizon)))
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    parameters = jnp.array(np.random.RandomState(0).randn(controller.num_control_parameters).astype(np.float32))
+
+    # The default quadratic terms are the diagonal of Q, merged in one weight vector
+    assert np.allclose(controller.cost_registry.state_weights, np.diag(controller.Q))
+    assert not controller.cost_registry.has_input_weights
+
+    breakdown = controller.jitted_compute_cost_breakdown(state_jax, reference_jax, parameters, contact_sequence)
+    assert set(breakdown) == {'com_position', 'com_velocity', 'base_angle', 'base_angle_rates',
+                              'grf_regularization', 'com_height_limits', 'yaw_rate'}
+    assert all(np.isfinite(cost) for cost in breakdown.values())
+    assert breakdown['grf_regularization'] > 0
+
+    predicted_states, _ = controller.compute_predicted_trajectory(state_jax, parameters, contact_sequence)
+    state_errors = predicted_states - reference_jax[:controller.state_dim]
+    plan_cost = np.einsum('hi,ij,hj->', state_errors, controller.Q, state_errors)
+    default_cost = sum(breakdown[name] for name in ['com_position', 'com_velocity', 'base_angle', 'base_angle_rates'])
+    assert np.isclose(default_cost, plan_cost, rtol=1e-4)
+
+    rollout_cost = controller.compute_rollout(state_jax, reference_jax, parameters, contact_sequence)
+    assert np.isclose(sum(breakdown.values()), rollout_cost, rtol=1e-3)
+
+
+def test_gait_adaptive_samples_gather_their_contact_sequence(small_mpc_params, monkeypatch):
+    from quadruped_pympc.controllers.sampling.centroidal_nmpc_jax_gait_adaptive import Sampling_MPC as Sampling_MPC_GaitAdaptive
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', False)
+    controller = Sampling_MPC_GaitAdaptive(device="cpu")
+    state_jax = jnp.zeros(controller.state_dim).at[2].set(0.27)
+    reference_jax = jnp.zeros(controller.reference_dim).at[2].set(0.3).at[3].set(0.3)
+    timing = jnp.array([0.1, 0.6, 0.6, 0.1])
+
+    # One contact sequence per candidate step frequency, the same the gait generator gives for it
+    step_frequencies = controller.step_freq_delta
+    contact_sequences = controller.compute_contact_sequence_table(timing, step_frequencies)
+    assert contact_sequences.shape == (step_frequencies.shape[0], 4, controller.horizon)
+    for index, step_frequency in enumerate(step_frequencies):
+        contact_sequence, _ = controller.pgg.compute_contact_sequence(simulation_dt=0.002, t=timing, step_freq=step_frequency)
+        assert np.array_equal(contact_sequences[index], contact_sequence)
+
+    # Each sample of the vmapped rollout gathers the sequence of its own frequency
+    parameters = jnp.array(np.random.RandomState(0).randn(controller.num_parallel_computations, controller.num_control_parameters).astype(np.float32))
+    frequency_indices = jnp.arange(controller.num_parallel_computations) % step_frequencies.shape[0]
+    costs = controller.jit_vectorized_rollout(state_jax, reference_jax, contact_sequences, step_frequencies, parameters, frequency_indices)
+    for sample in range(4):
+        index = int(frequency_indices[sample])
+        cost = controller.compute_rollout(state_jax, reference_jax, contact_sequences[index:index+1], step_frequencies[index:index+1],
+                                          parameters[sample], 0)
+        assert np.isclose(costs[sample], cost, rtol=1e-4)
+
+
+def test_gait_timing_is_sampled_with_the_forces(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'sampling_method', 'mppi')
+    monkeypatch.setitem(config.mpc_params, 'optimize_gait_timing', True)
+    monkeypatch.setitem(config.mpc_params, 'num_sampling_iterations', 2)
+    monkeypatch.setitem(config.mpc_params, 'gait_timing_min_improvement', 0.0)
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    timing = jnp.array([0.1, 0.6, 0.6, 0.1])
+
+    # The nominal timing gives the contact sequence of the periodic gait
+    nominal_timing_parameters = controller.best_timing_parameters
+    contact_sequence, _ = controller.timing_pgg.compute_contact_sequence(simulation_dt=controller.dt, t=timing, 
+                                                                         step_freq=nominal_timing_parameters[8])
+    current_contact = contact_sequence[:, 0]
+    assert np.array_equal(controller.compute_timing_contact_sequence(timing, nominal_timing_parameters, current_contact), contact_sequence)
+
+    # The phase offset of a leg shifts its contacts, but not the current one
+    later_offset = nominal_timing_parameters.at[0].set(-0.2)
+    shifted_sequence = controller.compute_timing_contact_sequence(timing, later_offset, current_contact)
+    assert np.sum(shifted_sequence[0]) != np.sum(contact_sequence[0])
+    assert np.array_equal(shifted_sequence[:, 0], current_contact)
+
+    key = jax.random.PRNGKey(0)
+    outputs = controller.jitted_compute_control_gait_timing(state_jax, reference_jax, current_contact, controller.best_control_parameters,
+                                                            nominal_timing_parameters, key, timing)
+    costs, timing_parameters, contact_sequence = outputs[6], outputs[7], outputs[8]
+    assert costs.shape == (controller.num_parallel_computations,)
+
+    # Both iterations run in the scan, the last one starts from the solution of the first
+    first_iteration = controller.compute_mppi_gait_timing_update(state_jax, reference_jax, current_contact, controller.best_control_parameters,
+                                                                 nominal_timing_parameters, jax.random.split(key)[1], timing)
+    rollout_cost = controller.compute_timing_rollout(state_jax, reference_jax, first_iteration[0], first_iteration[1], timing, current_contact)
+    assert np.isclose(costs[0], rollout_cost, rtol=1e-3)
+
+    # The timing is updated too, within its bounds, and gives the returned contact sequence and step frequency
+    assert not np.allclose(timing_parameters, nominal_timing_parameters)
+    assert np.all((timing_parameters[4:8] >= controller.duty_factor_range[0]) & (timing_parameters[4:8] <= controller.duty_factor_range[1]))
+    assert np.array_equal(contact_sequence, controller.compute_timing_contact_sequence(timing, timing_parameters, current_contact))
+    assert np.isclose(outputs[5], timing_parameters[8])
+
+    # The plan along the horizon starts with the returned GRFs and predicted state
+    predicted_states, predicted_GRFs = outputs[9]
+    assert predicted_GRFs.shape == (controller.horizon, 12)
+    assert np.allclose(predicted_GRFs[0], outputs[0]) and np.allclose(predicted_states[0], outputs[2])
+
+
+def test_gait_timing_is_kept_without_enough_improvement(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'sampling_method', 'mppi')
+    monkeypatch.setitem(config.mpc_params, 'optimize_gait_timing', True)
+    monkeypatch.setitem(config.mpc_params, 'gait_timing_min_improvement', 1.0)
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    timing = jnp.array([0.1, 0.6, 0.6, 0.1])
+    current_contact = jnp.array([1., 0., 0., 1.])
+
+    # No cost can be lowered by 100%, the timing in use is returned and the plan follows its contact sequence
+    timing_parameters = controller.best_timing_parameters
+    outputs = controller.jitted_compute_control_gait_timing(state_jax, reference_jax, current_contact, controller.best_control_parameters,
+                                                            timing_parameters, jax.random.PRNGKey(0), timing)
+    assert np.allclose(outputs[7], timing_parameters)
+    assert np.isclose(outputs[5], timing_parameters[8])
+    assert np.array_equal(outputs[8], controller.compute_timing_contact_sequence(timing, timing_parameters, current_contact))
+    predicted_states, predicted_GRFs = outputs[9]
+    assert np.allclose(predicted_GRFs[0], outputs[0])
+
+
+def test_gait_timing_rejects_the_qmc_noise_engines(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'sampling_method', 'mppi')
+    monkeypatch.setitem(config.mpc_params, 'optimize_gait_timing', True)
+    monkeypatch.setitem(config.mpc_params, 'noise_engine', 'sobol')
+    with pytest.raises(SystemExit):
+        Sampling_MPC(device="cpu")
+
+
+def test_gait_timing_is_handed_over_to_the_periodic_gait_generator(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'sampling_method', 'mppi')
+    monkeypatch.setitem(config.mpc_params, 'optimize_gait_timing', True)
+    monkeypatch.setitem(config.mpc_params, 'use_random_gait', False)
+    from quadruped_pympc.interfaces.srbd_controller_interface import SRBDControllerInterface
+    from quadruped_pympc.helpers.periodic_gait_generator import PeriodicGaitGenerator
+    interface = SRBDControllerInterface()
+    state_current, ref_state = _dummy_state_and_reference()
+    pgg = PeriodicGaitGenerator(duty_factor=0.65, step_freq=1.4, gait_type=0, horizon=interface.horizon)
+    contact_sequence = pgg.compute_contact_sequence([interface.mpc_dt], [interface.horizon])
+
+    outputs = interface.compute_control(state_current, ref_state, contact_sequence, None, pgg.phase_signal, 1.4, 0)
+    timing_parameters = interface.best_timing_parameters
+    assert timing_parameters.shape == (9,)
+    assert np.isclose(outputs[5], timing_parameters[8])
+
+    # The offsets move on to the phase of the generator, the controller keeps the duty factors and step frequency
+    assert np.allclose(interface.controller.best_timing_parameters[0:4], 0.0)
+    assert np.allclose(interface.controller.best_timing_parameters[4:], timing_parameters[4:])
+
+    # The generator takes a duty factor per leg
+    pgg.set_phase_signal(np.full(4, 0.5))
+    pgg.duty_factor = np.array([0.4, 0.6, 0.4, 0.6])
+    assert np.array_equal(pgg.run(0.0, 1.4), [0, 1, 0, 1])
+
+
+def test_cem_block_covariance_follows_the_elites(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'sampling_method', 'cem_mppi')
+    monkeypatch.setitem(config.mpc_params, 'cem_elite_fraction', 0.25)
+    monkeypatch.setitem(config.mpc_params, 'cem_covariance_smoothing', 1.0)
+    controller = Sampling_MPC(device="cpu")
+    state_current, ref_state = _dummy_state_and_reference()
+    contact_sequence = np.ones((4, controller.horizon))
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    num_parameters = controller.num_control_parameters_single_leg
+
+    sigma = controller.sigma_cem_mppi
+    assert sigma.shape == (4, num_parameters, num_parameters)
+    assert np.allclose(sigma, np.identity(num_parameters) * config.mpc_params['sigma_cem_mppi'])
+
+    key = jax.random.PRNGKey(4)
+    outputs = controller.jitted_compute_control(state_jax, reference_jax, contact_sequence, controller.best_control_parameters,
+                                                key, sigma)
+    new_sigma = np.array(outputs[7])
+    assert np.allclose(new_sigma, np.tril(new_sigma))
+
+    # Same samples as inside the controller, their 16 best give the covariance of each leg
+    standard_normal = np.array(controller.sample_standard_normal(key, controller.num_parallel_computations - 1))
+    noise = np.concatenate([np.zeros((1, controller.num_control_parameters)), standard_normal * config.mpc_params['sigma_cem_mppi']])
+    elite = noise[np.argsort(np.array(outputs[6]))[:16]].reshape((16, 4, num_parameters))
+    for leg in range(4):
+        eigenvalues, eigenvectors = np.linalg.eigh(np.cov(elite[:, leg], rowvar=False))
+        expected = eigenvectors @ np.diag(np.clip(eigenvalues, 0.2**2, 5.**2)) @ eigenvectors.T
+        assert np.allclose(new_sigma[leg] @ new_sigma[leg].T, expected, atol=1e-3)
+
+
+def test_higher_order_integrators_converge_with_coarse_steps(monkeypatch):
+    from quadruped_pympc.controllers.sampling.centroidal_model_jax import Centroidal_Model_JAX
+    state = jnp.array([0.0, 0.0, 0.33, 0.3, 0.0, 0.1, 0.05, -0.05, 0.2, 0.5, -0.4, 1.0,
+                       0.3, 0.2, 0.0, 0.3, -0.2, 0.0, -0.3, 0.2, 0.0, -0.3, -0.2, 0.0], dtype=jnp.float32)
+    inputs = jnp.zeros(24, dtype=jnp.float32).at[12:].set(jnp.tile(jnp.array([3.0, 1.0, 40.0]), 4)).at[14].set(60.0)
+    contact_status = jnp.ones(4, dtype=jnp.float32)
+
+    def integrate(integrator, dt, num_steps):
+        monkeypatch.setitem(config.mpc_params, 'sampling_integrator', integrator)
+        monkeypatch.setitem(config.mpc_params, 'horizon', num_steps)
+        model = Centroidal_Model_JAX(dt, "cpu")
+        final_state = jax.jit(lambda state: jax.lax.fori_loop(0, num_steps, lambda n, state: model.integrate_jax(state, inputs, contact_status, n), state))(state)
+        return np.array(final_state[:12])
+    
+    # Same prediction time, 0.24 s
+    reference = integrate('rk4', 0.001, 240)
+    errors = {integrator: np.abs(integrate(integrator, 0.08, 3) - reference).max() for integrator in ['euler', 'semi_implicit_euler', 'rk2', 'rk4']}
+    assert errors['rk4'] < errors['rk2'] < errors['semi_implicit_euler'] < errors['euler']
+    assert errors['rk4'] < np.abs(integrate('euler', 0.02, 12) - reference).max() / 100
+
+
+def test_state_derivative_of_float64_numpy_state_does_not_warn():
+    import warnings
+    from quadruped_pympc.controllers.sampling.centroidal_model_jax import Centroidal_Model_JAX
+    model = Centroidal_Model_JAX(0.02, "cpu")
+    state = np.zeros(24)
+    state[12:] = np.tile([0.3, 0.2, 0.0], 4)
+    inputs = np.zeros(24)
+    inputs[12:] = np.tile([0.0, 0.0, 30.0], 4)
+
+    # Without x64 the arrays are float32, no float64 constant is requested
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', UserWarning)
+        state_dot = model.fd(state, inputs, np.ones(4))
+        reduced_state_dot = model.compute_state_derivative(state, inputs, np.ones(4), 'float32')
+    assert state_dot.dtype == jnp.float32
+    assert np.allclose(state_dot, reduced_state_dot)
+
+
+def test_integrator_is_chosen_per_stage(small_mpc_params, monkeypatch):
+    monkeypatch.setitem(config.mpc_params, 'use_nonuniform_discretization', True)
+    monkeypatch.setitem(config.mpc_params, 'sampling_integrator', 'rk4')
+    monkeypatch.setitem(config.mpc_params, 'sampling_integrator_fine_grained', 'euler')
+    monkeypatch.setitem(config.mpc_params, 'use_aot_compilation', False)
+    controller = Sampling_MPC(device="cpu")
+    robot = controller.robot
+    horizon_fine_grained = config.mpc_params['horizon_fine_grained']
+    assert robot.get_integration_stages(0, controller.horizon) == [(0, horizon_fine_grained, 'euler'), (horizon_fine_grained, controller.horizon, 'rk4')]
+    assert robot.get_integration_stages(horizon_fine_grained + 1, controller.horizon) == [(horizon_fine_grained + 1, controller.horizon, 'rk4')]
+
+    state_current, ref_state = _dummy_state_and_reference()
+    state_jax, reference_jax = controller.prepare_state_and_reference(state_current, ref_state, np.ones(4), np.ones(4))
+    inputs = jnp.zeros(24, dtype=jnp.float32).at[12:].set(30.0)
+    contact_status = jnp.ones(4, dtype=jnp.float32)
+    for n, integrator in [(0, 'euler'), (horizon_fine_grained, 'rk4')]:
+        # A traced step selects the integrator of its stage at runtime
+        traced = jax.jit(lambda n: robot.integrate_jax(state_jax, inputs, contact_status, n))(n)
+        assert np.allclose(traced, robot.integrate_jax(state_jax, inputs, contact_status, n, integrator=integrator), atol=1e-6)
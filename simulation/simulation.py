@@ -21,6 +21,7 @@ from gym_quadruped.utils.mujoco.visual import render_sphere
 
 # PyMPC controller imports
 from quadruped_pympc.quadruped_pympc_wrapper import QuadrupedPyMPC_Wrapper
+from quadruped_pympc.helpers.jax_compilation import configure_host_devices
 
 # HeightMap import
 if(cfg.simulation_params['visual_foothold_adaptation'] != 'blind'):
@@ -34,6 +35,9 @@ def run_simulation(process=0, num_episodes=500, return_dict=None, seed_number=0,
     np.set_printoptions(precision=3, suppress=True)
     np.random.seed(seed_number) 
 
+    # The host CPU devices of the sampling controller, before jax is used
+    configure_host_devices(cfg.mpc_params.get('num_sampling_devices', 1))
+
     robot_name = cfg.robot
     hip_height = cfg.hip_height
     robot_leg_joints = cfg.robot_leg_joints